@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Benchmark of the story engine: readers walk a story at random and every step is timed.
+# Usage:
+#   python benchmark.py --story SPACE_FROG.json --readers 1000 --steps 20000
+#   python benchmark.py --passages 5000 --depth 8 --output results.json
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from typing import List
+
+from macro import *
+from passage import *
+from story import Story, STORY_NAME, STORY_PASSAGES, STORY_FIRST_PASSAGE_ID
+from story_template import StoryTemplate
+
+BENCHMARK_USERNAME = 'benchmark_bot'
+FRAGMENT_NAME = 'fragment_{}'
+
+def generate_story(passages: int, depth: int, seed: int = 0) -> dict:
+    """
+    Generates story in "GTwine to JSON" format. Every passage displays a chain of `depth` fragments,
+    holds `depth` nested hooks, a link-reveal showing a hidden hook, a variable and two links.
+    """
+    randomizer = random.Random(seed)
+    passage_dicts = []
+    for index in range(depth):
+        text = f'fragment {index} '
+        macros = []
+        if index + 1 < depth:
+            display = {MACROS_NAME: MACRO_DISPLAY, MACROS_VALUE: FRAGMENT_NAME.format(index + 1), MACROS_ORIGINAL_TEXT: f'(display:"{FRAGMENT_NAME.format(index + 1)}")'}
+            text += display[MACROS_ORIGINAL_TEXT]
+            macros.append(display)
+        else:
+            visits = {MACROS_NAME: MACRO_SET, MACROS_VALUE: '$visits to "many"', MACROS_ORIGINAL_TEXT: '(set: $visits to "many")'}
+            text += visits[MACROS_ORIGINAL_TEXT]
+            macros.append(visits)
+        passage_dicts.append(_create_passage(f'f{index}', FRAGMENT_NAME.format(index), text, [], [], macros))
+
+    for index in range(passages):
+        nested_hook = None
+        for level in reversed(range(depth)):
+            hook_text = f'level {level} '
+            if nested_hook != None:
+                hook_text += nested_hook[HOOK_ORIGINAL_TEXT]
+            nested_hook = {HOOK_TEXT: hook_text, HOOK_ORIGINAL_TEXT: f'[{hook_text}]', HOOK_IS_HIDDEN: False,
+                           HOOK_HOOKS: [nested_hook] if nested_hook != None else [], HOOK_MACROS: []}
+        secret = {HOOK_NAME: 'secret', HOOK_TEXT: f'Secret of {index}.', HOOK_ORIGINAL_TEXT: f'|secret)[Secret of {index}.]', HOOK_IS_HIDDEN: True}
+        show = {MACROS_NAME: MACRO_SHOW, MACROS_VALUE: '?secret', MACROS_ORIGINAL_TEXT: '(show: ?secret)'}
+        attached_hook = {HOOK_TEXT: show[MACROS_ORIGINAL_TEXT], HOOK_ORIGINAL_TEXT: f'[{show[MACROS_ORIGINAL_TEXT]}]', HOOK_IS_HIDDEN: False, HOOK_MACROS: [show]}
+        reveal = {MACROS_NAME: MACRO_LINK_REVEAL, MACROS_VALUE: f'more {index}', MACROS_ATTACHED_HOOK: attached_hook,
+                  MACROS_ORIGINAL_TEXT: f'(link-reveal:"more {index}"){attached_hook[HOOK_ORIGINAL_TEXT]}'}
+        display = {MACROS_NAME: MACRO_DISPLAY, MACROS_VALUE: FRAGMENT_NAME.format(0), MACROS_ORIGINAL_TEXT: f'(display:"{FRAGMENT_NAME.format(0)}")'}
+        links = []
+        for link_text in ('Next', 'Other'):
+            destination = str(randomizer.randrange(passages))
+            links.append({LINK_TEXT: link_text, LINK_DESTINATION_NAME: destination, LINK_ORIGINAL_TEXT: f'[[{link_text}|{destination}]]'})
+
+        text = (f'{display[MACROS_ORIGINAL_TEXT]}\nPassage {index} with $visits visits. {reveal[MACROS_ORIGINAL_TEXT]}\n'
+                f'{nested_hook[HOOK_ORIGINAL_TEXT]}\n{secret[HOOK_ORIGINAL_TEXT]}\n' + ' '.join(link[LINK_ORIGINAL_TEXT] for link in links))
+        passage_dicts.append(_create_passage(str(index), str(index), text, links, [nested_hook, secret], [display, reveal]))
+
+    return {STORY_NAME: f'Synthetic {passages}x{depth}', STORY_FIRST_PASSAGE_ID: '0', STORY_PASSAGES: passage_dicts}
+
+def _create_passage(id: str, name: str, text: str, links: List[dict], hooks: List[dict], macros: List[dict]) -> dict:
+    return {PASSAGE_ID: id, PASSAGE_NAME: name, PASSAGE_TEXT: text, PASSAGE_LINKS: links, PASSAGE_HOOKS: hooks, PASSAGE_MACROS: macros, PASSAGE_IMAGES: []}
+
+def percentile(sorted_values: List[int], fraction: float) -> int:
+    if len(sorted_values) == 0:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def walk(story: Story, randomizer: random.Random, template: StoryTemplate) -> Story:
+    """
+    Makes one reader step: reveals a link or follows a link, then renders the passage.
+    """
+    macros = [macro for macro in story.current_passage.passage.link_reveal_macros if macro.index not in story.current_passage.revealed_macros]
+    links = story.get_links()
+    if len(macros) > 0 and randomizer.random() < 0.3:
+        story.navigate_by_deeplink(template.links.reveal_payloads[(story.current_passage.id, randomizer.choice(macros).index)])
+    elif len(links) > 0:
+        destination_name = randomizer.choice(links).destination_name
+        if destination_name in template.passages_by_name:
+            story.navigate(destination_name)
+    else:
+        # Reader has reached the end and starts again
+        story = Story(template, BENCHMARK_USERNAME)
+    story.get_clean_text()
+    story.get_links()
+    story.get_image()
+    return story
+
+def run(story_dict: dict, readers: int, steps: int, seed: int) -> dict:
+    compile_start = time.perf_counter()
+    template = StoryTemplate(story_dict)
+    compile_seconds = time.perf_counter() - compile_start
+
+    gc.collect()
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    stories = [Story(template, BENCHMARK_USERNAME) for _ in range(readers)]
+    memory_new_sessions = tracemalloc.get_traced_memory()[0] - memory_before
+
+    randomizer = random.Random(seed)
+    for index in range(readers):
+        stories[index] = walk(stories[index], randomizer, template)
+    memory_visited_sessions = tracemalloc.get_traced_memory()[0] - memory_before
+    memory_before = tracemalloc.get_traced_memory()[0]
+    packed_stories = [story.pack() for story in stories]
+    memory_packed_sessions = tracemalloc.get_traced_memory()[0] - memory_before
+    tracemalloc.stop()
+    del packed_stories
+
+    latencies = []
+    started = time.perf_counter()
+    for step in range(steps):
+        # Readers take turns, like concurrent readers served by one process
+        index = step % readers
+        step_start = time.perf_counter_ns()
+        stories[index] = walk(stories[index], randomizer, template)
+        latencies.append(time.perf_counter_ns() - step_start)
+    seconds = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'story': template.name,
+        'passages': len(template.passages_by_id),
+        'readers': readers,
+        'steps': steps,
+        'compile_seconds': compile_seconds,
+        'steps_per_second': steps / seconds if seconds > 0 else 0,
+        'latency_p50_us': percentile(latencies, 0.5) / 1000,
+        'latency_p99_us': percentile(latencies, 0.99) / 1000,
+        'latency_max_us': latencies[-1] / 1000 if len(latencies) > 0 else 0,
+        'new_session_bytes': memory_new_sessions / readers,
+        'visited_session_bytes': memory_visited_sessions / readers,
+        'packed_session_bytes': memory_packed_sessions / readers,
+    }
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark of the story engine')
+    parser.add_argument('--story', help='story JSON file, synthetic story is generated when not given')
+    parser.add_argument('--passages', type=int, default=2000, help='passages of synthetic story')
+    parser.add_argument('--depth', type=int, default=6, help='display and hook nesting of synthetic story')
+    parser.add_argument('--readers', type=int, default=1000, help='simulated readers')
+    parser.add_argument('--steps', type=int, default=20000, help='steps made by all readers together')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', help='label stored with results, e.g. version')
+    parser.add_argument('--output', help='file to write JSON results to, stdout by default')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.story != None:
+        with open(arguments.story) as f:
+            story_dict = json.load(f)
+    else:
+        story_dict = generate_story(arguments.passages, arguments.depth, arguments.seed)
+
+    results = run(story_dict, arguments.readers, arguments.steps, arguments.seed)
+    results['label'] = arguments.label
+    results['python'] = platform.python_version()
+    results['timestamp'] = time.time()
+
+    if arguments.output != None:
+        with open(arguments.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
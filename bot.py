@@ -8,82 +8,426 @@
 # Basic Echobot example, repeats messages.
 # Press Ctrl-C on the command line or send a signal to the process to stop the
 # bot.
-import json
-import base64
+import argparse
+import asyncio
 from os.path import exists
 from pathlib import Path
 from story import Story
+from story_registry import StoryRegistry
+from story_template import StoryError, StoryTemplate
+from link_codec import get_link_secret
 from link import Link
-import sys
+from image_cache import ImageCache
+from render_cache import Frame, RenderCache
+from metrics import Metrics, MetricsServer
+from prefetcher import Prefetcher
+from send_scheduler import MessageRef, SendScheduler, MAX_IN_FLIGHT
+from update_processor import ChatUpdateProcessor
+from update_log import UpdateRecorder
+from session_cache import SessionCache
+from session_store import SessionStore, SqliteSessionStore
+from webhook_server import serve_webhook
+from sharding import WorkerPool, create_front_application
 from typing import List
 
-from telegram import ParseMode, Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, CallbackContext, CallbackQueryHandler, Filters
-from telegram.utils import helpers
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import TelegramError
+from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, TypeHandler
+from telegram.request import BaseRequest
 
 import logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                      level=logging.INFO)
+logger = logging.getLogger(__name__)
 
-STORY = "story"
+SESSIONS = "sessions"
+REGISTRY = "registry"
+SCHEDULER = "scheduler"
+PREFETCHER = "prefetcher"
+RECORDER = "recorder"
+NAVIGATION = "navigation"
+# Reader's last passage message as `MessageRef` and hash of its image, kept in chat data
+LAST_MESSAGE = "last_message"
+LAST_IMAGE = "last_image"
 
-def start(update: Update, context: CallbackContext) -> None:
+NAVIGATION_EDIT = 'edit'
+NAVIGATION_RESEND = 'resend'
+STORY_CALLBACK_PREFIX = 'story:'
+STALE_BUTTON_TEXT = 'This button is from an older version of the story'
+BROKEN_STORY_TEXT = 'This story can\'t be read right now, please try again later'
+DEFAULT_STORIES = ['SPACE_FROG.json']
+STORY_CACHE_SIZE = 32
+IMAGE_CACHE_FILE = 'image_cache.json'
+SHARD_IMAGE_CACHE_FILE = 'image_cache-{}.json'
+SESSIONS_FILE = 'sessions.sqlite3'
+SHARD_SESSIONS_FILE = 'sessions-{}.sqlite3'
+# Update log of a worker, by log path and shard
+SHARD_UPDATE_LOG = '{}.{}'
+MAX_CONCURRENT_UPDATES = 256
+MAX_HOT_SESSIONS = 10000
+# Packed sessions take about 200 bytes each
+MAX_PACKED_SESSIONS = 1000000
+SESSION_IDLE_TTL = 600
+MAX_QUEUED_UPDATES = 1024
+RENDER_CACHE_SIZE = 4096
+METRICS_SERVER = "metrics_server"
+METRICS_HOST = '127.0.0.1'
+
+STAGE_START = 'start'
+STAGE_BUTTON = 'button'
+STAGE_NAVIGATE = 'navigate'
+STAGE_RENDER = 'render'
+STAGE_KEYBOARD = 'keyboard'
+STAGE_SEND = 'send'
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    with metrics.time(STAGE_START):
+        try:
+            await start_story(update, context)
+        except StoryError:
+            await report_broken_story(update, context)
+
+async def start_story(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     payload = context.args
+    replaced = None
+    cleanup = None
     if len(payload) > 0:
         data = payload[0]
-        story: Story = context.user_data[STORY]
-        story.navigate_by_deeplink(data)
+        story = await get_story(update, context)
+        with metrics.time(STAGE_NAVIGATE):
+            # Unknown links leave the passage as it is
+            story.navigate_by_deeplink(data)
+        if context.bot_data[NAVIGATION] == NAVIGATION_EDIT:
+            # Link in the text was clicked, passage is updated where it is and the command is cleaned up
+            replaced = context.chat_data.get(LAST_MESSAGE)
+            cleanup = context.bot_data[SCHEDULER].delete(MessageRef.of(update.effective_message), can_edit=False)
     else:
-        context.user_data.clear()
+        registry: StoryRegistry = context.bot_data[REGISTRY]
+        if len(registry.headers) > 1:
+            await send_catalogue(update, context, registry)
+            return
         username = context.bot.username
-        context.user_data[STORY] = Story(selected_story, username)
-    update_message(update, context)
+        story = Story(await get_template(context), username)
+    await asyncio.gather(update_message(update, context, story, replaced), wait_cleanup(cleanup))
+    context.bot_data[SESSIONS].save(update.effective_user.id, story)
 
-def button(update: Update, context: CallbackContext) -> None:
+async def send_catalogue(update: Update, context: ContextTypes.DEFAULT_TYPE, registry: StoryRegistry) -> None:
+    keyboard = []
+    for header in registry.get_headers():
+        # Story ids may be too long for callback data, signed index of the story is sent instead
+        keyboard.append([InlineKeyboardButton(header.name, callback_data=STORY_CALLBACK_PREFIX + registry.story_data[header.story_id])])
+    scheduler: SendScheduler = context.bot_data[SCHEDULER]
+    await scheduler.send_message(update.effective_chat.id, 'Choose a story', reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def choose_story(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    node_name = query.data
+    story_id = context.bot_data[REGISTRY].find_story(query.data[len(STORY_CALLBACK_PREFIX):])
+    if story_id == None:
+        # Catalogue of another bot or a forged button
+        metrics.increment('stale_buttons_total')
+        await context.bot_data[SCHEDULER].answer(query, text=STALE_BUTTON_TEXT)
+        return
+    try:
+        story = Story(await get_template(context, story_id), context.bot.username)
+    except StoryError:
+        await report_broken_story(update, context)
+        return
+
+    scheduler: SendScheduler = context.bot_data[SCHEDULER]
+    await asyncio.gather(scheduler.answer(query), update_message(update, context, story, MessageRef.of(query.message)))
+    context.bot_data[SESSIONS].save(update.effective_user.id, story)
+
+async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    with metrics.time(STAGE_BUTTON):
+        query = update.callback_query
+
+        try:
+            story = await get_story(update, context)
+        except StoryError:
+            await report_broken_story(update, context)
+            return
+        with metrics.time(STAGE_NAVIGATE):
+            is_known = story.navigate_by_button(query.data)
+
+        # CallbackQueries need to be answered, even if no notification to the user is needed
+        # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
+        scheduler: SendScheduler = context.bot_data[SCHEDULER]
+        if not is_known:
+            metrics.increment('stale_buttons_total')
+            await scheduler.answer(query, text=STALE_BUTTON_TEXT)
+            return
+        # Clicked message is replaced, the scheduler turns it into an edit when it can
+        await asyncio.gather(scheduler.answer(query), update_message(update, context, story, MessageRef.of(query.message)))
+        context.bot_data[SESSIONS].save(update.effective_user.id, story)
+
+async def get_story(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Story:
+    sessions: SessionCache = context.bot_data[SESSIONS]
+    story = await sessions.get(update.effective_user.id, context.bot.username)
+    if story == None:
+        # Reader has never started the story
+        story = Story(await get_template(context), context.bot.username)
+    return story
+
+async def report_broken_story(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Registry has logged why the story failed to compile
+    scheduler: SendScheduler = context.bot_data[SCHEDULER]
+    if update.callback_query != None:
+        await scheduler.answer(update.callback_query, text=BROKEN_STORY_TEXT)
+    else:
+        await scheduler.send_message(update.effective_chat.id, BROKEN_STORY_TEXT)
 
-    # CallbackQueries need to be answered, even if no notification to the user is needed
-    # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
-    query.answer()
-    query.delete_message()
+async def get_template(context: ContextTypes.DEFAULT_TYPE, story_id: str = None) -> StoryTemplate:
+    registry: StoryRegistry = context.bot_data[REGISTRY]
+    # Story is compiled here if nobody has read it lately, other readers are served meanwhile
+    return await asyncio.to_thread(registry.get_template, story_id)
 
-    story: Story = context.user_data[STORY]
-    story.navigate(node_name)
+async def update_message(update: Update, context: ContextTypes.DEFAULT_TYPE, story: Story, replaced: MessageRef = None):
+    """
+    Sends current passage of the story, `replaced` message is deleted.
+    In `NAVIGATION_EDIT` mode `replaced` message is edited instead when it is of the same kind,
+    when it shows the same image only its caption is changed.
+    """
+    user_id = update.effective_user.id
+    prefetcher: Prefetcher = context.bot_data.get(PREFETCHER)
+    frame = get_frame(story, prefetcher, user_id)
+    text = frame.text
+    reply_markup = frame.reply_markup
+    image = frame.image
+    scheduler: SendScheduler = context.bot_data[SCHEDULER]
+    chat_id = update.effective_chat.id
+    can_edit = context.bot_data[NAVIGATION] == NAVIGATION_EDIT
+    last_message: MessageRef = context.chat_data.get(LAST_MESSAGE)
+    image_hash = image_cache.get_hash(image) if image != None else None
 
-    update_message(update, context)
+    # Delete is queued right before the send, so they can become one edit
+    deleted = scheduler.delete(replaced, can_edit) if replaced != None else None
+    if image == None:
+        sent = scheduler.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    else:
+        photo = image_cache.get_photo(image)
+        keep_photo = (can_edit and replaced != None and last_message != None and last_message.message_id == replaced.message_id
+                      and context.chat_data.get(LAST_IMAGE) == image_hash)
+        if not isinstance(photo, str) and not keep_photo:
+            metrics.increment('image_uploads_total')
+        sent = scheduler.send_photo(chat_id, photo, caption=text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN, keep_photo=keep_photo)
+    with metrics.time(STAGE_SEND):
+        message, _ = await asyncio.gather(sent, wait_cleanup(deleted))
+    if isinstance(message, MessageRef):
+        # Edit left the message as it was
+        context.chat_data[LAST_MESSAGE] = message
+    else:
+        # Whole message would stay in chat data of every reader, only what the next page turn needs is kept
+        context.chat_data[LAST_MESSAGE] = MessageRef.of(message)
+        if image != None:
+            image_cache.save_file_id(image, message.photo[-1].file_id)
+    context.chat_data[LAST_IMAGE] = image_hash
+    if prefetcher != None:
+        prefetcher.prefetch(user_id, story)
+
+async def wait_cleanup(deleted: asyncio.Future = None) -> None:
+    """
+    Waits for a delete queued with the scheduler. Message left behind is only untidy,
+    so its failure is logged and the reader's story goes on.
+    """
+    if deleted == None:
+        return
+    try:
+        await deleted
+    except TelegramError as error:
+        logger.warning('Message is not deleted: %s', error)
 
-def update_message(update: Update, context: CallbackContext):
-    story: Story = context.user_data[STORY]
+def get_frame(story: Story, prefetcher: Prefetcher = None, user_id = None) -> Frame:
+    key = story.get_render_key()
+    frame = render_cache.get(key)
+    if frame == None and prefetcher != None:
+        frame = prefetcher.take(user_id, key)
+        if frame != None:
+            render_cache.put(key, frame)
+    if frame != None:
+        story.variables.update(frame.assignments)
+        return frame
 
-    text = story.get_clean_text()
+    frame = render_frame(story, metrics)
+    render_cache.put(key, frame)
+    return frame
+
+def render_frame(story: Story, metrics: Metrics) -> Frame:
+    with metrics.time(STAGE_RENDER, (story.template.id, story.current_passage.id)):
+        text = story.get_clean_text()
     links: List[Link] = story.get_links()
 
-    keyboard = []
-    for link in links:
-        keyboard.append([InlineKeyboardButton(link.link_text, callback_data=link.destination_name)])
+    with metrics.time(STAGE_KEYBOARD):
+        keyboard = []
+        button_data = story.template.links.button_data
+        for link in links:
+            data = button_data.get(link.destination_name)
+            # Links to missing passages are reported when the story is loaded
+            if data != None:
+                keyboard.append([InlineKeyboardButton(link.link_text, callback_data=data)])
+
+        reply_markup = InlineKeyboardMarkup(keyboard)
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return Frame(text, reply_markup, story.get_image(), dict(story.get_assignments()))
 
-    text = story.get_clean_text()
-    image_base64 = story.get_image_base64()
-    image_bytes = None
-    if image_base64 != None:
-        image_bytes = base64.b64decode(image_base64.encode('ascii'))
+image_cache = ImageCache(IMAGE_CACHE_FILE)
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+# Disabled unless metrics are served or logged
+metrics = Metrics()
+# Prefetch renders are not timed, they run in other threads and are off the click path
+UNTIMED = Metrics()
 
-    if image_bytes == None:
-        update.effective_chat.send_message(text=text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+async def close_sessions(application: Application) -> None:
+    await application.bot_data[SCHEDULER].stop()
+    prefetcher: Prefetcher = application.bot_data.get(PREFETCHER)
+    if prefetcher != None:
+        prefetcher.stop()
+    recorder: UpdateRecorder = application.bot_data.get(RECORDER)
+    if recorder != None:
+        recorder.close()
+    application.bot_data[SESSIONS].close()
+    server: MetricsServer = application.bot_data.get(METRICS_SERVER)
+    if server != None:
+        await server.stop()
+
+def create_application(token: str, base_url: str = None, session_store: SessionStore = None, registry: StoryRegistry = None,
+                       metrics_port: int = None, metrics_log_interval: float = None, navigation: str = NAVIGATION_EDIT,
+                       prefetch: bool = False, watch_interval: float = None, record_updates: str = None,
+                       request: BaseRequest = None, session_ttl: float = SESSION_IDLE_TTL) -> Application:
+    """
+    `base_url` points the bot to another Bot API server, e.g. `FakeBotApi` for offline runs.
+    `request` makes Bot API calls instead of HTTP, e.g. `FakeBotRequest` for replays.
+    `navigation` tells whether readers turn pages by editing the message or by getting a new one.
+    With `prefetch` passages a reader can go to next are rendered while the reader reads the current one.
+    Story files are checked for changes every `watch_interval` seconds, changed stories are reloaded.
+    Every update is appended to `record_updates` log file when it is given, see `replay.py`.
+    Reader progress is kept in `session_store`, SQLite file `SESSIONS_FILE` by default.
+    Stories of readers idle for `session_ttl` seconds are packed and unpacked on their next click.
+    Stories come from `registry`, `DEFAULT_STORIES` by default.
+    Metrics are collected when `metrics_port` or `metrics_log_interval` is given: served
+    on `METRICS_HOST` at `metrics_port` and logged every `metrics_log_interval` seconds.
+    """
+    async def start_tasks(application: Application) -> None:
+        if metrics_port != None:
+            server = MetricsServer(metrics)
+            await server.start(METRICS_HOST, metrics_port)
+            application.bot_data[METRICS_SERVER] = server
+        if metrics_log_interval != None:
+            application.create_task(metrics.log_periodically(metrics_log_interval))
+        if watch_interval != None:
+            application.create_task(registry.watch(watch_interval))
+
+    builder = Application.builder().token(token).concurrent_updates(ChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    if request != None:
+        builder = builder.request(request)
     else:
-        update.effective_chat.send_photo(image_bytes, caption=text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+        # One pool of connections serves every call the scheduler lets through
+        builder = builder.connection_pool_size(MAX_IN_FLIGHT)
+    # Bounded, so the webhook can push back when updates come faster than they are handled
+    builder = builder.update_queue(asyncio.Queue(MAX_QUEUED_UPDATES))
+    if base_url != None:
+        builder = builder.base_url(base_url)
+    application = builder.post_init(start_tasks).post_shutdown(close_sessions).build()
+
+    # Stories are compiled once, every reader shares them and keeps only own progress
+    if registry == None:
+        registry = StoryRegistry(DEFAULT_STORIES, STORY_CACHE_SIZE, get_link_secret(token))
+    application.bot_data[REGISTRY] = registry
+    if session_store == None:
+        session_store = SqliteSessionStore(SESSIONS_FILE)
+    sessions = SessionCache(session_store, MAX_HOT_SESSIONS, registry.get_template, MAX_PACKED_SESSIONS, session_ttl, registry.find_template)
+    application.bot_data[SESSIONS] = sessions
+    scheduler = SendScheduler(application.bot)
+    application.bot_data[SCHEDULER] = scheduler
+    application.bot_data[NAVIGATION] = navigation
+    if prefetch:
+        prefetcher = Prefetcher(lambda story: render_frame(story, UNTIMED))
+        application.bot_data[PREFETCHER] = prefetcher
+        metrics.add_counter('prefetch_scheduled_total', lambda: prefetcher.scheduled)
+        metrics.add_counter('prefetch_used_total', lambda: prefetcher.used)
+        metrics.add_counter('prefetch_wasted_total', lambda: prefetcher.wasted)
+        metrics.add_counter('prefetch_evicted_total', lambda: prefetcher.evicted)
+        metrics.add_gauge('prefetch_bytes', lambda: prefetcher.size)
 
-selected_story = {}
-with open('SPACE_FROG.json') as f:
-   selected_story = json.load(f)
+    if metrics_port != None or metrics_log_interval != None:
+        metrics.enabled = True
+    metrics.add_counter('render_cache_hits_total', lambda: render_cache.hits)
+    metrics.add_counter('render_cache_misses_total', lambda: render_cache.misses)
+    metrics.add_counter('coalesced_edits_total', lambda: scheduler.coalesced)
+    metrics.add_counter('flood_waits_total', lambda: scheduler.flood_waits)
+    metrics.add_gauge('active_sessions', lambda: len(sessions))
+    metrics.add_gauge('packed_sessions', sessions.get_packed_count)
+    metrics.add_gauge('active_session_bytes', sessions.get_hot_bytes)
+    metrics.add_gauge('packed_session_bytes', lambda: sessions.packed_bytes)
+    metrics.add_counter('session_packs_total', lambda: sessions.packs)
+    metrics.add_counter('session_unpacks_total', lambda: sessions.unpacks)
+    metrics.add_gauge('loaded_stories', registry.get_loaded_count)
+    metrics.add_counter('story_reloads_total', lambda: registry.reloads)
 
-updater = Updater(sys.argv[1])
+    if record_updates != None:
+        recorder = UpdateRecorder(record_updates)
+        application.bot_data[RECORDER] = recorder
+        # Group before the others, so every update is recorded before it is handled
+        application.add_handler(TypeHandler(Update, recorder.record), group=-1)
+    application.add_handler(CommandHandler('start', start))
+    application.add_handler(CallbackQueryHandler(choose_story, pattern='^' + STORY_CALLBACK_PREFIX))
+    application.add_handler(CallbackQueryHandler(button))
+    return application
 
-updater.dispatcher.add_handler(CommandHandler('start', start))
-updater.dispatcher.add_handler(CallbackQueryHandler(button))
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Telegram bot reading Twine stories')
+    parser.add_argument('token', help='bot token')
+    parser.add_argument('--webhook-url', help='receive updates with a webhook at this public url instead of polling')
+    parser.add_argument('--listen', default='0.0.0.0', help='address of the webhook server')
+    parser.add_argument('--port', type=int, default=8443, help='port of the webhook server')
+    parser.add_argument('--webhook-path', default='/', help='path of the webhook server')
+    parser.add_argument('--secret-token', help='secret Telegram sends with every webhook request')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes sharing readers by chat id')
+    parser.add_argument('--stories', nargs='+', default=DEFAULT_STORIES, help='story JSON files or directories with them')
+    parser.add_argument('--metrics-port', type=int, help=f'serve Prometheus metrics on {METRICS_HOST} at this port, workers use the following ports')
+    parser.add_argument('--metrics-log-interval', type=float, help='log metrics every given number of seconds')
+    parser.add_argument('--navigation', choices=(NAVIGATION_EDIT, NAVIGATION_RESEND), default=NAVIGATION_EDIT,
+                        help='edit the message in place on page turn, or delete it and send a new one')
+    parser.add_argument('--prefetch', action='store_true', help='render passages readers can go to next in background threads')
+    parser.add_argument('--watch-interval', type=float, help='reload changed story files, checking them every given number of seconds')
+    parser.add_argument('--session-ttl', type=float, default=SESSION_IDLE_TTL, help='pack stories of readers idle for this many seconds')
+    parser.add_argument('--record-updates', help='append every update to this log file for replay.py, workers add their number to it')
+    return parser.parse_args()
 
-updater.start_polling()
-updater.idle()
\ No newline at end of file
+def create_worker_application(token: str, shard: int, registry: StoryRegistry, metrics_port: int = None, metrics_log_interval: float = None,
+                              navigation: str = NAVIGATION_EDIT, prefetch: bool = False, watch_interval: float = None,
+                              record_updates: str = None, session_ttl: float = SESSION_IDLE_TTL) -> Application:
+    global image_cache
+    # Workers would overwrite file ids saved by each other in a shared file
+    image_cache = ImageCache(SHARD_IMAGE_CACHE_FILE.format(shard))
+    if metrics_port != None:
+        metrics_port += shard
+    if record_updates != None:
+        record_updates = SHARD_UPDATE_LOG.format(record_updates, shard)
+    return create_application(token, session_store=SqliteSessionStore(SHARD_SESSIONS_FILE.format(shard)), registry=registry,
+                              metrics_port=metrics_port, metrics_log_interval=metrics_log_interval, navigation=navigation,
+                              prefetch=prefetch, watch_interval=watch_interval, record_updates=record_updates,
+                              session_ttl=session_ttl)
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    registry = StoryRegistry(arguments.stories, STORY_CACHE_SIZE, get_link_secret(arguments.token))
+    # Broken default story stops the bot right away, and workers forked later share the compiled one
+    registry.get_template()
+    if arguments.workers > 1:
+        pool = WorkerPool(arguments.workers, lambda shard: create_worker_application(arguments.token, shard, registry,
+                                                                                      arguments.metrics_port, arguments.metrics_log_interval,
+                                                                                      arguments.navigation, arguments.prefetch,
+                                                                                      arguments.watch_interval, arguments.record_updates,
+                                                                                      arguments.session_ttl))
+        pool.start()
+        application = create_front_application(arguments.token, pool)
+    else:
+        application = create_application(arguments.token, registry=registry, metrics_port=arguments.metrics_port,
+                                         metrics_log_interval=arguments.metrics_log_interval, navigation=arguments.navigation,
+                                         prefetch=arguments.prefetch, watch_interval=arguments.watch_interval,
+                                         record_updates=arguments.record_updates, session_ttl=arguments.session_ttl)
+    if arguments.webhook_url == None:
+        application.run_polling()
+    else:
+        asyncio.run(serve_webhook(application, arguments.webhook_url, arguments.listen, arguments.port, arguments.webhook_path, arguments.secret_token))
@@ -5,13 +5,54 @@ from logging import fatal
 from os import name
 import unittest
 from story import *
+from story_analyzer import StoryError
 from passage import *
 from link import Link
+from image_cache import ImageCache
+from render_cache import RenderCache, Frame
+from fake_bot_api import FakeBotApi
+from telegram import Update
+import bot
+from update_processor import ChatUpdateProcessor
+from session_store import SqliteSessionStore, FileSessionStore
+from session_cache import SessionCache
+from webhook_server import WebhookServer
+from sharding import WorkerPool
+from story_registry import StoryHeader, StoryRegistry, read_header
+from story_file import ImageBlob, StoryFile, convert_story
+from story_compiler import compile_stories
+from image_pipeline import MAX_PHOTO_SIDE, ImagePipeline, is_available, optimize_image
+import io
+from expression import ExpressionError, compile_assignments, compile_expression
+from metrics import Histogram, Metrics
+from send_scheduler import MessageRef, SendScheduler, TokenBucket
+from prefetcher import Prefetcher
+from telegram import Bot
+import benchmark
+import replay
+from update_log import read_updates
+import urllib.error, urllib.request
+import asyncio, base64, gc, json, multiprocessing, os, re, tempfile, threading, weakref
+from pathlib import Path
+from passage_state import PassageState
 
 TEST_USER = 'test_user'
 
+with open('SPACE_FROG.json') as f:
+    SPACE_FROG = json.load(f)
+
+OTHER_STORY = {STORY_NAME: 'Other', STORY_UUID: 'other', STORY_FIRST_PASSAGE_ID: '1',
+               STORY_PASSAGES: [benchmark._create_passage('1', 'start', 'Other story', [], [], [])]}
+
 DEFAULT_ID = '3'
 
+def get_reveal_key(story: Story, macro_value: str) -> tuple:
+    macro = next(macro for macro in story.current_passage.passage.link_reveal_macros if macro.value == macro_value)
+    return (story.current_passage.id, macro.index)
+
+def get_reveal_payload(story: Story, macro_value: str) -> str:
+    return story.template.links.reveal_payloads[get_reveal_key(story, macro_value)]
+
 PARAGRAPH_TEST_TEXT = 'paragraph_text'
 HOOK_TEST_TEXT = 'hook_text'
 
@@ -162,7 +203,7 @@ class StoryTests(unittest.TestCase):
         test_passage = self._create_passage(text=text, macros=[macro])
         story_dict = self._create_dict(passages=[test_passage])
         story = Story(story_dict, TEST_USER)
-        url = story.create_url(MACRO_LINK_REVEAL, macro_value)
+        url = story.create_reveal_url(*get_reveal_key(story, macro_value))
         expected_text = f'[{macro_value}]({url})'
 
         self.assertEqual(story.get_clean_text(), expected_text)
@@ -175,7 +216,7 @@ class StoryTests(unittest.TestCase):
         test_passage = self._create_passage(text=text, macros=[macro])
         story_dict = self._create_dict(passages=[test_passage])
         story = Story(story_dict, TEST_USER)
-        data = story._create_url_data(MACRO_LINK_REVEAL, macro_value)
+        data = get_reveal_payload(story, macro_value)
         expected_text = macro_value + HOOK_TEST_TEXT
         story.get_clean_text()
 
@@ -237,7 +278,7 @@ class StoryTests(unittest.TestCase):
         passage_text = link_macro[MACROS_ORIGINAL_TEXT] + hook[HOOK_ORIGINAL_TEXT] + hidden_hook[HOOK_ORIGINAL_TEXT]
         passage = self._create_passage(text=passage_text, macros=[link_macro], hooks=[hidden_hook])
         story = Story(self._create_dict(passages=[passage]), TEST_USER)
-        data = story._create_url_data(MACRO_LINK_REVEAL, link_value)
+        data = get_reveal_payload(story, link_value)
 
         story.get_clean_text()
         story.navigate_by_deeplink(data)
@@ -275,5 +316,1363 @@ class StoryTests(unittest.TestCase):
 
         self.assertEqual(story.get_clean_text(), variable_value)
 
+    def test_show_macro_after_hidden_hook_works(self):
+        hidden_hook_name = "hook_name"
+        hidden_hook = self._create_hidden_hook(hidden_hook_name, HOOK_TEST_TEXT)
+        show_macro = self._create_macro(name=MACRO_SHOW, value=f'?{hidden_hook_name}')
+        text = hidden_hook[HOOK_ORIGINAL_TEXT] + PARAGRAPH_TEST_TEXT + show_macro[MACROS_ORIGINAL_TEXT]
+        passage = self._create_passage(text=text, macros=[show_macro], hooks=[hidden_hook])
+        story = Story(self._create_dict(passages=[passage]), TEST_USER)
+
+        self.assertEqual(story.get_clean_text(), HOOK_TEST_TEXT + PARAGRAPH_TEST_TEXT)
+
+    def test_render_key_depends_on_revealed_macros_and_variables(self):
+        hook = self._create_hook(text=HOOK_TEST_TEXT)
+        macro_value = "test_value"
+        macro = self._create_macro(MACRO_LINK_REVEAL, macro_value, attachedHook=hook)
+        variable_name = '$plushieName'
+        text = macro[MACROS_ORIGINAL_TEXT] + hook[HOOK_ORIGINAL_TEXT] + variable_name
+        template = StoryTemplate(self._create_dict(passages=[self._create_passage(text=text, macros=[macro])]))
+        story = Story(template, TEST_USER)
+        another_story = Story(template, TEST_USER)
+        self.assertEqual(story.get_render_key(), another_story.get_render_key())
+
+        story.navigate_by_deeplink(get_reveal_payload(story, macro_value))
+        self.assertNotEqual(story.get_render_key(), another_story.get_render_key())
+
+        another_story.variables[variable_name] = 'Whispy'
+        self.assertNotEqual(Story(template, TEST_USER).get_render_key(), another_story.get_render_key())
+
+    def _create_conditional_passage(self) -> dict:
+        macros = [self._create_macro(MACRO_IF, '$count > 1'), self._create_macro(MACRO_ELSE_IF, '$count is 1'), self._create_macro(MACRO_ELSE, '')]
+        hooks = [self._create_hook(text='many'), self._create_hook(text='one'), self._create_hook(text='none')]
+        text = ''.join(macro[MACROS_ORIGINAL_TEXT] + hook[HOOK_ORIGINAL_TEXT] for macro, hook in zip(macros, hooks))
+        return self._create_passage(text=text, macros=macros, hooks=hooks)
+
+    def test_conditional_chain_shows_one_hook(self):
+        story = Story(self._create_dict(passages=[self._create_conditional_passage()]), TEST_USER)
+
+        texts = []
+        for count in (0, 1, 5):
+            story.variables['$count'] = count
+            texts.append(story.get_clean_text())
+
+        self.assertEqual(texts, ['none', 'one', 'many'])
+
+    def test_render_key_depends_on_condition_variables(self):
+        template = StoryTemplate(self._create_dict(passages=[self._create_conditional_passage()]))
+        story = Story(template, TEST_USER)
+
+        story.variables['$count'] = 1
+
+        self.assertNotEqual(story.get_render_key(), Story(template, TEST_USER).get_render_key())
+
+    def test_set_and_put_evaluate_expressions(self):
+        set_macro = self._create_macro(MACRO_SET, '$count to $count + 2, $name to "Whispy"')
+        put_macro = self._create_macro(MACRO_PUT, '$count * 10 into $score')
+        text = set_macro[MACROS_ORIGINAL_TEXT] + put_macro[MACROS_ORIGINAL_TEXT] + '$name $score'
+        story = Story(self._create_dict(passages=[self._create_passage(text=text, macros=[set_macro, put_macro])]), TEST_USER)
+
+        self.assertEqual(story.get_clean_text(), 'Whispy 20')
+        self.assertEqual(story.get_assignments(), {'$count': 2, '$name': 'Whispy', '$score': 20})
+
+    def test_set_is_applied_once_when_show_renders_again(self):
+        hidden_hook = self._create_hidden_hook('hook_name', HOOK_TEST_TEXT)
+        set_macro = self._create_macro(MACRO_SET, '$count to $count + 1')
+        show_macro = self._create_macro(MACRO_SHOW, '?hook_name')
+        text = set_macro[MACROS_ORIGINAL_TEXT] + hidden_hook[HOOK_ORIGINAL_TEXT] + show_macro[MACROS_ORIGINAL_TEXT] + '$count'
+        story = Story(self._create_dict(passages=[self._create_passage(text=text, macros=[set_macro, show_macro], hooks=[hidden_hook])]), TEST_USER)
+
+        self.assertEqual(story.get_clean_text(), HOOK_TEST_TEXT + '1')
+
+    def test_unsupported_expression_is_skipped(self):
+        set_macro = self._create_macro(MACRO_SET, "$tags to (passage:)'s tags")
+        passage = self._create_passage(text=set_macro[MACROS_ORIGINAL_TEXT] + PARAGRAPH_TEST_TEXT, macros=[set_macro])
+
+        with self.assertLogs('story_template', 'WARNING'):
+            story = Story(self._create_dict(passages=[passage]), TEST_USER)
+
+        self.assertEqual(story.get_clean_text(), PARAGRAPH_TEST_TEXT)
+        self.assertEqual(story.variables, {})
+
+    def _create_display_macro(self, passage_name: str) -> dict:
+        return {MACROS_NAME: MACRO_DISPLAY, MACROS_VALUE: passage_name, MACROS_ORIGINAL_TEXT: f'({MACRO_DISPLAY}:\"{passage_name}\")'}
+
+    def test_link_reveal_of_displayed_passage_is_plain_text(self):
+        hook = self._create_hook(text=HOOK_TEST_TEXT)
+        reveal = self._create_macro(MACRO_LINK_REVEAL, 'open', attachedHook=hook)
+        another_passage = self._create_passage(id='10', name='another', text=reveal[MACROS_ORIGINAL_TEXT] + hook[HOOK_ORIGINAL_TEXT], macros=[reveal])
+        display = self._create_display_macro('another')
+        first_passage = self._create_passage(text=display[MACROS_ORIGINAL_TEXT], macros=[display])
+
+        story = Story(self._create_dict(passages=[first_passage, another_passage]), TEST_USER)
+
+        self.assertEqual(story.get_clean_text(), 'open')
+
+    def test_display_cycle_fails_loading(self):
+        first_macro = self._create_display_macro('second')
+        second_macro = self._create_display_macro('first')
+        first_passage = self._create_passage(id='1', name='first', text=first_macro[MACROS_ORIGINAL_TEXT], macros=[first_macro])
+        second_passage = self._create_passage(id='2', name='second', text=second_macro[MACROS_ORIGINAL_TEXT], macros=[second_macro])
+
+        with self.assertRaises(StoryError):
+            StoryTemplate(self._create_dict(passages=[first_passage, second_passage], first_passage_id='1'))
+
+    def test_missing_display_fails_loading(self):
+        macro = self._create_display_macro('missing')
+        passage = self._create_passage(text=macro[MACROS_ORIGINAL_TEXT], macros=[macro])
+
+        with self.assertRaises(StoryError):
+            StoryTemplate(self._create_dict(passages=[passage]))
+
+    def test_missing_start_passage_fails_loading(self):
+        with self.assertRaises(StoryError):
+            StoryTemplate(self._create_dict(passages=[self._create_passage()], first_passage_id='missing'))
+
+    def test_unreachable_passages_are_found(self):
+        target_name = 'target'
+        link = {LINK_ORIGINAL_TEXT: '[[target]]', LINK_DESTINATION_NAME: target_name, LINK_TEXT: target_name}
+        first_passage = self._create_passage(text=link[LINK_ORIGINAL_TEXT], links=[link])
+        target_passage = self._create_passage(id='4', name=target_name)
+        lost_passage = self._create_passage(id='5', name='lost')
+
+        template = StoryTemplate(self._create_dict(passages=[first_passage, target_passage, lost_passage]))
+
+        self.assertEqual(template.analysis.unreachable_passage_ids, {'5'})
+
+    def test_static_display_is_inlined(self):
+        another_passage = self._create_passage(id='10', text='another_text', name='another')
+        macro = self._create_display_macro('another')
+        first_passage = self._create_passage(text=macro[MACROS_ORIGINAL_TEXT] + PARAGRAPH_TEST_TEXT, macros=[macro])
+
+        template = StoryTemplate(self._create_dict(passages=[first_passage, another_passage]))
+
+        self.assertEqual(template.passages_by_id[DEFAULT_ID].nodes, (TextNode('another_text' + PARAGRAPH_TEST_TEXT),))
+
+    def test_sessions_share_template_without_sharing_progress(self):
+        hook = self._create_hook(text=HOOK_TEST_TEXT)
+        macro_value = "test_value"
+        macro = self._create_macro(MACRO_LINK_REVEAL, macro_value, attachedHook=hook)
+        text = macro[MACROS_ORIGINAL_TEXT] + hook[HOOK_ORIGINAL_TEXT]
+        template = StoryTemplate(self._create_dict(passages=[self._create_passage(text=text, macros=[macro])]))
+        story = Story(template, TEST_USER)
+        another_story = Story(template, TEST_USER)
+        data = get_reveal_payload(story, macro_value)
+        story.get_clean_text()
+
+        story.navigate_by_deeplink(data)
+
+        self.assertEqual(story.get_clean_text(), macro_value + HOOK_TEST_TEXT)
+        self.assertEqual(another_story.get_clean_text(), f'[{macro_value}]({story.create_reveal_url(*get_reveal_key(story, macro_value))})')
+
+    def test_snapshot_does_not_share_later_progress(self):
+        template = StoryTemplate(SPACE_FROG)
+        story = Story(template, TEST_USER)
+        story.navigate('1')
+        story.variables['$name'] = 'Hobert'
+        snapshot = story.snapshot()
+        text = snapshot.get_clean_text()
+
+        story.navigate_by_deeplink(get_reveal_payload(story, 'SPACE FROG'))
+        story.variables['$name'] = 'SPACE FROG'
+        snapshot.navigate('2')
+
+        self.assertEqual(snapshot.variables, {'$name': 'Hobert'})
+        self.assertEqual(snapshot.revealed_macros, {})
+        self.assertEqual(story.current_passage.id, '1')
+        self.assertNotEqual(story.get_clean_text(), text)
+        snapshot.navigate('1')
+        self.assertEqual(snapshot.get_clean_text(), text)
+
+    def test_new_story_copies_nothing_from_template(self):
+        template = StoryTemplate(SPACE_FROG)
+        story = Story(template, TEST_USER)
+        story.navigate('1')
+
+        self.assertIs(story.current_passage.images, template.passages_by_id['1'].images)
+        self.assertIs(story.current_passage.revealed_macros, Story(template, TEST_USER).current_passage.revealed_macros)
+        self.assertEqual(story.get_state()[STATE_REVEALED_MACROS], {})
+
+class LinkCodecTests(unittest.TestCase):
+
+    def setUp(self):
+        self.template = StoryTemplate(SPACE_FROG, link_secret=b'secret')
+
+    def test_button_data_is_compact_and_decoded(self):
+        data = self.template.links.button_data['2']
+
+        self.assertLessEqual(len(data.encode('utf-8')), 64)
+        self.assertEqual(self.template.links.get_passage_name(data), '2')
+
+    def test_links_of_another_story_or_key_are_rejected(self):
+        data = self.template.links.button_data['2']
+        other_story = StoryTemplate(dict(SPACE_FROG, uuid='other'), link_secret=b'secret')
+        other_key = StoryTemplate(SPACE_FROG, link_secret=b'other')
+        forged = data[:-1] + ('A' if data[-1] != 'A' else 'B')
+
+        self.assertIsNone(other_story.links.get_passage_name(data))
+        self.assertIsNone(other_key.links.get_passage_name(data))
+        self.assertIsNone(self.template.links.get_passage_name(forged))
+
+    def test_deeplink_reveals_only_in_its_passage(self):
+        story = Story(self.template, TEST_USER)
+        story.navigate('1')
+        payload = get_reveal_payload(story, 'SPACE FROG')
+        url = story.create_reveal_url(*get_reveal_key(story, 'SPACE FROG'))
+
+        self.assertTrue(url.endswith('start=' + payload))
+        self.assertTrue(story.navigate_by_deeplink(payload))
+        story.navigate('2')
+        self.assertFalse(story.navigate_by_deeplink(payload))
+
+class ExpressionTests(unittest.TestCase):
+
+    def test_operators_follow_precedence(self):
+        expression = compile_expression('not ($a + 2 * 3 is 7) or "frog" is in $b')
+
+        self.assertEqual(expression.evaluate({'$a': 1, '$b': 'space frog'}), True)
+        self.assertEqual(expression.evaluate({'$a': 1, '$b': 'sheep'}), False)
+        self.assertEqual(expression.variable_names, {'$a', '$b'})
+
+    def test_booleans_are_not_numbers(self):
+        self.assertEqual(compile_expression('$a is 1').evaluate({'$a': True}), False)
+        with self.assertRaises(ExpressionError):
+            compile_expression('$a + 1').evaluate({'$a': True})
+
+    def test_unknown_syntax_fails_compilation(self):
+        with self.assertRaises(ExpressionError):
+            compile_assignments('$a to')
+        with self.assertRaises(ExpressionError):
+            compile_expression('$a is is 1')
+
+class SessionTests(unittest.TestCase):
+
+    STATE = {STATE_PASSAGE_ID: '2', STATE_VARIABLES: {'$name': 'value'}, STATE_REVEALED_MACROS: {'2': [0]}}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _check_store_keeps_state(self, create_store):
+        store = create_store()
+        store.save(1, self.STATE)
+        self.assertEqual(store.load(1), self.STATE)
+        store.close()
+
+        store = create_store()
+        self.assertEqual(store.load(1), self.STATE)
+        self.assertIsNone(store.load(2))
+        store.close()
+
+    def test_sqlite_store_keeps_state(self):
+        self._check_store_keeps_state(lambda: SqliteSessionStore(os.path.join(self.directory.name, 'sessions.sqlite3')))
+
+    def test_file_store_keeps_state(self):
+        self._check_store_keeps_state(lambda: FileSessionStore(os.path.join(self.directory.name, 'sessions.jsonl')))
+
+    def test_file_store_cuts_off_broken_last_line(self):
+        file_path = os.path.join(self.directory.name, 'sessions.jsonl')
+        store = FileSessionStore(file_path)
+        store.save(1, self.STATE)
+        store.close()
+        with open(file_path, 'ab') as f:
+            f.write(b'{"user": "2", "sta')
+
+        store = FileSessionStore(file_path)
+        store.save(3, self.STATE)
+        store.close()
+        store = FileSessionStore(file_path)
+
+        self.assertEqual((store.load(1), store.load(2), store.load(3)), (self.STATE, None, self.STATE))
+        store.close()
+
+    def test_state_waiting_to_be_written_is_loaded(self):
+        store = SqliteSessionStore(':memory:', flush_interval=60)
+        store.save(1, {'v': 'old'})
+        store.flush()
+        store.save(1, {'v': 'new'})
+        loaded = []
+
+        # As if the writer was busy with the previous batch
+        with store._write_lock:
+            flush = threading.Thread(target=store.flush)
+            flush.start()
+            flush.join(0.05)
+            load = threading.Thread(target=lambda: loaded.append(store.load(1)))
+            load.start()
+            load.join(1)
+            loaded_before_write = list(loaded)
+        flush.join()
+        load.join()
+
+        store.close()
+        self.assertEqual(loaded_before_write, [{'v': 'new'}])
+
+    def test_story_state_is_restored(self):
+        template = StoryTemplate(SPACE_FROG)
+        story = Story(template, TEST_USER)
+        story.navigate('1')
+        story.navigate_by_deeplink(get_reveal_payload(story, 'SPACE FROG'))
+        restored_story = Story(template, TEST_USER)
+
+        restored_story.restore_state(story.get_state())
+
+        self.assertEqual(restored_story.get_clean_text(), story.get_clean_text())
+
+    def test_evicted_session_is_loaded_from_store(self):
+        template = StoryTemplate(SPACE_FROG)
+        store = SqliteSessionStore(':memory:')
+        sessions = SessionCache(store, 1, lambda story_id: template)
+        story = Story(template, TEST_USER)
+        story.navigate('1')
+        sessions.save(1, story)
+        sessions.save(2, Story(template, TEST_USER))
+
+        restored_story = asyncio.run(sessions.get(1, TEST_USER))
+
+        self.assertIsNot(restored_story, story)
+        self.assertEqual(restored_story.get_state(), story.get_state())
+        sessions.close()
+
+    def test_session_is_read_while_other_readers_are_served(self):
+        template = StoryTemplate(SPACE_FROG)
+        store = SqliteSessionStore(':memory:', flush_interval=60)
+        store.save(1, Story(template, TEST_USER).get_state())
+        store.flush()
+        sessions = SessionCache(store, 10, lambda story_id: template)
+
+        async def get_while_batch_is_written():
+            with store._write_lock:
+                loading = asyncio.create_task(sessions.get(1, TEST_USER))
+                await asyncio.sleep(0.05)
+                self.assertFalse(loading.done())
+            return await loading
+
+        story = asyncio.run(get_while_batch_is_written())
+
+        sessions.close()
+        self.assertEqual(story.current_passage.id, template.first_passage_id)
+
+    def test_idle_session_is_packed_and_unpacked(self):
+        template = StoryTemplate(SPACE_FROG)
+        sessions = SessionCache(SqliteSessionStore(':memory:'), 10, lambda story_id: template, packed_capacity=10, idle_ttl=60)
+        story = Story(template, TEST_USER)
+        story.navigate('1')
+        story.navigate_by_deeplink(get_reveal_payload(story, 'SPACE FROG'))
+        story.variables['name'] = 'frog'
+        sessions.save(1, story, now=0)
+        sessions.save(2, Story(template, TEST_USER), now=100)
+
+        self.assertEqual((len(sessions), sessions.get_packed_count()), (1, 1))
+        self.assertLess(sessions.packed_bytes, story.get_size() / 3)
+        restored_story = asyncio.run(sessions.get(1, TEST_USER, now=101))
+
+        self.assertIsNot(restored_story, story)
+        self.assertEqual(restored_story.get_state(), story.get_state())
+        self.assertEqual(restored_story.get_clean_text(), story.get_clean_text())
+        self.assertEqual((sessions.unpacks, sessions.packed_bytes), (1, 0))
+        sessions.close()
+
+    def test_packed_sessions_are_bounded(self):
+        template = StoryTemplate(SPACE_FROG)
+        sessions = SessionCache(SqliteSessionStore(':memory:'), 1, lambda story_id: template, packed_capacity=1)
+        story = Story(template, TEST_USER)
+        story.navigate('1')
+        for user_id in (1, 2, 3):
+            sessions.save(user_id, story)
+
+        restored_story = asyncio.run(sessions.get(1, TEST_USER))
+
+        self.assertEqual(sessions.unpacks, 0)
+        self.assertEqual(restored_story.get_state(), story.get_state())
+        self.assertEqual(sessions.get_packed_count(), 1)
+        sessions.close()
+
+class StoryRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.frog_path = self._write_story('frog.json', SPACE_FROG)
+        self.other_path = self._write_story('other.json', OTHER_STORY)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write_story(self, file_name: str, story_dict: dict) -> str:
+        path = os.path.join(self.directory.name, file_name)
+        with open(path, 'w') as f:
+            json.dump(story_dict, f)
+        return path
+
+    def test_header_is_read_without_passages(self):
+        path = os.path.join(self.directory.name, 'cut.json')
+        with open(path, 'w') as f:
+            f.write('{"name": "Cut", "uuid": "cut", "startNode": "7", "passages": [{"pid": ')
+
+        self.assertEqual(read_header(path), StoryHeader('cut', 'Cut', '7', path))
+
+    def test_directory_is_scanned_and_stories_are_loaded_lazily(self):
+        registry = StoryRegistry([self.directory.name], capacity=2)
+
+        self.assertEqual(sorted(header.name for header in registry.get_headers()), ['Other', SPACE_FROG[STORY_NAME]])
+        self.assertEqual(len(registry._templates), 0)
+        self.assertEqual(registry.get_template('other').name, 'Other')
+        self.assertEqual(len(registry._templates), 1)
+
+    def test_least_recently_used_story_is_dropped(self):
+        registry = StoryRegistry([self.frog_path, self.other_path], capacity=1)
+        frog = weakref.ref(registry.get_template())
+
+        registry.get_template('other')
+        gc.collect()
+
+        self.assertIsNone(frog())
+        self.assertEqual(registry.get_loaded_count(), 1)
+
+    def test_dropped_story_still_read_is_not_compiled_again(self):
+        registry = StoryRegistry([self.frog_path, self.other_path], capacity=1)
+        frog = registry.get_template()
+
+        registry.get_template('other')
+
+        self.assertIs(registry.get_template(), frog)
+
+    def test_loaded_story_is_not_held_up_by_compile_of_another(self):
+        registry = StoryRegistry([self.frog_path, self.other_path], capacity=2)
+        other = registry.get_template('other')
+        frog_id = registry.default_story_id
+
+        # As if another thread was compiling the frog story
+        with registry._loading.setdefault(frog_id, threading.Lock()):
+            self.assertIs(registry.get_template('other'), other)
+
+    def test_failed_compile_is_remembered_until_file_changes(self):
+        display = {MACROS_NAME: MACRO_DISPLAY, MACROS_VALUE: 'missing', MACROS_ORIGINAL_TEXT: '(display:"missing")'}
+        broken = benchmark._create_passage('1', 'start', '(display:"missing")', [], [], [display])
+        self._write_story('other.json', dict(OTHER_STORY, passages=[broken]))
+        registry = StoryRegistry([self.other_path], capacity=1)
+
+        with self.assertLogs('story_registry', 'ERROR') as logs:
+            for _ in range(2):
+                with self.assertRaises(StoryError):
+                    registry.get_template()
+        self._rewrite_story(self.other_path, OTHER_STORY)
+        registry.reload_changed()
+
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(registry.get_template().name, 'Other')
+
+    def _rewrite_story(self, path: str, story_dict: dict) -> None:
+        modified = os.stat(path).st_mtime_ns
+        self._write_story(os.path.basename(path), story_dict)
+        # Same second on coarse file systems
+        os.utime(path, ns=(modified + 10 ** 9, modified + 10 ** 9))
+
+    def test_changed_story_is_reloaded_and_readers_migrate(self):
+        registry = StoryRegistry([self.other_path], capacity=1)
+        template = registry.get_template()
+        sessions = SessionCache(SqliteSessionStore(':memory:'), 10, registry.get_template)
+        sessions.save(1, Story(template, TEST_USER))
+        renamed = benchmark._create_passage('2', 'start', 'New story', [], [], [])
+        self._rewrite_story(self.other_path, dict(OTHER_STORY, startNode='2', passages=[renamed]))
+
+        self.assertEqual(registry.reload_changed(), ['other'])
+        story = asyncio.run(sessions.get(1, TEST_USER))
+
+        sessions.close()
+        self.assertIs(template.replaced_by, registry.get_template())
+        self.assertIs(story.template, registry.get_template())
+        # Passage has a new id, it is found by name
+        self.assertEqual(story.get_clean_text(), 'New story')
+        self.assertEqual(registry.reload_changed(), [])
+
+    def test_packed_readers_dont_keep_old_version(self):
+        registry = StoryRegistry([self.other_path], capacity=1)
+        template = registry.get_template()
+        sessions = SessionCache(SqliteSessionStore(':memory:'), 1, registry.get_template, packed_capacity=10,
+                                find_template=registry.find_template)
+        sessions.save(1, Story(template, TEST_USER))
+        # Reader of another story packs the first one
+        sessions.save(2, Story(StoryTemplate(SPACE_FROG), TEST_USER))
+        old_version = weakref.ref(template)
+        del template
+        renamed = benchmark._create_passage('2', 'start', 'New story', [], [], [])
+        self._rewrite_story(self.other_path, dict(OTHER_STORY, startNode='2', passages=[renamed]))
+
+        registry.reload_changed()
+        gc.collect()
+        story = asyncio.run(sessions.get(1, TEST_USER))
+
+        sessions.close()
+        self.assertIsNone(old_version())
+        self.assertEqual(sessions.unpacks, 0)
+        self.assertEqual(story.get_clean_text(), 'New story')
+
+    def test_reader_of_removed_passage_starts_again(self):
+        template = StoryTemplate(SPACE_FROG)
+        story = Story(template, TEST_USER)
+        story.navigate('1')
+        story.navigate_by_deeplink(get_reveal_payload(story, 'SPACE FROG'))
+        passages = [passage for passage in SPACE_FROG[STORY_PASSAGES] if passage[PASSAGE_ID] != '1']
+        template.replaced_by = StoryTemplate(dict(SPACE_FROG, passages=passages))
+
+        self.assertTrue(story.migrate())
+        self.assertEqual(story.current_passage.id, SPACE_FROG[STORY_FIRST_PASSAGE_ID])
+        self.assertEqual(story.revealed_macros, {})
+
+    def test_buttons_sent_before_reload_still_work(self):
+        template = StoryTemplate(SPACE_FROG)
+        story = Story(template, TEST_USER)
+        story.navigate('2')
+        destination_name = story.get_links()[0].destination_name
+        data = template.links.button_data[destination_name]
+        # Every passage after the removed one moves up in the file
+        passages = [passage for passage in SPACE_FROG[STORY_PASSAGES] if passage[PASSAGE_ID] != '1']
+        template.replaced_by = StoryTemplate(dict(SPACE_FROG, passages=passages))
+
+        self.assertTrue(story.migrate())
+        self.assertTrue(story.navigate_by_button(data))
+        self.assertEqual(story.current_passage.name, destination_name)
+
+    def test_broken_change_keeps_old_version(self):
+        registry = StoryRegistry([self.other_path], capacity=1)
+        template = registry.get_template()
+        self._rewrite_story(self.other_path, dict(OTHER_STORY, startNode='missing'))
+
+        with self.assertLogs('story_registry', 'ERROR') as logs:
+            self.assertEqual(registry.reload_changed(), [])
+            registry.reload_changed()
+        self.assertEqual(len(logs.records), 1)
+        self.assertIs(registry.get_template(), template)
+        self.assertIsNone(template.replaced_by)
+
+    def test_removed_story_file_is_reported_once(self):
+        registry = StoryRegistry([self.other_path], capacity=1)
+        template = registry.get_template()
+        os.remove(self.other_path)
+
+        with self.assertLogs('story_registry', 'ERROR') as logs:
+            self.assertEqual(registry.reload_changed(), [])
+            registry.reload_changed()
+        self.assertEqual(len(logs.records), 1)
+        self.assertIs(registry.get_template(), template)
+
+    def test_watch_goes_on_after_failed_check(self):
+        registry = StoryRegistry([self.other_path], capacity=1)
+        checks = []
+
+        def reload_changed():
+            checks.append(1)
+            raise RuntimeError('broken check')
+        registry.reload_changed = reload_changed
+
+        async def watch():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(registry.watch(0.01), 0.2)
+        with self.assertLogs('story_registry', 'ERROR'):
+            asyncio.run(watch())
+        self.assertGreater(len(checks), 1)
+
+class StoryFileTests(unittest.TestCase):
+
+    IMAGE_BYTES = b'image_bytes'
+    IMAGE_BASE_64 = base64.b64encode(IMAGE_BYTES).decode('ascii')
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _convert(self, story_dict: dict) -> str:
+        path = os.path.join(self.directory.name, 'story.twc')
+        convert_story(story_dict, path)
+        return path
+
+    def test_compiled_story_renders_same_text(self):
+        template = StoryTemplate(StoryFile(self._convert(SPACE_FROG)).get_story_dict())
+        story = Story(template, TEST_USER)
+        json_story = Story(SPACE_FROG, TEST_USER)
+        story.navigate('1')
+        json_story.navigate('1')
+
+        self.assertEqual(story.get_clean_text(), json_story.get_clean_text())
+        self.assertEqual([link.destination_name for link in story.get_links()], [link.destination_name for link in json_story.get_links()])
+
+    def test_images_are_stored_once_and_mapped(self):
+        image = {IMAGE_BASE_64: self.IMAGE_BASE_64, IMAGE_ORIGINAL: 'image'}
+        passages = [benchmark._create_passage(id, id, 'image', [], [], []) for id in ('1', '2')]
+        for passage in passages:
+            passage[PASSAGE_IMAGES] = [image]
+        story_file = StoryFile(self._convert({STORY_NAME: 'Images', STORY_FIRST_PASSAGE_ID: '1', STORY_PASSAGES: passages}))
+
+        story = Story(StoryTemplate(story_file.get_story_dict()), TEST_USER)
+        blob = story.get_image()
+
+        self.assertEqual(len(story_file.header['imageIndex']), 1)
+        self.assertIsInstance(blob, ImageBlob)
+        self.assertIs(blob.data.obj, story_file._map)
+        self.assertEqual(bytes(blob.data), self.IMAGE_BYTES)
+        # Uploaded image is known by the same hash in both formats
+        cache = ImageCache()
+        cache.save_file_id(self.IMAGE_BASE_64, 'file_id')
+        self.assertEqual(cache.get_photo(blob), 'file_id')
+
+    def test_registry_loads_compiled_story(self):
+        path = self._convert(SPACE_FROG)
+
+        registry = StoryRegistry([path], capacity=1)
+
+        self.assertEqual(registry.get_template().name, SPACE_FROG[STORY_NAME])
+
+class StoryCompilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.directory.name, 'compiled')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, name: str, story_dict: dict) -> str:
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as f:
+            json.dump(story_dict, f)
+        return path
+
+    def _get_hashes(self, images) -> list:
+        return [ImageCache().get_hash(image.get(IMAGE_BLOB) or image.get(IMAGE_BASE_64)) for image in images]
+
+    def test_snapshots_render_as_json_story(self):
+        [report] = compile_stories(['SPACE_FROG.json'], self.output)
+        compiled = StoryTemplate(StoryFile(report.output).get_story_dict())
+        template = StoryTemplate(SPACE_FROG)
+        story = Story(template, TEST_USER)
+
+        self.assertGreater(report.snapshots, 0)
+        for passage_id, passage in compiled.passages_by_id.items():
+            compiled_state = PassageState(passage, Story(compiled, TEST_USER))
+            state = PassageState(template.passages_by_id[passage_id], story)
+            self.assertEqual(compiled_state.get_clean_text(compiled.passages_by_name), state.get_clean_text(template.passages_by_name))
+            self.assertEqual(self._get_hashes(compiled_state.images), self._get_hashes(state.images))
+
+    def test_directory_is_compiled_in_parallel_and_broken_stories_reported(self):
+        self._write('other.json', OTHER_STORY)
+        self._write('no_start.json', {STORY_NAME: 'No start', STORY_PASSAGES: []})
+        display = {MACROS_NAME: MACRO_DISPLAY, MACROS_VALUE: 'missing', MACROS_ORIGINAL_TEXT: '(display:"missing")'}
+        broken = benchmark._create_passage('1', 'start', '(display:"missing")', [], [], [display])
+        self._write('broken_display.json', dict(OTHER_STORY, uuid='broken', passages=[broken]))
+
+        reports = {Path(report.path).name: report for report in compile_stories([self.directory.name], self.output, workers=2)}
+
+        self.assertEqual(reports['other.json'].output, os.path.join(self.output, 'other.twc'))
+        self.assertIn('start passage', reports['no_start.json'].error)
+        self.assertIn('displays missing passage', reports['broken_display.json'].error)
+        self.assertEqual(StoryRegistry([self.output], capacity=1).get_template().name, 'Other')
+
+class ImagePipelineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _create_image(self, width: int, height: int, mode: str = 'RGB') -> bytes:
+        from PIL import Image
+        image = Image.effect_noise((width, height), 64).convert(mode)
+        output = io.BytesIO()
+        image.save(output, 'PNG')
+        return output.getvalue()
+
+    def test_unreadable_image_is_kept(self):
+        self.assertEqual(optimize_image(b'not an image'), b'not an image')
+
+    @unittest.skipUnless(is_available(), 'Pillow is not installed')
+    def test_big_image_is_scaled_down_and_small_one_kept(self):
+        from PIL import Image
+        big = self._create_image(2560, 1600, 'RGBA')
+        small = base64.b64decode(next(passage for passage in SPACE_FROG[STORY_PASSAGES] if passage[PASSAGE_IMAGES])[PASSAGE_IMAGES][0][IMAGE_BASE_64])
+
+        optimized = optimize_image(big)
+
+        with Image.open(io.BytesIO(optimized)) as image:
+            self.assertEqual((image.format, image.size), ('JPEG', (MAX_PHOTO_SIDE, 800)))
+        self.assertLess(len(optimized), len(big))
+        self.assertEqual(optimize_image(small), small)
+
+    @unittest.skipUnless(is_available(), 'Pillow is not installed')
+    def test_equal_images_are_optimized_once_and_cached_on_disk(self):
+        first = self._create_image(2000, 100)
+        second = self._create_image(100, 2000)
+        pipeline = ImagePipeline(self.directory.name)
+
+        optimized = pipeline.process([first, second, first])
+        again = ImagePipeline(self.directory.name)
+
+        self.assertEqual(pipeline.processed, 2)
+        self.assertEqual(optimized[0], optimized[2])
+        self.assertEqual(again.process([second, first]), [optimized[1], optimized[0]])
+        self.assertEqual((again.processed, again.cache_hits), (0, 2))
+
+    @unittest.skipUnless(is_available(), 'Pillow is not installed')
+    def test_compiled_story_stores_optimized_images(self):
+        image = base64.b64encode(self._create_image(3000, 3000)).decode('ascii')
+        passage = dict(benchmark._create_passage('1', 'start', 'Look', [], [], []))
+        passage.update({PASSAGE_TEXT: '[img]', PASSAGE_IMAGES: [{IMAGE_ORIGINAL: '[img]', IMAGE_BASE_64: image}]})
+        path = os.path.join(self.directory.name, 'story.json')
+        with open(path, 'w') as f:
+            json.dump(dict(OTHER_STORY, passages=[passage]), f)
+
+        [report] = compile_stories([path], os.path.join(self.directory.name, 'compiled'), workers=2)
+        [passage] = StoryFile(report.output).get_story_dict()[STORY_PASSAGES]
+        [blob] = passage[PASSAGE_IMAGES]
+
+        self.assertLess(len(blob[IMAGE_BLOB].data), len(image) * 3 // 4)
+        self.assertEqual(blob[IMAGE_BLOB].hash, ImageCache().get_hash(image))
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_synthetic_story_renders_nested_content(self):
+        story = Story(benchmark.generate_story(passages=3, depth=3), TEST_USER)
+
+        text = story.get_clean_text()
+
+        self.assertIn('fragment 0 fragment 1 fragment 2', text)
+        self.assertIn('level 0 level 1 level 2', text)
+        self.assertIn('with many visits', text)
+
+    def test_results_are_reported(self):
+        results = benchmark.run(benchmark.generate_story(passages=10, depth=2), readers=5, steps=50, seed=0)
+
+        self.assertEqual(results['steps'], 50)
+        self.assertGreater(results['steps_per_second'], 0)
+        self.assertLessEqual(results['latency_p50_us'], results['latency_p99_us'])
+
+class RenderCacheTests(unittest.TestCase):
+
+    def _create_frame(self, text: str) -> Frame:
+        return Frame(text, None, None, {})
+
+    def test_hits_and_misses_are_counted(self):
+        cache = RenderCache(2)
+        cache.put('key', self._create_frame('text'))
+
+        self.assertEqual(cache.get('key').text, 'text')
+        self.assertIsNone(cache.get('another_key'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_frame_is_evicted(self):
+        cache = RenderCache(2)
+        cache.put('first', self._create_frame('first'))
+        cache.put('second', self._create_frame('second'))
+        cache.get('first')
+
+        cache.put('third', self._create_frame('third'))
+
+        self.assertIsNone(cache.get('second'))
+        self.assertIsNotNone(cache.get('first'))
+        self.assertEqual(len(cache), 2)
+
+class ImageCacheTests(unittest.TestCase):
+
+    IMAGE_BYTES = b'image_bytes'
+    IMAGE_BASE_64 = base64.b64encode(IMAGE_BYTES).decode('ascii')
+
+    def test_bytes_returned_before_upload(self):
+        cache = ImageCache()
+
+        self.assertEqual(cache.get_photo(self.IMAGE_BASE_64), self.IMAGE_BYTES)
+
+    def test_file_id_returned_after_upload(self):
+        cache = ImageCache()
+        cache.save_file_id(self.IMAGE_BASE_64, 'file_id')
+
+        self.assertEqual(cache.get_photo(self.IMAGE_BASE_64), 'file_id')
+
+    def test_file_ids_are_persisted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'image_cache.json')
+            ImageCache(file_path).save_file_id(self.IMAGE_BASE_64, 'file_id')
+
+            self.assertEqual(ImageCache(file_path).get_photo(self.IMAGE_BASE_64), 'file_id')
+
+    def test_broken_file_is_started_over(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'image_cache.json')
+            with open(file_path, 'w') as f:
+                f.write('{"cut')
+            cache = ImageCache(file_path)
+            cache.save_file_id(self.IMAGE_BASE_64, 'file_id')
+
+            self.assertEqual(ImageCache(file_path).get_photo(self.IMAGE_BASE_64), 'file_id')
+            self.assertEqual(os.listdir(directory), ['image_cache.json'])
+
+class MetricsTests(unittest.TestCase):
+
+    def test_histogram_counts_by_buckets(self):
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 5.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [1, 2, 1])
+        self.assertEqual(histogram.get_quantile(0.5), 1.0)
+        self.assertEqual(histogram.get_quantile(1.0), float('inf'))
+
+    def test_disabled_metrics_record_nothing(self):
+        metrics = Metrics()
+
+        with metrics.time('render', ('story', '1')):
+            pass
+        metrics.increment('image_uploads_total')
+
+        self.assertEqual((metrics.stages, metrics.passages, metrics.counters), ({}, {}, {}))
+
+    def test_export_has_stage_and_passage_histograms(self):
+        metrics = Metrics(enabled=True)
+        metrics.add_gauge('active_sessions', lambda: 3)
+
+        with metrics.time('render', ('frog', '1')):
+            pass
+        metrics.increment('image_uploads_total')
+        text = metrics.export()
+
+        self.assertIn('twinecoil_stage_seconds_count{stage="render"} 1', text)
+        self.assertIn('twinecoil_passage_seconds_count{stage="render",story="frog",passage="1"} 1', text)
+        self.assertIn('twinecoil_image_uploads_total 1', text)
+        self.assertIn('twinecoil_active_sessions 3', text)
+
+class ChatUpdateProcessorTests(unittest.IsolatedAsyncioTestCase):
+
+    def _create_update(self, chat_id: int) -> Update:
+        message = {'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': 'text'}
+        return Update.de_json({'update_id': 1, 'message': message}, None)
+
+    async def _record(self, events: list, name: str):
+        events.append(f'{name} started')
+        await asyncio.sleep(0.01)
+        events.append(f'{name} finished')
+
+    async def test_updates_of_one_chat_are_ordered(self):
+        processor = ChatUpdateProcessor(8)
+        events = []
+
+        await asyncio.gather(processor.process_update(self._create_update(1), self._record(events, 'first')),
+                             processor.process_update(self._create_update(1), self._record(events, 'second')))
+
+        self.assertEqual(events, ['first started', 'first finished', 'second started', 'second finished'])
+
+    async def test_updates_of_different_chats_are_concurrent(self):
+        processor = ChatUpdateProcessor(8)
+        events = []
+
+        await asyncio.gather(processor.process_update(self._create_update(1), self._record(events, 'first')),
+                             processor.process_update(self._create_update(2), self._record(events, 'second')))
+
+        self.assertEqual(events[:2], ['first started', 'second started'])
+
+    async def test_updates_waiting_for_busy_chat_dont_hold_back_other_chats(self):
+        processor = ChatUpdateProcessor(2)
+        events = []
+
+        await asyncio.gather(*(processor.process_update(self._create_update(1), self._record(events, f'busy {index}')) for index in range(4)),
+                             processor.process_update(self._create_update(2), self._record(events, 'other')))
+
+        self.assertEqual(events[:2], ['busy 0 started', 'other started'])
+
+class WorkerPoolTests(unittest.IsolatedAsyncioTestCase):
+
+    def _create_update(self, chat_id: int, update_id: int) -> Update:
+        message = {'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': 'text'}
+        return Update.de_json({'update_id': update_id, 'message': message}, None)
+
+    async def test_updates_of_one_chat_go_to_one_worker_in_order(self):
+        pool = WorkerPool(2, None)
+
+        for update_id in range(3):
+            await pool.route(self._create_update(3, update_id), None)
+        await pool.route(self._create_update(4, 3), None)
+
+        self.assertEqual([pool.queues[1].get(timeout=1)['update_id'] for _ in range(3)], [0, 1, 2])
+        self.assertEqual(pool.queues[0].get(timeout=1)['update_id'], 3)
+
+    async def test_dead_worker_is_started_again(self):
+        pool = WorkerPool(1, lambda shard: os._exit(3))
+        pool.start()
+        dead = pool._processes[0]
+        dead.join(5)
+
+        with self.assertLogs('sharding', 'ERROR') as logs:
+            await pool.route(self._create_update(1, 0), None)
+        pool._processes[0].join(5)
+        pool.stop()
+
+        self.assertIn('Worker 0 has died with exit code 3', logs.output[0])
+        self.assertIsNot(pool._processes[0], dead)
+
+    async def test_front_loop_runs_while_worker_is_behind(self):
+        pool = WorkerPool(1, None)
+        pool.queues = [multiprocessing.get_context('fork').Queue(1)]
+
+        await pool.route(self._create_update(1, 0), None)
+        routed = asyncio.create_task(pool.route(self._create_update(1, 1), None))
+        await asyncio.sleep(0.05)
+        self.assertFalse(routed.done())
+        first = pool.queues[0].get(timeout=1)
+        await asyncio.wait_for(routed, 1)
+
+        self.assertEqual([first['update_id'], pool.queues[0].get(timeout=1)['update_id']], [0, 1])
+
+FAKE_TOKEN = '1:fake'
+
+class TokenBucketTests(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, capacity=2, now=0)
+
+        bucket.take(0)
+        bucket.take(0)
+
+        self.assertEqual(bucket.get_delay(0), 0.5)
+        self.assertEqual(bucket.get_delay(0.5), 0)
+
+class SendSchedulerTests(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.api = FakeBotApi()
+        self.api.start()
+        self.bot = Bot(FAKE_TOKEN, base_url=self.api.base_url)
+        await self.bot.initialize()
+
+    async def asyncTearDown(self):
+        await self.bot.shutdown()
+        self.api.stop()
+
+    async def test_delete_and_send_of_text_become_edit(self):
+        scheduler = SendScheduler(self.bot)
+        message = await scheduler.send_message(1, 'first')
+
+        deleted = scheduler.delete(MessageRef.of(message))
+        edited = await scheduler.send_message(1, 'second')
+        await deleted
+        await scheduler.stop()
+
+        self.assertEqual(self.api.get_methods()[-1], 'editMessageText')
+        self.assertNotIn('deleteMessage', self.api.get_methods())
+        self.assertEqual((edited.message_id, edited.text), (message.message_id, 'second'))
+        self.assertEqual(scheduler.coalesced, 1)
+
+    async def test_photo_replaced_by_text_is_resent(self):
+        scheduler = SendScheduler(self.bot)
+        message = await scheduler.send_photo(1, b'photo', caption='first')
+
+        deleted = scheduler.delete(MessageRef.of(message))
+        await scheduler.send_message(1, 'second')
+        await deleted
+        await scheduler.stop()
+
+        self.assertEqual(self.api.get_methods()[-2:], ['deleteMessage', 'sendMessage'])
+
+    async def test_delete_that_can_not_edit_is_not_coalesced(self):
+        scheduler = SendScheduler(self.bot)
+        message = await scheduler.send_message(1, 'first')
+
+        deleted = scheduler.delete(MessageRef.of(message), can_edit=False)
+        await scheduler.send_message(1, 'second')
+        await deleted
+        await scheduler.stop()
+
+        self.assertEqual(self.api.get_methods()[-2:], ['deleteMessage', 'sendMessage'])
+
+    async def test_kept_photo_edits_only_caption(self):
+        scheduler = SendScheduler(self.bot)
+        message = await scheduler.send_photo(1, b'photo', caption='first')
+
+        deleted = scheduler.delete(MessageRef.of(message))
+        edited = await scheduler.send_photo(1, b'photo', caption='second', keep_photo=True)
+        await deleted
+        await scheduler.stop()
+
+        self.assertEqual(self.api.get_methods()[-1], 'editMessageCaption')
+        self.assertEqual((edited.message_id, edited.caption), (message.message_id, 'second'))
+
+    async def test_chat_rate_keeps_below_flood_limit(self):
+        self.api.flood_interval = 0.04
+        # Sends are spaced 2.5 times wider than the limit, so jitter of the HTTP round trip can't bring two of them closer
+        scheduler = SendScheduler(self.bot, chat_rate=1 / (self.api.flood_interval * 2.5), chat_burst=1)
+
+        await asyncio.gather(*[scheduler.send_message(1, str(index)) for index in range(5)])
+        await scheduler.stop()
+
+        times = [request.time for request in self.api.requests if request.method == 'sendMessage']
+        self.assertEqual(self.api.flood_errors, 0)
+        self.assertEqual([request.params['text'] for request in self.api.requests if request.method == 'sendMessage'], ['0', '1', '2', '3', '4'])
+        self.assertTrue(all(later - earlier >= 0.04 for earlier, later in zip(times, times[1:])))
+
+    async def test_buckets_of_quiet_chats_are_dropped(self):
+        # Buckets refill in 10 ms, after the messages are sent
+        scheduler = SendScheduler(self.bot, chat_rate=100)
+        scheduler.sweep_interval = 0
+
+        await asyncio.gather(*[scheduler.send_message(chat_id, 'text') for chat_id in range(1, 51)])
+        await asyncio.sleep(0.05)
+        await scheduler.send_message(100, 'text')
+        await scheduler.stop()
+
+        self.assertLessEqual(len(scheduler._chat_buckets), 2)
+
+    async def test_retry_after_is_waited_out(self):
+        self.api.flood_interval = 0.5
+        scheduler = SendScheduler(self.bot, chat_rate=1000)
+
+        messages = await asyncio.gather(scheduler.send_message(1, 'first'), scheduler.send_message(1, 'second'))
+        await scheduler.stop()
+
+        self.assertEqual([message.text for message in messages], ['first', 'second'])
+        self.assertEqual(scheduler.flood_waits, 1)
+
+    async def test_answer_overtakes_queued_sends(self):
+        scheduler = SendScheduler(self.bot, chat_rate=5, chat_burst=1)
+        query = Update.de_json({'update_id': 1, 'callback_query': {'id': '1', 'from': {'id': 1, 'is_bot': False, 'first_name': 'reader'},
+                                                                      'chat_instance': '1', 'data': 'data'}}, self.bot).callback_query
+
+        sends = [scheduler.send_message(1, str(index)) for index in range(3)]
+        await asyncio.gather(scheduler.answer(query), *sends)
+        await scheduler.stop()
+
+        # Sends after the first one wait for the chat, the answer doesn't
+        self.assertLess(self.api.get_methods().index('answerCallbackQuery'), 3)
+
+class PrefetcherTests(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.template = StoryTemplate(SPACE_FROG)
+        self.prefetcher = Prefetcher(lambda story: bot.render_frame(story, Metrics()))
+
+    def tearDown(self):
+        self.prefetcher.stop()
+
+    async def test_destinations_are_rendered_ahead(self):
+        story = Story(self.template, TEST_USER)
+        destinations = {link.destination_name for link in story.get_links()}
+
+        self.prefetcher.prefetch(1, story)
+        await self.prefetcher.join()
+        story.navigate(destinations.pop())
+        frame = self.prefetcher.take(1, story.get_render_key())
+
+        self.assertEqual(frame.text, bot.render_frame(story.snapshot(), Metrics()).text)
+        self.assertEqual(self.prefetcher.used, 1)
+        self.assertIsNone(self.prefetcher.take(2, story.get_render_key()))
+
+    async def test_frames_are_dropped_when_reader_moves_on(self):
+        story = Story(self.template, TEST_USER)
+        self.prefetcher.prefetch(1, story)
+        await self.prefetcher.join()
+        count = len(self.prefetcher)
+
+        story.navigate('1')
+        self.prefetcher.prefetch(1, story)
+
+        self.assertGreater(count, 0)
+        self.assertEqual(self.prefetcher.wasted, count)
+
+    async def test_oldest_frames_are_evicted_over_budget(self):
+        self.prefetcher.max_bytes = 1
+        story = Story(self.template, TEST_USER)
+
+        for user_id in range(3):
+            self.prefetcher.prefetch(user_id, story)
+        await self.prefetcher.join()
+
+        self.assertEqual(len(self.prefetcher), 0)
+        self.assertEqual(self.prefetcher.evicted, self.prefetcher.scheduled)
+
+class BotTests(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.api = FakeBotApi()
+        self.api.start()
+        bot.image_cache = ImageCache()
+        bot.render_cache = RenderCache(16)
+        bot.metrics = Metrics()
+        self.store = SqliteSessionStore(':memory:')
+        self.application = bot.create_application(FAKE_TOKEN, self.api.base_url, self.store)
+        await self.application.initialize()
+
+    async def asyncTearDown(self):
+        await self.application.shutdown()
+        self.store.close()
+        self.api.stop()
+
+    def _create_start_update_dict(self, update_id: int = 1) -> dict:
+        message = {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'from': {'id': 1, 'is_bot': False, 'first_name': 'reader'},
+                   'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}
+        return {'update_id': update_id, 'message': message}
+
+    def _create_deeplink_update(self, payload: str, update_id: int) -> Update:
+        update_dict = self._create_start_update_dict(update_id)
+        update_dict['message']['text'] = f'/start {payload}'
+        return Update.de_json(update_dict, self.application.bot)
+
+    def _create_start_update(self, update_id: int = 1) -> Update:
+        return Update.de_json(self._create_start_update_dict(update_id), self.application.bot)
+
+    async def _post(self, port: int, data) -> int:
+        request = urllib.request.Request(f'http://127.0.0.1:{port}/', json.dumps(data).encode('utf-8'), {'Content-Type': 'application/json'})
+        try:
+            response = await asyncio.to_thread(urllib.request.urlopen, request)
+            return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+    def _create_button_update(self, data: str, update_id: int = 2) -> Update:
+        message = {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}}
+        callback_query = {'id': '1', 'from': {'id': 1, 'is_bot': False, 'first_name': 'reader'}, 'chat_instance': '1', 'message': message, 'data': data}
+        return Update.de_json({'update_id': update_id, 'callback_query': callback_query}, self.application.bot)
+
+    def _get_button_data(self, row: int = 0) -> str:
+        reply_markup = json.loads(self.api.requests[-1].params['reply_markup'])
+        return reply_markup['inline_keyboard'][row][0]['callback_data']
+
+    async def test_start_sends_first_passage(self):
+        await self.application.process_update(self._create_start_update())
+
+        request = self.api.requests[-1]
+        self.assertEqual(request.method, 'sendMessage')
+        self.assertIn('a story of a frog in space', request.params['text'])
+
+    async def test_second_reader_gets_cached_frame(self):
+        await self.application.process_update(self._create_start_update())
+        await self.application.process_update(self._create_start_update())
+
+        self.assertEqual((bot.render_cache.hits, bot.render_cache.misses), (1, 1))
+
+    async def test_button_answers_deletes_and_sends_next_passage(self):
+        await self.application.process_update(self._create_start_update())
+        await self.application.process_update(self._create_button_update(self._get_button_data()))
+
+        methods = self.api.get_methods()
+        photos = [request for request in self.api.requests if request.method == 'sendPhoto']
+        self.assertIn('answerCallbackQuery', methods)
+        self.assertIn('deleteMessage', methods)
+        self.assertIn('Once upon a time', photos[-1].params['caption'])
+
+    async def test_deeplink_edits_caption_of_passage_message(self):
+        await self.application.process_update(self._create_start_update())
+        await self.application.process_update(self._create_button_update(self._get_button_data()))
+        payload = re.search(r'start=([\w-]+)', self.api.requests[-1].params['caption']).group(1)
+
+        await self.application.process_update(self._create_deeplink_update(payload, 3))
+        await self.application.bot_data[bot.SCHEDULER].stop()
+
+        edits = [request for request in self.api.requests if request.method == 'editMessageCaption']
+        self.assertEqual(len(edits), 1)
+        self.assertIn('Hobert', edits[0].params['caption'])
+        self.assertNotIn('sendPhoto', self.api.get_methods()[-2:])
+        # Reader's /start command is cleaned up
+        self.assertIn({'chat_id': '1', 'message_id': '1'}, [request.params for request in self.api.requests if request.method == 'deleteMessage'])
+
+    async def test_only_reference_to_passage_message_is_kept(self):
+        await self.application.process_update(self._create_start_update())
+        await self.application.process_update(self._create_button_update(self._get_button_data()))
+
+        self.assertEqual(self.application.chat_data[1][bot.LAST_MESSAGE], MessageRef(1, 2, True))
+
+    async def test_failed_cleanup_of_start_command_is_waited_for(self):
+        await self.application.process_update(self._create_start_update())
+        await self.application.process_update(self._create_button_update(self._get_button_data()))
+        payload = re.search(r'start=([\w-]+)', self.api.requests[-1].params['caption']).group(1)
+        self.api.failing_methods.add('deleteMessage')
+
+        await self.application.process_update(self._create_deeplink_update(payload, 3))
+
+        self.assertCountEqual(self.api.get_methods()[-2:], ['editMessageCaption', 'deleteMessage'])
+        self.assertIn('Hobert', [request for request in self.api.requests if request.method == 'editMessageCaption'][0].params['caption'])
+
+    async def test_resend_navigation_deletes_and_sends(self):
+        application = bot.create_application(FAKE_TOKEN, self.api.base_url, self.store, navigation=bot.NAVIGATION_RESEND)
+        await application.initialize()
+
+        await application.process_update(Update.de_json(self._create_start_update_dict(), application.bot))
+        await application.process_update(Update.de_json(self._create_button_update(self._get_button_data()).to_dict(), application.bot))
+
+        await application.shutdown()
+        self.assertEqual(self.api.get_methods()[-2:], ['deleteMessage', 'sendPhoto'])
+
+    async def test_failed_delete_does_not_stop_page_turn(self):
+        application = bot.create_application(FAKE_TOKEN, self.api.base_url, self.store, navigation=bot.NAVIGATION_RESEND)
+        await application.initialize()
+        self.api.failing_methods.add('deleteMessage')
+
+        await application.process_update(Update.de_json(self._create_start_update_dict(), application.bot))
+        started = self.store.load(1)
+        await application.process_update(Update.de_json(self._create_button_update(self._get_button_data()).to_dict(), application.bot))
+
+        await application.shutdown()
+        self.assertEqual(self.api.get_methods()[-2:], ['deleteMessage', 'sendPhoto'])
+        # Page turn is saved
+        self.assertNotEqual(self.store.load(1), started)
+
+    async def test_button_uses_prefetched_frame(self):
+        application = bot.create_application(FAKE_TOKEN, self.api.base_url, self.store, prefetch=True)
+        await application.initialize()
+        prefetcher: Prefetcher = application.bot_data[bot.PREFETCHER]
+
+        await application.process_update(Update.de_json(self._create_start_update_dict(), application.bot))
+        await prefetcher.join()
+        await application.process_update(Update.de_json(self._create_button_update(self._get_button_data()).to_dict(), application.bot))
+
+        await application.shutdown()
+        await application.post_shutdown(application)
+        self.assertEqual(prefetcher.used, 1)
+        self.assertIn('Once upon a time', self.api.requests[-1].params['caption'])
+
+    async def test_stale_button_is_rejected(self):
+        await self.application.process_update(self._create_start_update())
+        await self.application.process_update(self._create_button_update('1'))
+        await self.application.bot_data[bot.SCHEDULER].stop()
+
+        self.assertEqual(self.api.get_methods()[-1], 'answerCallbackQuery')
+        self.assertEqual(self.api.requests[-1].params['text'], bot.STALE_BUTTON_TEXT)
+
+    async def test_recorded_updates_replay_to_same_messages(self):
+        directory = tempfile.TemporaryDirectory()
+        log_path = os.path.join(directory.name, 'updates.log')
+        application = bot.create_application(FAKE_TOKEN, self.api.base_url, self.store, record_updates=log_path)
+        await application.initialize()
+
+        await application.process_update(Update.de_json(self._create_start_update_dict(), application.bot))
+        await application.process_update(Update.de_json(self._create_button_update(self._get_button_data()).to_dict(), application.bot))
+        await application.shutdown()
+        await application.post_shutdown(application)
+        with open(log_path, 'a') as f:
+            f.write('[1.0,{"update_id"')
+        results, api = await replay.replay(read_updates([log_path]), bot.DEFAULT_STORIES, FAKE_TOKEN)
+
+        directory.cleanup()
+        self.assertEqual((results['updates'], results['stale_buttons']), (2, 0))
+        self.assertEqual(replay.compare_messages(replay.get_messages(api), replay.get_messages(self.api)), [])
+        self.assertEqual(len(replay.get_messages(api)), 2)
+
+    async def test_other_chats_are_served_while_story_is_compiled(self):
+        registry = StoryRegistry(['SPACE_FROG.json'], 2)
+        application = bot.create_application(FAKE_TOKEN, self.api.base_url, self.store, registry)
+        await application.initialize()
+
+        # As if another reader's click was compiling the story
+        with registry._loading.setdefault(registry.default_story_id, threading.Lock()):
+            started = asyncio.create_task(application.process_update(Update.de_json(self._create_start_update_dict(), application.bot)))
+            await asyncio.sleep(0.05)
+            self.assertFalse(started.done())
+        await started
+
+        await application.shutdown()
+        self.assertEqual(self.api.get_methods()[-1], 'sendMessage')
+
+    async def test_broken_story_is_reported_to_reader(self):
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, 'broken.json')
+        display = {MACROS_NAME: MACRO_DISPLAY, MACROS_VALUE: 'missing', MACROS_ORIGINAL_TEXT: '(display:"missing")'}
+        with open(path, 'w') as f:
+            json.dump(dict(OTHER_STORY, passages=[benchmark._create_passage('1', 'start', '(display:"missing")', [], [], [display])]), f)
+        application = bot.create_application(FAKE_TOKEN, self.api.base_url, self.store, StoryRegistry([path], 1))
+        await application.initialize()
+
+        with self.assertLogs('story_registry', 'ERROR'):
+            await application.process_update(Update.de_json(self._create_start_update_dict(), application.bot))
+
+        await application.shutdown()
+        directory.cleanup()
+        self.assertEqual(self.api.requests[-1].params['text'], bot.BROKEN_STORY_TEXT)
+
+    async def test_start_offers_catalogue_of_stories(self):
+        directory = tempfile.TemporaryDirectory()
+        other_path = os.path.join(directory.name, 'other.json')
+        with open(other_path, 'w') as f:
+            json.dump(OTHER_STORY, f)
+        application = bot.create_application(FAKE_TOKEN, self.api.base_url, self.store, StoryRegistry(['SPACE_FROG.json', other_path], 2))
+        await application.initialize()
+
+        await application.process_update(Update.de_json(self._create_start_update_dict(), application.bot))
+        keyboard = json.loads(self.api.requests[-1].params['reply_markup'])['inline_keyboard']
+        await application.process_update(Update.de_json(self._create_button_update(keyboard[1][0]['callback_data']).to_dict(), application.bot))
+
+        await application.shutdown()
+        directory.cleanup()
+        self.assertEqual([row[0]['text'] for row in keyboard], [SPACE_FROG[STORY_NAME], 'Other'])
+        self.assertIn('Other story', self.api.requests[-1].params['text'])
+
+    async def test_unknown_story_of_catalogue_is_stale(self):
+        directory = tempfile.TemporaryDirectory()
+        other_path = os.path.join(directory.name, 'a' * 100 + '.json')
+        with open(other_path, 'w') as f:
+            json.dump(dict(OTHER_STORY, uuid=None), f)
+        application = bot.create_application(FAKE_TOKEN, self.api.base_url, self.store, StoryRegistry(['SPACE_FROG.json', other_path], 2))
+        await application.initialize()
+
+        await application.process_update(Update.de_json(self._create_start_update_dict(), application.bot))
+        keyboard = json.loads(self.api.requests[-1].params['reply_markup'])['inline_keyboard']
+        await application.process_update(Update.de_json(self._create_button_update(bot.STORY_CALLBACK_PREFIX + 'removed').to_dict(), application.bot))
+        await application.bot_data[bot.SCHEDULER].stop()
+
+        await application.shutdown()
+        directory.cleanup()
+        self.assertLessEqual(max(len(row[0]['callback_data'].encode('utf-8')) for row in keyboard), 64)
+        self.assertEqual(self.api.requests[-1].params['text'], bot.STALE_BUTTON_TEXT)
+
+    async def test_metrics_are_served(self):
+        application = bot.create_application(FAKE_TOKEN, self.api.base_url, self.store, metrics_port=0)
+        await application.initialize()
+        await application.post_init(application)
+
+        await application.process_update(Update.de_json(self._create_start_update_dict(), application.bot))
+        port = application.bot_data[bot.METRICS_SERVER].port
+        response = await asyncio.to_thread(urllib.request.urlopen, f'http://127.0.0.1:{port}/metrics')
+        text = response.read().decode('utf-8')
+
+        await application.shutdown()
+        await application.post_shutdown(application)
+        self.assertIn('twinecoil_stage_seconds_count{stage="start"} 1', text)
+        self.assertIn('twinecoil_stage_seconds_count{stage="send"} 1', text)
+        self.assertIn('twinecoil_render_cache_misses_total 1', text)
+
+    async def test_webhook_update_is_handled(self):
+        await self.application.start()
+        server = WebhookServer(self.application.update_queue, self.application.bot)
+        await server.start('127.0.0.1', 0)
+
+        status = await self._post(server.port, self._create_start_update_dict())
+        for _ in range(100):
+            if 'sendMessage' in self.api.get_methods():
+                break
+            await asyncio.sleep(0.01)
+
+        await server.stop()
+        await self.application.stop()
+        self.assertEqual(status, 200)
+        self.assertIn('sendMessage', self.api.get_methods())
+
+    async def test_webhook_pushes_back_when_queue_is_full(self):
+        server = WebhookServer(asyncio.Queue(1), self.application.bot)
+        await server.start('127.0.0.1', 0)
+
+        status = await self._post(server.port, [self._create_start_update_dict(1), self._create_start_update_dict(2)])
+
+        await server.stop()
+        self.assertEqual(status, 503)
+
+    async def test_webhook_rejects_batch_with_broken_update(self):
+        queue = asyncio.Queue(10)
+        server = WebhookServer(queue, self.application.bot)
+        await server.start('127.0.0.1', 0)
+
+        status = await self._post(server.port, [self._create_start_update_dict(1), 5])
+
+        await server.stop()
+        self.assertEqual((status, queue.qsize()), (400, 0))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
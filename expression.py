@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import re
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+# Value of a variable that was never set, as in Harlowe 3
+DEFAULT_VALUE = 0
+
+TOKEN_PATTERN = re.compile(r'''\s*(?:(?P<number>\d+(?:\.\d+)?)|(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|(?P<variable>\$\w+)|(?P<word>[A-Za-z_]\w*)|(?P<operator><=|>=|[-+*/%<>(),]))''')
+MACRO_SOURCE_PATTERN = re.compile(r'^\(\s*[\w-]+\s*:(.*)\)$', re.DOTALL)
+
+class ExpressionError(ValueError):
+    """
+    Expression can't be compiled, or its values don't fit its operators when it is evaluated.
+    """
+
+@dataclass(frozen=True)
+class Expression:
+    """
+    Compiled Harlowe expression. `evaluate` takes reader variables and never changes them,
+    `variable_names` are the variables it reads.
+    """
+    source: str
+    evaluate: Callable[[dict], object]
+    variable_names: frozenset
+
+def get_macro_source(original: str, value: str) -> str:
+    """
+    Returns macro arguments as written. GTwine drops quotes from the value, so original text is preferred.
+    """
+    match = MACRO_SOURCE_PATTERN.match(original or '')
+    if match == None:
+        return value
+    return match.group(1).strip()
+
+def compile_expression(source: str) -> Expression:
+    parser = _Parser(source)
+    evaluate = parser.parse_expression()
+    parser.expect_end()
+    return Expression(source, evaluate, frozenset(parser.variable_names))
+
+def compile_assignments(source: str, is_put: bool = False) -> Tuple[Tuple[str, Expression], ...]:
+    """
+    Compiles `$name to value` pairs of (set:), or `value into $name` pairs of (put:), separated by commas.
+    """
+    parser = _Parser(source)
+    assignments = []
+    while True:
+        start = parser.get_position()
+        if is_put:
+            evaluate = parser.parse_expression()
+            end = parser.get_position()
+            parser.expect('into')
+            variable = parser.expect_variable()
+        else:
+            variable = parser.expect_variable()
+            parser.expect('to')
+            start = parser.get_position()
+            evaluate = parser.parse_expression()
+            end = parser.get_position()
+        assignments.append((variable, Expression(source[start:end].strip(), evaluate, frozenset(parser.variable_names))))
+        parser.variable_names.clear()
+        if not parser.accept(','):
+            break
+    parser.expect_end()
+    return tuple(assignments)
+
+def to_text(value) -> str:
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if type(value) is float and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def is_true(value) -> bool:
+    if type(value) is not bool:
+        raise ExpressionError(f'{to_text(value)} is not a boolean')
+    return value
+
+def _is_number(value) -> bool:
+    return type(value) is int or type(value) is float
+
+def _equals(left, right) -> bool:
+    # Python counts True as 1, Harlowe doesn't
+    return (type(left) is bool) == (type(right) is bool) and left == right
+
+def _add(left, right):
+    if (_is_number(left) and _is_number(right)) or (type(left) is str and type(right) is str):
+        return left + right
+    raise ExpressionError(f"Can't add {to_text(right)} to {to_text(left)}")
+
+def _arithmetic(operation: Callable) -> Callable:
+    def calculate(left, right):
+        if not _is_number(left) or not _is_number(right):
+            raise ExpressionError(f'{to_text(left)} and {to_text(right)} must be numbers')
+        try:
+            return operation(left, right)
+        except ZeroDivisionError:
+            raise ExpressionError("Can't divide by zero")
+    return calculate
+
+def _contains(container, item) -> bool:
+    if type(container) is str:
+        if type(item) is not str:
+            raise ExpressionError(f'Text can only contain text, not {to_text(item)}')
+        return item in container
+    if type(container) in (list, tuple):
+        return any(_equals(element, item) for element in container)
+    raise ExpressionError(f"{to_text(container)} can't contain anything")
+
+BINARY_OPERATORS = {
+    '+': _add,
+    '-': _arithmetic(lambda left, right: left - right),
+    '*': _arithmetic(lambda left, right: left * right),
+    '/': _arithmetic(lambda left, right: left / right),
+    '%': _arithmetic(lambda left, right: left % right),
+    '<': _arithmetic(lambda left, right: left < right),
+    '>': _arithmetic(lambda left, right: left > right),
+    '<=': _arithmetic(lambda left, right: left <= right),
+    '>=': _arithmetic(lambda left, right: left >= right),
+    'is': _equals,
+    'is not': lambda left, right: not _equals(left, right),
+    'contains': _contains,
+    'is in': lambda left, right: _contains(right, left),
+    'is not in': lambda left, right: not _contains(right, left),
+}
+# Longest operators first: "is not in" before "is not" before "is"
+COMPARISON_OPERATORS = ('is not in', 'is not', 'is in', 'contains', '<=', '>=', 'is', '<', '>')
+CONSTANTS = {'true': True, 'false': False}
+
+class _Parser:
+    """
+    Recursive descent parser turning expression tokens into nested closures, so evaluation
+    doesn't look at the source again.
+    """
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.tokens: List[Tuple[str, str, int, int]] = []
+        self.index = 0
+        self.variable_names = set()
+        position = 0
+        while position < len(source):
+            match = TOKEN_PATTERN.match(source, position)
+            if match == None or match.end() == position:
+                if source[position:].strip() == '':
+                    break
+                raise ExpressionError(f'Unexpected "{source[position:].strip()}" in "{source}"')
+            kind = match.lastgroup
+            self.tokens.append((kind, match.group(kind), match.start(kind), match.end()))
+            position = match.end()
+
+    def get_position(self) -> int:
+        if self.index < len(self.tokens):
+            return self.tokens[self.index][2]
+        return len(self.source)
+
+    def peek(self, offset: int = 0) -> Optional[str]:
+        if self.index + offset < len(self.tokens):
+            kind, text, _, _ = self.tokens[self.index + offset]
+            return text if kind in ('word', 'operator') else None
+        return None
+
+    def accept(self, text: str) -> bool:
+        if self.peek() == text:
+            self.index += 1
+            return True
+        return False
+
+    def expect(self, text: str) -> None:
+        if not self.accept(text):
+            raise ExpressionError(f'Expected "{text}" in "{self.source}"')
+
+    def expect_variable(self) -> str:
+        if self.index < len(self.tokens) and self.tokens[self.index][0] == 'variable':
+            self.index += 1
+            return self.tokens[self.index - 1][1]
+        raise ExpressionError(f'Expected variable in "{self.source}"')
+
+    def expect_end(self) -> None:
+        if self.index < len(self.tokens):
+            raise ExpressionError(f'Unexpected "{self.tokens[self.index][1]}" in "{self.source}"')
+
+    def parse_expression(self) -> Callable:
+        return self._parse_or()
+
+    def _parse_or(self) -> Callable:
+        left = self._parse_and()
+        while self.accept('or'):
+            left = self._combine_logical(left, self._parse_and(), is_and=False)
+        return left
+
+    def _parse_and(self) -> Callable:
+        left = self._parse_not()
+        while self.accept('and'):
+            left = self._combine_logical(left, self._parse_not(), is_and=True)
+        return left
+
+    def _combine_logical(self, left: Callable, right: Callable, is_and: bool) -> Callable:
+        if is_and:
+            return lambda variables: is_true(left(variables)) and is_true(right(variables))
+        return lambda variables: is_true(left(variables)) or is_true(right(variables))
+
+    def _parse_not(self) -> Callable:
+        if self.accept('not'):
+            operand = self._parse_not()
+            return lambda variables: not is_true(operand(variables))
+        return self._parse_comparison()
+
+    def _parse_comparison(self) -> Callable:
+        left = self._parse_additive()
+        while True:
+            operator = self._accept_comparison()
+            if operator == None:
+                return left
+            left = self._combine(left, operator, self._parse_additive())
+
+    def _accept_comparison(self) -> Optional[str]:
+        for operator in COMPARISON_OPERATORS:
+            words = operator.split(' ')
+            if all(self.peek(offset) == word for offset, word in enumerate(words)):
+                self.index += len(words)
+                return operator
+        return None
+
+    def _parse_additive(self) -> Callable:
+        left = self._parse_multiplicative()
+        while self.peek() in ('+', '-'):
+            operator = self.peek()
+            self.index += 1
+            left = self._combine(left, operator, self._parse_multiplicative())
+        return left
+
+    def _parse_multiplicative(self) -> Callable:
+        left = self._parse_unary()
+        while self.peek() in ('*', '/', '%'):
+            operator = self.peek()
+            self.index += 1
+            left = self._combine(left, operator, self._parse_unary())
+        return left
+
+    def _parse_unary(self) -> Callable:
+        if self.accept('-'):
+            operand = self._parse_unary()
+            negate = BINARY_OPERATORS['-']
+            return lambda variables: negate(0, operand(variables))
+        return self._parse_primary()
+
+    def _parse_primary(self) -> Callable:
+        if self.index >= len(self.tokens):
+            raise ExpressionError(f'Expression "{self.source}" ends too early')
+        kind, text, _, _ = self.tokens[self.index]
+        self.index += 1
+        if kind == 'number':
+            value = float(text) if '.' in text else int(text)
+            return lambda variables: value
+        if kind == 'string':
+            value = re.sub(r'\\(.)', r'\1', text[1:-1])
+            return lambda variables: value
+        if kind == 'variable':
+            self.variable_names.add(text)
+            return lambda variables: variables.get(text, DEFAULT_VALUE)
+        if kind == 'word' and text in CONSTANTS:
+            value = CONSTANTS[text]
+            return lambda variables: value
+        if text == '(':
+            inner = self.parse_expression()
+            self.expect(')')
+            return inner
+        raise ExpressionError(f'Unexpected "{text}" in "{self.source}"')
+
+    def _combine(self, left: Callable, operator: str, right: Callable) -> Callable:
+        operation = BINARY_OPERATORS[operator]
+        return lambda variables: operation(left(variables), right(variables))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import email.parser
+import email.policy
+import json
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+from urllib.parse import parse_qsl
+
+from telegram.request import BaseRequest, RequestData
+
+FAKE_BOT_USERNAME = 'fake_bot'
+
+FLOOD_METHODS = ('sendMessage', 'sendPhoto', 'editMessageText', 'editMessageCaption', 'editMessageMedia')
+FLOOD_RETRY_AFTER = 1
+
+@dataclass
+class ApiRequest:
+    method: str
+    params: dict
+    time: float
+
+class ApiError(Exception):
+
+    def __init__(self, error_code: int, description: str, parameters: dict = None) -> None:
+        self.error_code = error_code
+        self.description = description
+        self.parameters = parameters
+
+class FakeBotApi:
+    """
+    Minimal local Telegram Bot API server, so the bot can be run and tested offline.
+    Every call is recorded in `requests`, updates added with `add_update` are served by getUpdates.
+    When `flood_interval` is set, messages to one chat coming closer than that in seconds
+    are refused with 429 like Telegram does, they are counted in `flood_errors`.
+    Calls of methods in `failing_methods` are refused with 400.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0) -> None:
+        self.requests: List[ApiRequest] = []
+        self.updates = []
+        self.response_delay = 0
+        self.flood_interval = 0
+        self.flood_errors = 0
+        self.failing_methods = set()
+        self._last_message_times = {}
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._create_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_update(self, update: dict) -> None:
+        with self._lock:
+            self.updates.append(update)
+
+    def get_methods(self) -> List[str]:
+        with self._lock:
+            return [request.method for request in self.requests]
+
+    def handle(self, method: str, params: dict):
+        now = time.monotonic()
+        with self._lock:
+            self.requests.append(ApiRequest(method, params, now))
+            if method in FLOOD_METHODS and self.flood_interval > 0:
+                chat_id = str(params.get('chat_id'))
+                last_time = self._last_message_times.get(chat_id)
+                if last_time != None and now - last_time < self.flood_interval:
+                    self.flood_errors += 1
+                    raise ApiError(429, f'Too Many Requests: retry after {FLOOD_RETRY_AFTER}', {'retry_after': FLOOD_RETRY_AFTER})
+                self._last_message_times[chat_id] = now
+        if method in self.failing_methods:
+            raise ApiError(400, f'Bad Request: {method} failed')
+        if self.response_delay > 0:
+            time.sleep(self.response_delay)
+
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': FAKE_BOT_USERNAME}
+        if method == 'getUpdates':
+            return self._get_updates(int(params.get('offset', 0)))
+        if method in ('sendMessage', 'sendPhoto', 'editMessageText', 'editMessageCaption', 'editMessageMedia'):
+            return self._create_message(method, params)
+        return True
+
+    def respond(self, method: str, params: dict) -> Tuple[int, bytes]:
+        """
+        Returns HTTP status and body of Bot API response to the call.
+        """
+        try:
+            status = 200
+            response = {'ok': True, 'result': self.handle(method, params)}
+        except ApiError as error:
+            status = error.error_code
+            response = {'ok': False, 'error_code': error.error_code, 'description': error.description}
+            if error.parameters != None:
+                response['parameters'] = error.parameters
+        return status, json.dumps(response).encode('utf-8')
+
+    def _get_updates(self, offset: int) -> list:
+        with self._lock:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            return list(self.updates)
+
+    def _create_message(self, method: str, params: dict) -> dict:
+        with self._lock:
+            self._message_id += 1
+            message_id = params.get('message_id', self._message_id)
+        message = {'message_id': int(message_id), 'date': int(time.time()), 'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}}
+        if method == 'sendMessage' or method == 'editMessageText':
+            message['text'] = params.get('text', '')
+        else:
+            message['caption'] = params.get('caption', '')
+            message['photo'] = [{'file_id': f'photo_{message_id}', 'file_unique_id': f'unique_{message_id}', 'width': 100, 'height': 100}]
+        return message
+
+    def _create_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                self._respond()
+
+            def do_GET(self):
+                self._respond()
+
+            def _respond(self):
+                method = self.path.rstrip('/').split('/')[-1]
+                status, body = api.respond(method, self._read_params())
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_params(self) -> dict:
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length > 0 else b''
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('multipart/form-data'):
+                    return self._read_multipart(content_type, body)
+                if content_type.startswith('application/json'):
+                    return json.loads(body or b'{}')
+                return dict(parse_qsl(body.decode('utf-8')))
+
+            def _read_multipart(self, content_type: str, body: bytes) -> dict:
+                message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                    f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8') + body)
+                params = {}
+                for part in message.iter_parts():
+                    payload = part.get_payload(decode=True)
+                    if part.get_filename() == None:
+                        payload = payload.decode('utf-8')
+                    params[part.get_param('name', header='content-disposition')] = payload
+                return params
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+class FakeBotRequest(BaseRequest):
+    """
+    Calls `FakeBotApi` right in this process, without HTTP and without starting its server,
+    e.g. to replay recorded updates at full speed. Parameters look as the server would get them.
+    """
+
+    def __init__(self, api: FakeBotApi) -> None:
+        self.api = api
+
+    @property
+    def read_timeout(self) -> None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: RequestData = None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        params = {}
+        if request_data != None:
+            params.update(request_data.json_parameters)
+            for name, (_, content, _) in request_data.multipart_data.items():
+                params[name] = content
+        return self.api.respond(url.rstrip('/').split('/')[-1], params)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import json
+import logging
+import os
+from os.path import exists
+from typing import Union
+from story_file import ImageBlob
+
+logger = logging.getLogger(__name__)
+
+class ImageCache:
+    """
+    Keeps passage images decoded once and remembers Telegram `file_id` of already uploaded ones.
+    Images are identified by hash of their content, so same picture used by several passages
+    is uploaded only once. If `file_path` is given, known file ids survive bot restarts,
+    every process writing file ids needs a file of its own.
+    Images are base64 strings of JSON stories or `ImageBlob` of compiled ones.
+    """
+
+    def __init__(self, file_path: str = None) -> None:
+        self.file_path = file_path
+        self.file_ids = {}
+        self._hashes = {}
+        self._bytes = {}
+        if file_path != None and exists(file_path):
+            try:
+                with open(file_path) as f:
+                    self.file_ids = json.load(f)
+            except ValueError:
+                # Images are uploaded again, file ids are only a shortcut
+                logger.warning('Image cache %s is broken, it is started over', file_path)
+
+    def get_photo(self, image: Union[str, ImageBlob]) -> Union[str, bytes]:
+        """
+        Returns `file_id` if image was uploaded before, otherwise decoded image bytes.
+        """
+        image_hash = self.get_hash(image)
+        file_id = self.file_ids.get(image_hash)
+        if file_id != None:
+            return file_id
+
+        if isinstance(image, ImageBlob):
+            # Mapped file already holds the bytes, they are copied only for the upload
+            return bytes(image.data)
+        image_bytes = self._bytes.get(image_hash)
+        if image_bytes == None:
+            image_bytes = base64.b64decode(image.encode('ascii'))
+            self._bytes[image_hash] = image_bytes
+        return image_bytes
+
+    def save_file_id(self, image: Union[str, ImageBlob], file_id: str) -> None:
+        image_hash = self.get_hash(image)
+        if self.file_ids.get(image_hash) == file_id:
+            return
+        self.file_ids[image_hash] = file_id
+        # Bytes are not needed anymore, Telegram has them
+        self._bytes.pop(image_hash, None)
+        if self.file_path != None:
+            # Crash while writing must not leave a half written file
+            with open(self.file_path + '.tmp', 'w') as f:
+                json.dump(self.file_ids, f)
+            os.replace(self.file_path + '.tmp', self.file_path)
+
+    def get_hash(self, image: Union[str, ImageBlob]) -> str:
+        if isinstance(image, ImageBlob):
+            return image.hash
+        # Base64 strings come from the shared story, so string lookup is cheap after the first one
+        image_hash = self._hashes.get(image)
+        if image_hash == None:
+            image_hash = hashlib.sha256(image.encode('ascii')).hexdigest()
+            self._hashes[image] = image_hash
+        return image_hash
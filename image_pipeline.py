@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+try:
+    from PIL import Image
+except ImportError:
+    # Images are stored as the author made them
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Telegram keeps photos up to 1280 pixels on the longest side, bigger ones are scaled down by it anyway
+MAX_PHOTO_SIDE = 1280
+JPEG_QUALITY = 85
+# Background of transparent images, JPEG has no transparency
+BACKGROUND_COLOR = (255, 255, 255)
+
+def is_available() -> bool:
+    return Image != None
+
+def optimize_image(data: bytes, max_side: int = MAX_PHOTO_SIDE, quality: int = JPEG_QUALITY) -> bytes:
+    """
+    Scales image down to `max_side` and recompresses it as JPEG. Returns the original when it is
+    smaller than the result, e.g. a tiny PNG, or when the image can't be read.
+    """
+    if Image == None:
+        return data
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.thumbnail((max_side, max_side))
+            if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, BACKGROUND_COLOR)
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality=quality, optimize=True, progressive=True)
+    except (OSError, ValueError) as error:
+        logger.warning('Image is kept as it is: %s', error)
+        return data
+    optimized = output.getvalue()
+    return optimized if len(optimized) < len(data) else data
+
+class ImagePipeline:
+    """
+    Optimizes images of a story once, when the story is compiled. Equal images are processed once,
+    results are kept in `cache_directory` by hash of the original, so compiling again skips the work.
+    Images are processed by `workers` processes, in this process when it is 1.
+    Without Pillow images are returned as they are.
+    """
+
+    def __init__(self, cache_directory: Optional[str] = None, workers: int = 1, max_side: int = MAX_PHOTO_SIDE,
+                 quality: int = JPEG_QUALITY) -> None:
+        self.cache_directory = cache_directory
+        self.workers = workers
+        self.max_side = max_side
+        self.quality = quality
+        self.cache_hits = 0
+        self.processed = 0
+        if cache_directory != None:
+            os.makedirs(cache_directory, exist_ok=True)
+
+    def process(self, images: List[bytes]) -> List[bytes]:
+        if Image == None:
+            return list(images)
+        results = {}
+        missing = {}
+        for data in images:
+            image_hash = hashlib.sha256(data).hexdigest()
+            if image_hash in results or image_hash in missing:
+                continue
+            cached = self._read_cache(image_hash)
+            if cached != None:
+                results[image_hash] = cached
+                self.cache_hits += 1
+            else:
+                missing[image_hash] = data
+
+        hashes = list(missing)
+        sources = [missing[image_hash] for image_hash in hashes]
+        if self.workers == 1 or len(sources) <= 1:
+            optimized = [optimize_image(data, self.max_side, self.quality) for data in sources]
+        else:
+            with ProcessPoolExecutor(self.workers) as executor:
+                optimized = list(executor.map(optimize_image, sources, [self.max_side] * len(sources), [self.quality] * len(sources)))
+        for image_hash, data in zip(hashes, optimized):
+            results[image_hash] = data
+            self._write_cache(image_hash, data)
+        self.processed += len(sources)
+        return [results[hashlib.sha256(data).hexdigest()] for data in images]
+
+    def _get_cache_path(self, image_hash: str) -> str:
+        # Other settings make other images
+        return os.path.join(self.cache_directory, f'{image_hash}-{self.max_side}-{self.quality}')
+
+    def _read_cache(self, image_hash: str) -> Optional[bytes]:
+        if self.cache_directory == None:
+            return None
+        try:
+            with open(self._get_cache_path(image_hash), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_cache(self, image_hash: str, data: bytes) -> None:
+        if self.cache_directory == None:
+            return
+        path = self._get_cache_path(image_hash)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import hmac
+import struct
+import zlib
+from typing import Dict, Iterable, Optional, Tuple
+from telegram import helpers
+from passage import Passage
+
+LINK_VERSION = 2
+# Bytes of HMAC kept in a token
+TAG_SIZE = 6
+# Version, passage number
+BUTTON_FORMAT = '<BH'
+# Version, passage number, macro number
+REVEAL_FORMAT = '<BHH'
+# Version, position of the story in the catalogue
+STORY_FORMAT = '<BH'
+# Links of stories compiled without a key are still bound to the story, but anyone can make them
+DEFAULT_LINK_SECRET = b''
+
+def get_link_secret(token: str) -> bytes:
+    """
+    Key signing links of the bot, the same in every worker and after restarts.
+    """
+    return hashlib.sha256(b'twinecoil-links:' + token.encode('utf-8')).digest()
+
+class LinkCodec:
+    """
+    Tokens of buttons and link-reveal deeplinks of one compiled story. A token is URL safe base64 of
+    a version tag, numbers of the passage and macro, and a truncated HMAC of them together with story id,
+    passage id and macro text. Every token is made when the story is compiled, so decoding is a dict
+    lookup: tokens of other stories, of removed passages and forged ones are not found.
+    The passage number comes from the passage id rather than its position in the file, so a passage
+    keeps its tokens in every version of the story and buttons already sent work after a reload.
+    Passages with equal numbers are told apart by the HMAC.
+    """
+
+    def __init__(self, story_id: str, passages: Iterable[Passage], secret: bytes = DEFAULT_LINK_SECRET) -> None:
+        self.button_data: Dict[str, str] = {}
+        self.reveal_payloads: Dict[Tuple[str, int], str] = {}
+        self._passage_names: Dict[str, str] = {}
+        self._reveals: Dict[str, Tuple[str, int]] = {}
+        self._reveal_urls: Dict[str, Dict[Tuple[str, int], str]] = {}
+        for passage in passages:
+            number = zlib.crc32(str(passage.id).encode('utf-8')) & 0xFFFF
+            scope = f'{story_id}\0{passage.id}'.encode('utf-8')
+            if passage.name != None:
+                data = _sign(secret, scope, struct.pack(BUTTON_FORMAT, LINK_VERSION, number))
+                self.button_data[passage.name] = data
+                self._passage_names[data] = passage.name
+            for macro in passage.link_reveal_macros:
+                payload = _sign(secret, scope + f'\0{macro.value}'.encode('utf-8'), struct.pack(REVEAL_FORMAT, LINK_VERSION, number, macro.index))
+                self.reveal_payloads[(passage.id, macro.index)] = payload
+                self._reveals[payload] = (passage.id, macro.index)
+
+    def get_passage_name(self, data: str) -> Optional[str]:
+        """
+        Returns name of the passage a button leads to, None for unknown buttons.
+        """
+        return self._passage_names.get(data)
+
+    def get_reveal(self, payload: str) -> Optional[Tuple[str, int]]:
+        """
+        Returns passage id and macro number revealed by a deeplink, None for unknown links.
+        """
+        return self._reveals.get(payload)
+
+    def get_reveal_urls(self, username: str) -> Dict[Tuple[str, int], str]:
+        """
+        Deeplinks of every link-reveal macro by passage id and macro number, made once per bot.
+        """
+        urls = self._reveal_urls.get(username)
+        if urls == None:
+            urls = {key: helpers.create_deep_linked_url(username, payload) for key, payload in self.reveal_payloads.items()}
+            self._reveal_urls[username] = urls
+        return urls
+
+def sign_story(story_id: str, index: int, secret: bytes = DEFAULT_LINK_SECRET) -> str:
+    """
+    Token of the catalogue button choosing the story at `index`, short whatever the length of the story id.
+    """
+    return _sign(secret, f'story\0{story_id}'.encode('utf-8'), struct.pack(STORY_FORMAT, LINK_VERSION, index))
+
+def _sign(secret: bytes, scope: bytes, packed: bytes) -> str:
+    tag = hmac.new(secret, scope + packed, hashlib.sha256).digest()[:TAG_SIZE]
+    return base64.urlsafe_b64encode(packed + tag).rstrip(b'=').decode('ascii')
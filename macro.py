@@ -6,4 +6,8 @@ MACROS_ATTACHED_HOOK = 'attachedHook'
 MACRO_DISPLAY = 'display'
 MACRO_LINK_REVEAL = 'link-reveal'
 MACRO_SHOW = 'show'
-MACRO_SET = 'set'
\ No newline at end of file
+MACRO_SET = 'set'
+MACRO_PUT = 'put'
+MACRO_IF = 'if'
+MACRO_ELSE_IF = 'else-if'
+MACRO_ELSE = 'else'
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+from macro import *
+from expression import *
+
+ORIGINAL_TEXT = 'original'
+
+HOOK_NAME = 'hookName'
+HOOK_ORIGINAL_TEXT = ORIGINAL_TEXT
+HOOK_TEXT = 'hookText'
+HOOK_IS_HIDDEN = 'isHidden'
+HOOK_LINKS = 'links'
+HOOK_HOOKS = 'hooks'
+HOOK_MACROS = 'macros'
+HOOK_IMAGES = 'image'
+
+# Macros the renderer understands, others are shown as they were written
+KNOWN_MACROS = (MACRO_DISPLAY, MACRO_LINK_REVEAL, MACRO_SHOW, MACRO_SET, MACRO_PUT, MACRO_IF, MACRO_ELSE_IF, MACRO_ELSE)
+# Macros which take effect even when their text is not found in the hook or passage
+EFFECT_MACROS = (MACRO_SHOW, MACRO_SET, MACRO_PUT)
+CONDITIONAL_MACROS = (MACRO_IF, MACRO_ELSE_IF, MACRO_ELSE)
+# Macros added after sessions started saving revealed macro numbers, they take no number
+UNNUMBERED_MACROS = (MACRO_PUT,) + CONDITIONAL_MACROS
+
+VARIABLE_PATTERN = re.compile(r'\$\w+')
+
+@dataclass(frozen=True)
+class TextNode:
+    text: str
+
+@dataclass(frozen=True)
+class VariableNode:
+    name: str
+
+@dataclass(frozen=True)
+class HookNode:
+    name: Optional[str]
+    is_hidden: bool
+    nodes: tuple
+
+@dataclass(frozen=True)
+class MacroNode:
+    index: int
+    name: str
+    value: str
+    hook: Optional[HookNode] = None
+
+@dataclass(frozen=True)
+class AssignmentNode:
+    """
+    (set:) or (put:), pairs of variable name and compiled value.
+    """
+    assignments: Tuple[Tuple[str, Expression], ...]
+
+@dataclass(frozen=True)
+class ConditionalNode:
+    """
+    (if:), (else-if:) or (else:) with the hook right after it. `condition` is None for (else:).
+    """
+    name: str
+    condition: Optional[Expression]
+    hook: Optional[HookNode]
+
+class MarkupParser:
+    """
+    Turns passage text into a tuple of nodes using "original" texts of links, images, hooks and macros
+    found by GTwine. Links and images are dropped, everything else becomes a node, so rendering
+    is one walk over the nodes instead of text replacements.
+    Macros are numbered in order of appearance, the number identifies macro inside the passage.
+    Expressions of (set:), (put:) and (if:) are compiled here, ones that can't be compiled
+    are described in `errors`.
+    """
+
+    def __init__(self) -> None:
+        self.macro_count = 0
+        self.errors = []
+
+    def parse(self, text: str, removed: List[str], hooks: List[dict], macros: List[dict]) -> tuple:
+        """
+        `removed` are original texts of links and images, they are cut out of the text.
+        """
+        macros = [macro for macro in macros if macro[MACROS_NAME] in KNOWN_MACROS]
+        spans = []
+        for original in removed:
+            self._add_spans(spans, text, original, None)
+        for macro in macros:
+            # Hook attached to a macro is rendered by the macro
+            attached_hook = macro.get(MACROS_ATTACHED_HOOK)
+            if attached_hook != None:
+                self._add_spans(spans, text, attached_hook[HOOK_ORIGINAL_TEXT], None)
+        for hook in hooks:
+            self._add_spans(spans, text, hook[HOOK_ORIGINAL_TEXT], hook)
+        not_found = []
+        for macro in macros:
+            if not self._add_spans(spans, text, macro[MACROS_ORIGINAL_TEXT], macro) and macro[MACROS_NAME] in EFFECT_MACROS:
+                not_found.append(macro)
+
+        # Outer element wins when elements overlap, inner ones are parsed with it
+        spans.sort(key=lambda span: (span[0], span[0] - span[1]))
+        nodes = []
+        position = 0
+        for start, end, element in spans:
+            if start < position:
+                continue
+            self._add_text(nodes, text[position:start])
+            if element != None:
+                nodes.append(self._parse_element(element, removed))
+            position = end
+        self._add_text(nodes, text[position:])
+        for macro in not_found:
+            nodes.append(self._parse_element(macro, removed))
+        return self._attach_conditional_hooks(nodes)
+
+    def _attach_conditional_hooks(self, nodes: list) -> tuple:
+        attached = []
+        for node in nodes:
+            if type(node) is HookNode and len(attached) > 0 and type(attached[-1]) is ConditionalNode and attached[-1].hook == None:
+                attached[-1] = ConditionalNode(attached[-1].name, attached[-1].condition, node)
+            else:
+                attached.append(node)
+        return tuple(attached)
+
+    def _parse_element(self, element: dict, removed: List[str]):
+        if MACROS_NAME in element:
+            name = element[MACROS_NAME]
+            if name not in UNNUMBERED_MACROS:
+                index = self.macro_count
+                self.macro_count += 1
+            if name in (MACRO_SET, MACRO_PUT) or name in CONDITIONAL_MACROS:
+                return self._compile_macro(element, removed)
+            hook = element.get(MACROS_ATTACHED_HOOK)
+            hook_node = None
+            if hook != None:
+                hook_node = self._parse_hook(hook, removed, is_hidden=False)
+            return MacroNode(index, element[MACROS_NAME], element[MACROS_VALUE], hook_node)
+        return self._parse_hook(element, removed, element.get(HOOK_IS_HIDDEN, False))
+
+    def _compile_macro(self, macro: dict, removed: List[str]):
+        name = macro[MACROS_NAME]
+        source = get_macro_source(macro[MACROS_ORIGINAL_TEXT], macro[MACROS_VALUE])
+        if name in CONDITIONAL_MACROS:
+            hook = macro.get(MACROS_ATTACHED_HOOK)
+            # Hook usually follows the macro in the text and is attached after parsing
+            hook_node = self._parse_hook(hook, removed, is_hidden=False) if hook != None else None
+            if name == MACRO_ELSE:
+                return ConditionalNode(name, None, hook_node)
+            try:
+                return ConditionalNode(name, compile_expression(source), hook_node)
+            except ExpressionError as error:
+                self.errors.append(f'{macro[MACROS_ORIGINAL_TEXT]}: {error}')
+                # Hook of the broken condition is never shown
+                return ConditionalNode(name, Expression(source, _fail, frozenset()), hook_node)
+        try:
+            return AssignmentNode(compile_assignments(source, is_put=name == MACRO_PUT))
+        except ExpressionError as error:
+            self.errors.append(f'{macro[MACROS_ORIGINAL_TEXT]}: {error}')
+            return AssignmentNode(())
+
+    def _parse_hook(self, hook: dict, removed: List[str], is_hidden: bool) -> HookNode:
+        hook_elements = hook.get(HOOK_LINKS, []) + hook.get(HOOK_IMAGES, [])
+        hook_removed = removed + [element[ORIGINAL_TEXT] for element in hook_elements]
+        nodes = self.parse(hook[HOOK_TEXT], hook_removed, hook.get(HOOK_HOOKS, []), hook.get(HOOK_MACROS, []))
+        return HookNode(hook.get(HOOK_NAME), is_hidden, nodes)
+
+    def _add_spans(self, spans: List[Tuple], text: str, original: str, element: Optional[dict]) -> bool:
+        if not original:
+            return False
+        start = text.find(original)
+        found = start != -1
+        while start != -1:
+            spans.append((start, start + len(original), element))
+            start = text.find(original, start + len(original))
+        return found
+
+    def _add_text(self, nodes: list, text: str) -> None:
+        position = 0
+        for match in VARIABLE_PATTERN.finditer(text):
+            if match.start() > position:
+                nodes.append(TextNode(text[position:match.start()]))
+            nodes.append(VariableNode(match.group()))
+            position = match.end()
+        if position < len(text):
+            nodes.append(TextNode(text[position:]))
+
+def _fail(variables: dict):
+    raise ExpressionError('Expression was not compiled')
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = 'twinecoil_'
+METRICS_PATH = '/metrics'
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """
+    Counts observations by buckets, like Prometheus histograms. Quantiles are estimated from the buckets.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        # Last one counts observations above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_quantile(self, fraction: float) -> float:
+        """
+        Returns upper bound of the bucket holding the quantile, infinity when it is above every bucket.
+        """
+        rank = fraction * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank and total > 0:
+                return bound
+        return float('inf')
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'passage', 'started')
+
+    def __init__(self, metrics: 'Metrics', stage: str, passage: Optional[tuple]) -> None:
+        self.metrics = metrics
+        self.stage = stage
+        self.passage = passage
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exception) -> None:
+        self.metrics.observe(self.stage, time.perf_counter() - self.started, self.passage)
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exception) -> None:
+        pass
+
+NO_TIMER = _NoTimer()
+
+class Metrics:
+    """
+    Latency histograms of update handling stages, counters and gauges of the bot.
+    When not `enabled` timers do nothing and counters are not touched, so instrumented code
+    costs one attribute check.
+    Per passage histograms are labeled with (story id, passage id) given to `time`.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.stages: Dict[str, Histogram] = {}
+        self.passages: Dict[Tuple[str, tuple], Histogram] = {}
+        self.counters: Dict[str, int] = {}
+        self.collected_counters: Dict[str, Callable[[], int]] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def time(self, stage: str, passage: tuple = None):
+        if not self.enabled:
+            return NO_TIMER
+        return _Timer(self, stage, passage)
+
+    def observe(self, stage: str, seconds: float, passage: tuple = None) -> None:
+        histogram = self.stages.get(stage)
+        if histogram == None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.observe(seconds)
+        if passage != None:
+            histogram = self.passages.get((stage, passage))
+            if histogram == None:
+                histogram = self.passages[(stage, passage)] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name: str, value: int = 1) -> None:
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_counter(self, name: str, get_value: Callable[[], int]) -> None:
+        """
+        Counter kept by someone else, e.g. hits of a cache. `get_value` is called only when metrics are exported.
+        """
+        self.collected_counters[name] = get_value
+
+    def add_gauge(self, name: str, get_value: Callable[[], float]) -> None:
+        """
+        `get_value` is called only when metrics are exported, e.g. size of a cache.
+        """
+        self.gauges[name] = get_value
+
+    def _get_counters(self) -> Dict[str, int]:
+        counters = dict(self.counters)
+        for name, get_value in self.collected_counters.items():
+            counters[name] = get_value()
+        return counters
+
+    def export(self) -> str:
+        """
+        Returns metrics in Prometheus text format.
+        """
+        lines = []
+        name = METRIC_PREFIX + 'stage_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        for stage, histogram in sorted(self.stages.items()):
+            self._export_histogram(lines, name, f'stage="{stage}"', histogram)
+        name = METRIC_PREFIX + 'passage_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        for (stage, (story_id, passage_id)), histogram in sorted(self.passages.items(), key=lambda item: str(item[0])):
+            self._export_histogram(lines, name, f'stage="{stage}",story="{_escape(story_id)}",passage="{_escape(passage_id)}"', histogram)
+        for counter, value in sorted(self._get_counters().items()):
+            lines.append(f'# TYPE {METRIC_PREFIX}{counter} counter')
+            lines.append(f'{METRIC_PREFIX}{counter} {value}')
+        for gauge, get_value in sorted(self.gauges.items()):
+            lines.append(f'# TYPE {METRIC_PREFIX}{gauge} gauge')
+            lines.append(f'{METRIC_PREFIX}{gauge} {get_value()}')
+        return '\n'.join(lines) + '\n'
+
+    def _export_histogram(self, lines: list, name: str, labels: str, histogram: Histogram) -> None:
+        total = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+        lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+    def log_summary(self) -> None:
+        for stage, histogram in sorted(self.stages.items()):
+            logger.info('Stage %s: %d times, p50 <= %.4fs, p99 <= %.4fs', stage, histogram.count,
+                        histogram.get_quantile(0.5), histogram.get_quantile(0.99))
+        for counter, value in sorted(self._get_counters().items()):
+            logger.info('%s: %d', counter, value)
+        for gauge, get_value in sorted(self.gauges.items()):
+            logger.info('%s: %s', gauge, get_value())
+
+    async def log_periodically(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.log_summary()
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsServer:
+    """
+    Serves `Metrics.export` at `METRICS_PATH` for Prometheus, one request per connection.
+    """
+
+    def __init__(self, metrics: Metrics) -> None:
+        self.metrics = metrics
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self, host: str, port: int) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await reader.readline()).decode('latin-1')
+            # Request headers are not needed
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.split(' ')
+            if len(parts) == 3 and parts[0] == 'GET' and parts[1] == METRICS_PATH:
+                status = '200 OK'
+                body = self.metrics.export().encode('utf-8')
+            else:
+                status = '404 Not Found'
+                body = b''
+            writer.write((f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                          f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n').encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 from typing import List
 from macro import *
+from markup import *
 from link import Link
 
 PASSAGE_ID = 'id'
@@ -11,131 +12,87 @@ PASSAGE_LINKS = 'links'
 PASSAGE_HOOKS = 'hooks'
 PASSAGE_MACROS = 'macros'
 PASSAGE_IMAGES = 'image'
+# Set by the story compiler for passages every reader sees the same until something is revealed
+PASSAGE_SNAPSHOT = 'renderSnapshot'
+SNAPSHOT_TEXT = 'text'
+SNAPSHOT_IMAGES = 'images'
 
 LINK_ORIGINAL_TEXT = 'original'
 LINK_TEXT = 'linkText'
 LINK_DESTINATION_NAME = 'passageName'
 
 IMAGE_ORIGINAL = 'original'
-
-HOOK_NAME = 'hookName'
-HOOK_ORIGINAL_TEXT = 'original'
-HOOK_TEXT = 'hookText'
-HOOK_IS_HIDDEN = 'isHidden'
-HOOK_MACROS = 'macros'
+IMAGE_BASE_64 = 'imageBase64'
+# Set for images of compiled stories instead of base64
+IMAGE_BLOB = 'imageBlob'
 
 class Passage:
+    """
+    Compiled passage of a `StoryTemplate`. It is shared by every reader and must not be mutated,
+    reader specific changes are kept in `PassageState`.
+    """
 
-    def __init__(self, paragraph_dict: dict, link_creator):
+    def __init__(self, paragraph_dict: dict):
         self.id = paragraph_dict[PASSAGE_ID]
-        if PASSAGE_NAME in paragraph_dict:
-            self.name = paragraph_dict[PASSAGE_NAME]
+        self.name = paragraph_dict.get(PASSAGE_NAME)
         self.text = paragraph_dict[PASSAGE_TEXT]
-        self.links_json = paragraph_dict[PASSAGE_LINKS]
-        self.hooks = paragraph_dict[PASSAGE_HOOKS]
-        self.macros = paragraph_dict[PASSAGE_MACROS]
-        self.images = paragraph_dict[PASSAGE_IMAGES]
-        self.context = link_creator
-
-        self._preprocess_static()
-    
-    def _preprocess_static(self):
+        self.images = tuple(paragraph_dict[PASSAGE_IMAGES])
+        snapshot = paragraph_dict.get(PASSAGE_SNAPSHOT)
+        # Text and images rendered ahead of time for a reader who has revealed nothing here
+        self.snapshot = None if snapshot == None else (snapshot[SNAPSHOT_TEXT], tuple(snapshot[SNAPSHOT_IMAGES]))
         self.links = []
-        for link_json in self.links_json:
-            self.text = self.text.replace(link_json[LINK_ORIGINAL_TEXT], '')
+        for link_json in paragraph_dict[PASSAGE_LINKS]:
             self.links.append(Link(link_text=link_json[LINK_TEXT], destination_name=link_json[LINK_DESTINATION_NAME]))
-        
-        for image in self.images:
-            self.text = self.text.replace(image[IMAGE_ORIGINAL], '')
+
+        removed = [link_json[LINK_ORIGINAL_TEXT] for link_json in paragraph_dict[PASSAGE_LINKS]]
+        removed += [image[IMAGE_ORIGINAL] for image in self.images]
+        parser = MarkupParser()
+        self.nodes = parser.parse(self.text, removed, paragraph_dict[PASSAGE_HOOKS], paragraph_dict[PASSAGE_MACROS])
+        self.errors = tuple(parser.errors)
+        self.link_reveal_macros = tuple(self._find_macros(MACRO_LINK_REVEAL))
+        self.show_macros = tuple(self._find_macros(MACRO_SHOW))
+        self.display_names = tuple(macro.value for macro in self._find_macros(MACRO_DISPLAY))
+        self.variable_names = frozenset(self._find_variable_names())
+        self.hooks_by_name = {}
+        for node in self._iterate_nodes(self.nodes):
+            if type(node) is HookNode and node.name != None:
+                self.hooks_by_name.setdefault(node.name, []).append(node)
+        # Variables and hooks of the rendered text, including displayed passages. Filled by `StoryTemplate`.
+        self.render_variable_names = tuple(sorted(self.variable_names))
+        self.render_hook_names = frozenset(self.hooks_by_name)
+
+    def is_static(self) -> bool:
+        """
+        Passage renders to the same text for every reader and has no images.
+        """
+        return len(self.images) == 0 and all(type(node) is TextNode for node in self.nodes)
+
+    def _find_variable_names(self):
+        """
+        Variables printed by the passage or read by its expressions.
+        """
+        for node in self._iterate_nodes(self.nodes):
+            node_type = type(node)
+            if node_type is VariableNode:
+                yield node.name
+            elif node_type is AssignmentNode:
+                for _, expression in node.assignments:
+                    yield from expression.variable_names
+            elif node_type is ConditionalNode and node.condition != None:
+                yield from node.condition.variable_names
+
+    def _find_macros(self, name: str):
+        for node in self._iterate_nodes(self.nodes):
+            if type(node) is MacroNode and node.name == name:
+                yield node
+
+    def _iterate_nodes(self, nodes: tuple):
+        for node in nodes:
+            yield node
+            if type(node) is HookNode:
+                yield from self._iterate_nodes(node.nodes)
+            elif type(node) in (MacroNode, ConditionalNode) and node.hook != None:
+                yield from self._iterate_nodes(node.hook.nodes)
 
     def get_links(self) -> List[Link]:
         return self.links
-    
-    def get_clean_text(self, passages_by_name: dict) -> str:
-        # The idea is to handle hook/macro while there are hooks and macros.
-        # Operations will have order
-        # Show macro before hidden hooks
-
-        self._process_active_hooks(passages_by_name)
-        self._process_macros(passages_by_name)
-        self._process_variables()
-
-        return self._get_text_without_hidden_hooks()
-    
-    def _process_variables(self):
-        for variable in self.context.variables:
-            print(self.context.variables)
-            print(self.text)
-            self.text = self.text.replace(variable, self.context.variables[variable])
-            print(self.text)
-
-    def _process_macros(self, passages_by_name: dict):
-        request_hooks = False
-        for macro in self.macros:
-            name = macro[MACROS_NAME]
-            value = macro[MACROS_VALUE]
-            original_text = macro[MACROS_ORIGINAL_TEXT]
-
-            if (name == MACRO_SHOW):
-                hook_name = value[1:]
-                for hook in self.hooks:
-                    if hook[HOOK_NAME] == hook_name:
-                        hook[HOOK_IS_HIDDEN] = False
-                self.text = self.text.replace(original_text, "")
-                self.macros.remove(macro)
-                request_hooks = True
-            if (name == MACRO_DISPLAY):
-                passage_to_add: Passage = passages_by_name[value]
-                self.text = self.text.replace(original_text, passage_to_add.text)
-                self.images.extend(passage_to_add.images)
-                self.macros.remove(macro)
-                request_hooks = True
-            if (name == MACRO_LINK_REVEAL):
-                url = self.context.create_url(MACRO_LINK_REVEAL, value)
-                url_text = f'[{value}]({url})'
-                self.text = self.text.replace(original_text, url_text)
-
-                hook = macro[MACROS_ATTACHED_HOOK]
-                hook_original = hook[HOOK_ORIGINAL_TEXT]
-                self.text = self.text.replace(hook_original, "")
-            if (name == MACRO_SET):
-                variable, variable_val = value.split(' to ')
-                print(f'setting {variable} to {variable_val}')
-                self.context.variables[variable] = variable_val.replace('"', '')
-                self.text = self.text.replace(original_text, "")
-        
-        if request_hooks:
-            self._process_active_hooks(passages_by_name)
-    
-    def _process_active_hooks(self, passages_by_name: dict):
-        request_macros = False
-        for hook in self.hooks:
-            if not hook[HOOK_IS_HIDDEN]:
-                self.text = self.text.replace(hook[HOOK_ORIGINAL_TEXT], hook[HOOK_TEXT])
-                self.hooks.remove(hook)
-                if HOOK_MACROS in hook:
-                    self.macros.extend(hook[HOOK_MACROS])
-                    request_macros = True
-        
-        if request_macros:
-            self._process_macros(passages_by_name)
-
-    def _get_text_without_hidden_hooks(self) -> str:
-        text = self.text
-        for hook in self.hooks:
-            if hook[HOOK_IS_HIDDEN]:
-                text = text.replace(hook[HOOK_ORIGINAL_TEXT], '')
-        return text
-    
-    def navigate_by_macro(self, name: str, value: str):
-        for macro in self.macros:
-            if name == MACRO_LINK_REVEAL and macro[MACROS_NAME] == MACRO_LINK_REVEAL and macro[MACROS_VALUE] == value:
-                url = self.context.create_url(MACRO_LINK_REVEAL, value)
-                url_text = f'[{value}]({url})'
-                replacement = value + macro[MACROS_ATTACHED_HOOK][HOOK_ORIGINAL_TEXT]
-                self.text = self.text.replace(url_text, replacement)
-                hook = macro[MACROS_ATTACHED_HOOK]
-                self.hooks.append(hook)
-                self.macros.remove(macro)
-
-
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from typing import List
+from macro import *
+from link import Link
+from passage import *
+from renderer import Renderer
+
+# Shared by every passage nothing was revealed in
+NOTHING_REVEALED = frozenset()
+
+class PassageState:
+    """
+    Reader's view of the shared `Passage` being read. Numbers of revealed macros are a frozenset
+    shared with the story's overlay, revealing replaces it, so snapshots of the story never see
+    later reveals. Images and assignments are those of the last render.
+    """
+    __slots__ = ('passage', 'id', 'name', 'revealed_macros', 'images', 'assignments', 'context')
+
+    def __init__(self, passage: Passage, link_creator, revealed_macros: frozenset = NOTHING_REVEALED):
+        self.passage = passage
+        self.id = passage.id
+        self.name = passage.name
+        self.revealed_macros = revealed_macros
+        self.images = passage.images
+        self.assignments = {}
+        self.context = link_creator
+
+    def get_links(self) -> List[Link]:
+        return self.passage.get_links()
+    
+    def get_clean_text(self, passages_by_name: dict) -> str:
+        snapshot = self.passage.snapshot
+        if snapshot != None and len(self.revealed_macros) == 0:
+            text, self.images = snapshot
+            return text
+        renderer = Renderer(passages_by_name, self.context)
+        text, self.images = renderer.render(self.passage, self.revealed_macros)
+        self.assignments = renderer.assignments
+        return text
+    
+    def reveal_macro(self, index: int) -> frozenset:
+        self.revealed_macros = self.revealed_macros | {index}
+        return self.revealed_macros
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set
+from render_cache import Frame
+from story import Story
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREFETCH_WORKERS = 2
+DEFAULT_PREFETCH_BYTES = 16 * 1024 * 1024
+# Rough size of a frame besides its text: keyboard, assignments and the frame itself
+FRAME_OVERHEAD = 1024
+
+class Prefetcher:
+    """
+    Renders passages the reader can go to next while the reader is reading the current one.
+    Each destination is rendered on a snapshot of the reader's story by `render` in a pool of
+    `workers` threads, so the click only looks the frame up by `Story.get_render_key`.
+    Frames of a reader are dropped when the reader moves on, and the oldest frames are dropped
+    when they take more than `max_bytes`. Images are not copied, frames refer to those of the story.
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, render: Callable[[Story], Frame], workers: int = DEFAULT_PREFETCH_WORKERS,
+                 max_bytes: int = DEFAULT_PREFETCH_BYTES) -> None:
+        self.render = render
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.scheduled = 0
+        self.used = 0
+        self.wasted = 0
+        self.evicted = 0
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='prefetch')
+        # (user id, render key) -> (frame, size), oldest first
+        self._frames = OrderedDict()
+        self._keys: Dict[object, Set[tuple]] = {}
+        self._pending: Dict[object, List[asyncio.Future]] = {}
+
+    def prefetch(self, user_id, story: Story) -> None:
+        """
+        Starts rendering destinations of the story's current passage, frames of the passage
+        the reader has left are dropped and their renders are cancelled.
+        """
+        self.cancel(user_id)
+        loop = asyncio.get_running_loop()
+        pending = []
+        keys = set()
+        for link in story.get_links():
+            if link.destination_name not in story.template.passages_by_name:
+                continue
+            snapshot = story.snapshot()
+            snapshot.navigate(link.destination_name)
+            key = (user_id, snapshot.get_render_key())
+            # Several links may lead to one passage
+            if key in keys:
+                continue
+            keys.add(key)
+            future = loop.run_in_executor(self._executor, self.render, snapshot)
+            future.add_done_callback(lambda future, key=key: self._keep(key, future))
+            pending.append(future)
+            self.scheduled += 1
+        if len(pending) > 0:
+            self._pending[user_id] = pending
+
+    def take(self, user_id, key: tuple) -> Optional[Frame]:
+        """
+        Returns frame prefetched for the reader's story with the given render key.
+        """
+        entry = self._frames.pop((user_id, key), None)
+        if entry == None:
+            return None
+        self._forget(user_id, key, entry[1])
+        self.used += 1
+        return entry[0]
+
+    def cancel(self, user_id) -> None:
+        for future in self._pending.pop(user_id, []):
+            future.cancel()
+        for key in self._keys.pop(user_id, set()):
+            _, size = self._frames.pop((user_id, key))
+            self.size -= size
+            self.wasted += 1
+
+    async def join(self) -> None:
+        """
+        Waits for renders started so far.
+        """
+        futures = [future for pending in self._pending.values() for future in pending]
+        await asyncio.gather(*futures, return_exceptions=True)
+
+    def stop(self) -> None:
+        for user_id in list(self._pending):
+            self.cancel(user_id)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def _keep(self, key: tuple, future: asyncio.Future) -> None:
+        user_id, render_key = key
+        pending = self._pending.get(user_id)
+        if future.cancelled() or pending == None or future not in pending:
+            return
+        pending.remove(future)
+        if len(pending) == 0:
+            del self._pending[user_id]
+        if future.exception() != None:
+            logger.warning('Prefetch of %s failed', render_key, exc_info=future.exception())
+            return
+
+        frame = future.result()
+        size = sys.getsizeof(frame.text) + FRAME_OVERHEAD
+        self._frames[key] = (frame, size)
+        self._keys.setdefault(user_id, set()).add(render_key)
+        self.size += size
+        while self.size > self.max_bytes:
+            (oldest_user_id, oldest_key), (_, oldest_size) = self._frames.popitem(last=False)
+            self._forget(oldest_user_id, oldest_key, oldest_size)
+            self.evicted += 1
+
+    def _forget(self, user_id, key: tuple, size: int) -> None:
+        self.size -= size
+        keys = self._keys[user_id]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self._keys[user_id]
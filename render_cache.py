@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Union
+from story_file import ImageBlob
+
+@dataclass(frozen=True)
+class Frame:
+    """
+    Everything sent to a reader for a passage. `assignments` are variables set while rendering,
+    they are applied to the reader's story when the frame comes from the cache.
+    """
+    text: str
+    reply_markup: object
+    image: Union[str, ImageBlob, None]
+    assignments: dict
+
+class RenderCache:
+    """
+    Rendered frames keyed by `Story.get_render_key`, least recently used frame is dropped
+    when there are more than `capacity` of them.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[Frame]:
+        frame = self._frames.get(key)
+        if frame == None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._frames.move_to_end(key)
+        return frame
+
+    def put(self, key: tuple, frame: Frame) -> None:
+        self._frames[key] = frame
+        self._frames.move_to_end(key)
+        if len(self._frames) > self.capacity:
+            self._frames.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._frames)
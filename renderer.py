@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from typing import List, Tuple
+from macro import *
+from markup import *
+
+# Marks variables that had no value before the render
+_UNSET = object()
+
+class Renderer:
+    """
+    Renders compiled passage nodes for one reader in a single walk, text is collected into a buffer.
+    Walk is repeated only when (show:) reveals a hook that was already skipped, variables set
+    by the skipped walk are put back first. Variables set during the render are kept in `assignments`.
+    Expressions failing on reader values are skipped, as if their hook was hidden.
+    """
+
+    def __init__(self, passages_by_name: dict, link_creator) -> None:
+        self.passages_by_name = passages_by_name
+        self.context = link_creator
+
+    def render(self, passage, revealed_macros: set) -> Tuple[str, List[dict]]:
+        self.shown_hooks = set()
+        # Passage owning the macros being rendered, links are made for its macro numbers
+        self.passage_id = passage.id
+        self.previous_values = {}
+        while True:
+            self.buffer = []
+            self.images = list(passage.images)
+            self.skipped_hooks = set()
+            self.assignments = {}
+            self.is_branch_shown = True
+            self.rerender = False
+            self._render_nodes(passage.nodes, revealed_macros)
+            if not self.rerender:
+                return ''.join(self.buffer), self.images
+            self._restore_variables()
+
+    def _restore_variables(self) -> None:
+        variables = self.context.variables
+        for name, value in self.previous_values.items():
+            if value is _UNSET:
+                variables.pop(name, None)
+            else:
+                variables[name] = value
+        self.previous_values = {}
+
+    def _render_nodes(self, nodes: tuple, revealed_macros: set) -> None:
+        for node in nodes:
+            node_type = type(node)
+            if node_type is TextNode:
+                self.buffer.append(node.text)
+            elif node_type is VariableNode:
+                value = self.context.variables.get(node.name, _UNSET)
+                self.buffer.append(node.name if value is _UNSET else to_text(value))
+            elif node_type is HookNode:
+                self._render_hook(node, revealed_macros)
+            elif node_type is AssignmentNode:
+                self._assign(node)
+            elif node_type is ConditionalNode:
+                self._render_conditional(node, revealed_macros)
+            else:
+                self._render_macro(node, revealed_macros)
+
+    def _render_hook(self, hook: HookNode, revealed_macros: set) -> None:
+        if hook.is_hidden and hook.name not in self.shown_hooks:
+            self.skipped_hooks.add(hook.name)
+            return
+        self._render_nodes(hook.nodes, revealed_macros)
+
+    def _assign(self, node: AssignmentNode) -> None:
+        variables = self.context.variables
+        for name, expression in node.assignments:
+            try:
+                value = expression.evaluate(variables)
+            except ExpressionError:
+                continue
+            if name not in self.previous_values:
+                self.previous_values[name] = variables.get(name, _UNSET)
+            variables[name] = value
+            self.assignments[name] = value
+
+    def _render_conditional(self, node: ConditionalNode, revealed_macros: set) -> None:
+        """
+        (else-if:) and (else:) show their hook only when the hook of the previous one was hidden.
+        """
+        if node.name == MACRO_IF or not self.is_branch_shown:
+            is_shown = node.condition == None
+            if not is_shown:
+                try:
+                    is_shown = is_true(node.condition.evaluate(self.context.variables))
+                except ExpressionError:
+                    is_shown = False
+        else:
+            is_shown = False
+        if is_shown and node.hook != None:
+            self._render_nodes(node.hook.nodes, revealed_macros)
+        # Conditionals inside the hook don't change which branch of this chain was shown
+        self.is_branch_shown = is_shown or (node.name != MACRO_IF and self.is_branch_shown)
+
+    def _render_macro(self, macro: MacroNode, revealed_macros: set) -> None:
+        name = macro.name
+        value = macro.value
+        if name == MACRO_SHOW:
+            hook_name = value.strip()[1:]
+            self.shown_hooks.add(hook_name)
+            if hook_name in self.skipped_hooks:
+                self.rerender = True
+        elif name == MACRO_DISPLAY:
+            # Story is checked for display cycles when it is loaded
+            passage_to_add = self.passages_by_name[value]
+            # Macros of displayed passage can't be revealed, their numbers belong to another passage,
+            # deeplinks of the current one would be refused for them
+            passage_id = self.passage_id
+            self.passage_id = None
+            self._render_nodes(passage_to_add.nodes, set())
+            self.passage_id = passage_id
+            self.images.extend(passage_to_add.images)
+        elif name == MACRO_LINK_REVEAL:
+            if macro.index in revealed_macros:
+                self.buffer.append(value)
+                self._render_hook(macro.hook, revealed_macros)
+            elif self.passage_id == None:
+                self.buffer.append(value)
+            else:
+                url = self.context.create_reveal_url(self.passage_id, macro.index)
+                self.buffer.append(f'[{value}]({url})')
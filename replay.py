@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Replays updates recorded with `bot.py --record-updates` through the bot's handlers against a fake Bot API,
+# to measure throughput, find slow passages and check that a change doesn't change what readers get.
+# Buttons and deeplinks are signed with the bot token, give the recording bot's token to replay them.
+# Usage:
+#   python replay.py updates.log --stories SPACE_FROG.json --token <token> --profile replay.prof
+#   python replay.py updates.log --token <token> --speed 1
+#   python replay.py updates.log --token <token> --messages before.jsonl
+#   python replay.py updates.log --token <token> --messages after.jsonl --expect before.jsonl
+# For a sampling profile run the replay under an external profiler, e.g. `py-spy record -- python replay.py ...`
+import argparse
+import asyncio
+import cProfile
+import json
+import pstats
+import sys
+import time
+from typing import Iterable, List, Tuple
+
+from telegram import Update
+
+import bot
+from benchmark import percentile
+from fake_bot_api import FakeBotApi, FakeBotRequest
+from image_cache import ImageCache
+from link_codec import get_link_secret
+from metrics import Metrics
+from render_cache import RenderCache
+from send_scheduler import SendScheduler
+from session_store import SqliteSessionStore
+from story_registry import StoryRegistry
+from update_log import read_updates
+
+REPLAY_TOKEN = '0:replay'
+# Sends are not held back by Telegram limits at full speed
+UNLIMITED_RATE = 1e9
+# Longer pauses of the recording, e.g. restarts of the bot, are shortened to this many seconds
+MAX_PAUSE = 10
+HOT_PASSAGES = 10
+# Methods showing readers a passage, compared between replays
+MESSAGE_METHODS = ('sendMessage', 'sendPhoto', 'editMessageText', 'editMessageCaption', 'editMessageMedia')
+MESSAGE_PARAMS = ('text', 'caption', 'reply_markup')
+# Modules of the story engine shown in the profile summary
+ENGINE_MODULES = ('story', 'passage', 'renderer', 'expression', 'markup', 'link_codec')
+
+async def replay(records: Iterable[Tuple[float, dict]], stories: List[str], token: str = REPLAY_TOKEN, speed: float = 0,
+                 navigation: str = bot.NAVIGATION_EDIT, prefetch: bool = False) -> Tuple[dict, FakeBotApi]:
+    """
+    Handles recorded updates like the bot would, updates of different chats concurrently.
+    With `speed` 0 updates come as fast as they are handled and sends are not rate limited,
+    otherwise they come at the recorded pace sped up `speed` times.
+    Returns results and the fake Bot API with every call the bot made.
+    """
+    api = FakeBotApi()
+    bot.image_cache = ImageCache()
+    bot.render_cache = RenderCache(bot.RENDER_CACHE_SIZE)
+    bot.metrics = Metrics(enabled=True)
+    registry = StoryRegistry(stories, bot.STORY_CACHE_SIZE, get_link_secret(token))
+    store = SqliteSessionStore(':memory:')
+    application = bot.create_application(token, session_store=store, registry=registry, navigation=navigation,
+                                         prefetch=prefetch, request=FakeBotRequest(api))
+    if speed == 0:
+        application.bot_data[bot.SCHEDULER] = SendScheduler(application.bot, UNLIMITED_RATE, UNLIMITED_RATE, UNLIMITED_RATE, UNLIMITED_RATE)
+    await application.initialize()
+
+    latencies = []
+
+    async def handle(update: Update) -> None:
+        started = time.perf_counter_ns()
+        await application.process_update(update)
+        latencies.append(time.perf_counter_ns() - started)
+
+    pending = set()
+    previous = None
+    started = time.perf_counter()
+    replay_time = 0
+    for received, update_dict in records:
+        if speed > 0:
+            if previous != None:
+                replay_time += min(received - previous, MAX_PAUSE) / speed
+            previous = received
+            await asyncio.sleep(max(0, started + replay_time - time.perf_counter()))
+        # Bounded like the update queue of the bot
+        while len(pending) >= bot.MAX_QUEUED_UPDATES:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        update = Update.de_json(update_dict, application.bot)
+        pending.add(asyncio.create_task(application.update_processor.process_update(update, handle(update))))
+    await asyncio.gather(*pending)
+    seconds = time.perf_counter() - started
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+    latencies.sort()
+    renders = [(passage, histogram) for (stage, passage), histogram in bot.metrics.passages.items() if stage == bot.STAGE_RENDER]
+    renders.sort(key=lambda item: item[1].sum, reverse=True)
+    results = {
+        'updates': len(latencies),
+        'seconds': seconds,
+        'updates_per_second': len(latencies) / seconds if seconds > 0 else 0,
+        'latency_p50_ms': percentile(latencies, 0.5) / 1e6,
+        'latency_p99_ms': percentile(latencies, 0.99) / 1e6,
+        'latency_max_ms': latencies[-1] / 1e6 if len(latencies) > 0 else 0,
+        'api_calls': len(api.requests),
+        'stale_buttons': bot.metrics.counters.get('stale_buttons_total', 0),
+        'render_cache_hits': bot.render_cache.hits,
+        'render_cache_misses': bot.render_cache.misses,
+        'hot_passages': [{'story': story_id, 'passage': passage_id, 'renders': histogram.count, 'seconds': histogram.sum}
+                         for (story_id, passage_id), histogram in renders[:HOT_PASSAGES]],
+    }
+    return results, api
+
+def get_messages(api: FakeBotApi) -> List[dict]:
+    """
+    Messages the bot showed to readers, chat by chat in the order they were sent. Message ids are left out,
+    they depend on the order chats were served in.
+    """
+    messages = []
+    for request in api.requests:
+        if request.method in MESSAGE_METHODS:
+            message = {'chat': str(request.params.get('chat_id', '')), 'method': request.method}
+            message.update({name: request.params[name] for name in MESSAGE_PARAMS if name in request.params})
+            messages.append(message)
+    # Stable sort keeps order within a chat
+    messages.sort(key=lambda message: message['chat'])
+    return messages
+
+def compare_messages(messages: List[dict], expected: List[dict]) -> List[str]:
+    differences = []
+    for index, (message, expected_message) in enumerate(zip(messages, expected)):
+        if message != expected_message:
+            differences.append(f'Message {index} to chat {expected_message["chat"]} differs: {expected_message} became {message}')
+    if len(messages) != len(expected):
+        differences.append(f'{len(expected)} messages were expected, {len(messages)} were sent')
+    return differences
+
+def print_profile(profile: cProfile.Profile, limit: int = 20) -> None:
+    stats = pstats.Stats(profile, stream=sys.stderr)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE)
+    stats.print_stats('|'.join(f'/{module}[a-z_]*\\.py' for module in ENGINE_MODULES), limit)
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Replays recorded updates against the bot with a fake Bot API')
+    parser.add_argument('logs', nargs='+', help='update logs written with --record-updates, logs of workers are merged')
+    parser.add_argument('--stories', nargs='+', default=bot.DEFAULT_STORIES, help='story JSON files or directories with them')
+    parser.add_argument('--token', default=REPLAY_TOKEN, help='token of the bot that recorded the updates, buttons are signed with it')
+    parser.add_argument('--speed', type=float, default=0, help='replay at recorded pace sped up this many times, 0 for full speed')
+    parser.add_argument('--navigation', choices=(bot.NAVIGATION_EDIT, bot.NAVIGATION_RESEND), default=bot.NAVIGATION_EDIT)
+    parser.add_argument('--prefetch', action='store_true', help='prefetch passages like the bot with --prefetch')
+    parser.add_argument('--profile', help='profile the replay with cProfile and write stats to this file')
+    parser.add_argument('--messages', help='write messages readers got to this JSON lines file')
+    parser.add_argument('--expect', help='compare messages readers got with ones written by an earlier --messages run')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    records = read_updates(arguments.logs)
+    coroutine = replay(records, arguments.stories, arguments.token, arguments.speed, arguments.navigation, arguments.prefetch)
+    if arguments.profile != None:
+        profile = cProfile.Profile()
+        results, api = profile.runcall(asyncio.run, coroutine)
+        profile.dump_stats(arguments.profile)
+        print_profile(profile)
+    else:
+        results, api = asyncio.run(coroutine)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+    messages = get_messages(api)
+    if arguments.messages != None:
+        with open(arguments.messages, 'w') as f:
+            for message in messages:
+                f.write(json.dumps(message, ensure_ascii=False) + '\n')
+    if arguments.expect != None:
+        with open(arguments.expect) as f:
+            expected = [json.loads(line) for line in f]
+        differences = compare_messages(messages, expected)
+        for difference in differences[:HOT_PASSAGES]:
+            print(difference)
+        print(f'{len(messages)} messages, {len(differences)} differences')
+        sys.exit(1 if len(differences) > 0 else 0)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from telegram import Bot, CallbackQuery, InputMediaPhoto, Message
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Lower number goes first
+PRIORITY_ANSWER = 0
+PRIORITY_SEND = 1
+PRIORITY_CLEANUP = 2
+
+# Limits from https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+GROUP_RATE = 20 / 60
+GROUP_BURST = 3
+MAX_IN_FLIGHT = 256
+# Seconds between sweeps of buckets of chats that have been quiet long enough to refill them
+BUCKET_SWEEP_INTERVAL = 60
+
+NOT_MODIFIED_ERROR = 'not modified'
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average and bursts of up to `capacity` calls.
+    """
+
+    def __init__(self, rate: float, capacity: float, now: float = None) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now == None else now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_delay(self, now: float) -> float:
+        """
+        Returns seconds until a token is available.
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+@dataclass(frozen=True)
+class MessageRef:
+    """
+    Enough of a sent message to delete or edit it later, a whole `Message` also holds its text, keyboard and chat.
+    """
+    chat_id: int
+    message_id: int
+    has_photo: bool
+
+    @staticmethod
+    def of(message: Message) -> 'MessageRef':
+        return MessageRef(message.chat_id, message.message_id, len(message.photo) > 0)
+
+@dataclass
+class _Job:
+    priority: int
+    sequence: int
+    call: Callable[[], Awaitable]
+    future: asyncio.Future
+    # Jobs sending something to a chat take a token of the chat
+    is_limited: bool
+    # Message removed by a delete job, so a following send can edit it instead
+    deleted_message: Optional[MessageRef] = None
+    # Edits the given message into what a send job sends, None when it can't
+    edit: Optional[Callable[[MessageRef], Awaitable]] = None
+    merged_futures: List[asyncio.Future] = field(default_factory=list)
+
+class SendScheduler:
+    """
+    Queue of Bot API calls. Calls to one chat go one at a time and in order, limited by the chat's
+    token bucket, while all calls share the global one. Callback answers go first, deletes last.
+    When a send is queued right behind a delete in the same chat and the messages are of the same
+    kind, both become one edit of the deleted message, unless the delete was queued with `can_edit` off.
+    Calls that Telegram answers with RetryAfter are put back and everything waits for the given time.
+    Sends resolve to the sent `Message`, or to the `MessageRef` of the deleted one when an edit didn't change it.
+    """
+
+    def __init__(self, bot: Bot, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE, group_rate: float = GROUP_RATE,
+                 chat_burst: float = CHAT_BURST) -> None:
+        self.bot = bot
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.coalesced = 0
+        self.flood_waits = 0
+        self.sweep_interval = BUCKET_SWEEP_INTERVAL
+        self._next_sweep = 0
+        self._global_bucket = TokenBucket(global_rate, GLOBAL_BURST)
+        self._chat_buckets: Dict[object, TokenBucket] = {}
+        self._chats: Dict[object, deque] = {}
+        # Entries are (priority, sequence, chat), stale ones are skipped
+        self._ready: List[Tuple] = []
+        self._waiting: List[Tuple] = []
+        self._scheduled: Dict[object, Tuple] = {}
+        self._running = set()
+        self._sequence = itertools.count()
+        self._paused_until = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._in_flight: Optional[asyncio.Semaphore] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def answer(self, query: CallbackQuery, **kwargs) -> asyncio.Future:
+        # Answers are not messages, they are neither limited nor ordered with the chat
+        return self._enqueue(('answer', next(self._sequence)), _Job(PRIORITY_ANSWER, 0, lambda: query.answer(**kwargs), None, False))
+
+    def delete(self, message: MessageRef, can_edit: bool = True) -> asyncio.Future:
+        async def call():
+            try:
+                return await self.bot.delete_message(message.chat_id, message.message_id)
+            except BadRequest:
+                # Reader has deleted it already or it is too old to be deleted
+                return False
+        job = _Job(PRIORITY_CLEANUP, 0, call, None, False, deleted_message=message if can_edit else None)
+        return self._enqueue(message.chat_id, job)
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        async def edit(message: MessageRef):
+            if message.has_photo:
+                return None
+            return await self.bot.edit_message_text(text, chat_id, message.message_id, **kwargs)
+        job = _Job(PRIORITY_SEND, 0, lambda: self.bot.send_message(chat_id, text, **kwargs), None, True, edit=edit)
+        return self._enqueue(chat_id, job)
+
+    def send_photo(self, chat_id: int, photo, caption: str = None, reply_markup=None, parse_mode=None, keep_photo: bool = False) -> asyncio.Future:
+        """
+        `keep_photo` tells that the replaced message shows the same photo, so only its caption is edited.
+        """
+        async def edit(message: MessageRef):
+            if not message.has_photo:
+                return None
+            if keep_photo:
+                return await self.bot.edit_message_caption(chat_id, message.message_id, caption=caption, reply_markup=reply_markup, parse_mode=parse_mode)
+            media = InputMediaPhoto(photo, caption=caption, parse_mode=parse_mode)
+            return await self.bot.edit_message_media(media, chat_id, message.message_id, reply_markup=reply_markup)
+        call = lambda: self.bot.send_photo(chat_id, photo, caption=caption, reply_markup=reply_markup, parse_mode=parse_mode)
+        return self._enqueue(chat_id, _Job(PRIORITY_SEND, 0, call, None, True, edit=edit))
+
+    async def stop(self) -> None:
+        if self._dispatcher != None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    def _enqueue(self, chat, job: _Job) -> asyncio.Future:
+        if self._dispatcher == None:
+            self._wakeup = asyncio.Event()
+            self._in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+        job.sequence = next(self._sequence)
+        job.future = asyncio.get_running_loop().create_future()
+        jobs = self._chats.setdefault(chat, deque())
+        if job.edit != None and len(jobs) > 0 and jobs[-1].deleted_message != None:
+            self._merge(jobs, job)
+        else:
+            jobs.append(job)
+        self._schedule(chat)
+        return job.future
+
+    def _merge(self, jobs: deque, job: _Job) -> None:
+        deleting = jobs.pop()
+        deleted_message = deleting.deleted_message
+        delete = deleting.call
+        send = job.call
+
+        async def edit_or_resend():
+            try:
+                message = await job.edit(deleted_message)
+                if message != None:
+                    self.coalesced += 1
+                    return message
+            except BadRequest as error:
+                if NOT_MODIFIED_ERROR in error.message.lower():
+                    return deleted_message
+            # Message is of another kind or can't be edited anymore
+            await delete()
+            return await send()
+
+        job.call = edit_or_resend
+        job.merged_futures.append(deleting.future)
+        jobs.append(job)
+
+    def _get_chat_bucket(self, chat, now: float) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat)
+        if bucket == None:
+            # Group chats have negative ids and lower limits
+            if isinstance(chat, int) and chat < 0:
+                bucket = TokenBucket(self.group_rate, GROUP_BURST, now)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            self._chat_buckets[chat] = bucket
+        return bucket
+
+    def _schedule(self, chat) -> None:
+        jobs = self._chats.get(chat)
+        if chat in self._running:
+            return
+        if jobs == None or len(jobs) == 0:
+            self._chats.pop(chat, None)
+            self._scheduled.pop(chat, None)
+            return
+        head = jobs[0]
+        entry = (head.priority, head.sequence, chat)
+        if self._scheduled.get(chat) == entry:
+            return
+        self._scheduled[chat] = entry
+        now = time.monotonic()
+        delay = self._get_chat_bucket(chat, now).get_delay(now) if head.is_limited else 0
+        if delay > 0:
+            heapq.heappush(self._waiting, (now + delay, entry))
+        else:
+            heapq.heappush(self._ready, entry)
+        self._wakeup.set()
+
+    def _sweep_buckets(self, now: float) -> None:
+        # A full bucket is the same as a new one, chats with nothing queued don't need theirs
+        for chat, bucket in list(self._chat_buckets.items()):
+            if chat not in self._chats and chat not in self._running and bucket.is_full(now):
+                del self._chat_buckets[chat]
+        self._next_sweep = now + self.sweep_interval
+
+    async def _dispatch(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                self._sweep_buckets(now)
+            while len(self._waiting) > 0 and self._waiting[0][0] <= now:
+                heapq.heappush(self._ready, heapq.heappop(self._waiting)[1])
+            if len(self._ready) == 0:
+                timeout = self._waiting[0][0] - now if len(self._waiting) > 0 else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            entry = self._ready[0]
+            if self._scheduled.get(entry[2]) != entry:
+                heapq.heappop(self._ready)
+                continue
+            job = self._chats[entry[2]][0]
+            delay = self._paused_until - now
+            if job.is_limited:
+                delay = max(delay, self._global_bucket.get_delay(now))
+            if delay > 0:
+                # New jobs may come with a higher priority meanwhile
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._in_flight.acquire()
+            if len(self._ready) == 0 or self._ready[0] != entry or self._scheduled.get(entry[2]) != entry:
+                # Queue changed while waiting for a free connection
+                self._in_flight.release()
+                continue
+            heapq.heappop(self._ready)
+            chat = entry[2]
+            del self._scheduled[chat]
+            self._chats[chat].popleft()
+            if job.is_limited:
+                now = time.monotonic()
+                self._global_bucket.take(now)
+                self._get_chat_bucket(chat, now).take(now)
+            self._running.add(chat)
+            asyncio.get_running_loop().create_task(self._run(chat, job))
+
+    async def _run(self, chat, job: _Job) -> None:
+        try:
+            result = await job.call()
+        except RetryAfter as error:
+            retry_after = error.retry_after
+            if isinstance(retry_after, datetime.timedelta):
+                retry_after = retry_after.total_seconds()
+            logger.warning('Flood limit is hit, waiting %s seconds', retry_after)
+            self.flood_waits += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._chats.setdefault(chat, deque()).appendleft(job)
+        except Exception as error:
+            for future in [job.future] + job.merged_futures:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            job.future.set_result(result)
+            for future in job.merged_futures:
+                future.set_result(True)
+        finally:
+            self._in_flight.release()
+            self._running.discard(chat)
+            self._schedule(chat)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+from session_store import SessionStore
+from story import PackedStory, Story, STATE_STORY_ID
+from story_template import StoryTemplate
+
+class SessionCache:
+    """
+    Keeps stories of recently active readers in memory. Least recently used story is dropped
+    when there are more than `capacity` of them, its state is already in the `SessionStore`
+    and the story is restored from it on the next click.
+    With `packed_capacity` stories are packed into `PackedStory` instead of being dropped, and so are
+    stories not used for `idle_ttl` seconds. Up to `packed_capacity` of them are kept, least recently
+    used are dropped, a packed story is unpacked on the next click without reading the store.
+    `get_template` returns compiled story by its id. Stories of a reloaded story file are moved
+    to its new version when their reader comes back. Packed stories don't hold their template, `find_template`
+    returns the current version if it is compiled, packs of other versions are read from the store instead.
+    """
+
+    def __init__(self, store: SessionStore, capacity: int, get_template: Callable[[str], StoryTemplate], packed_capacity: int = 0,
+                 idle_ttl: float = None, find_template: Callable[[str], Optional[StoryTemplate]] = None) -> None:
+        self.store = store
+        self.capacity = capacity
+        self.get_template = get_template
+        self.find_template = find_template if find_template != None else get_template
+        self.packed_capacity = packed_capacity
+        self.idle_ttl = idle_ttl
+        self.packed_bytes = 0
+        self.packs = 0
+        self.unpacks = 0
+        # User id -> (story, last use time), least recently used first
+        self._stories = OrderedDict()
+        self._packed = OrderedDict()
+
+    async def get(self, user_id, username: str, now: float = None) -> Optional[Story]:
+        """
+        Stories not kept in memory are read from the store in a thread, the read may wait for a batch
+        being written and the story may have to be compiled, other readers are served meanwhile.
+        """
+        now = time.monotonic() if now == None else now
+        entry = self._stories.get(user_id)
+        if entry != None:
+            story = entry[0]
+            self._put(user_id, story, now)
+            story.migrate()
+            return story
+
+        story = None
+        packed = self._take_packed(user_id)
+        if packed != None:
+            template = self.find_template(packed.story_id)
+            # Story was reloaded or dropped while the reader was away, the store has the same state
+            if template != None and template.version == packed.version:
+                self.unpacks += 1
+                story = packed.unpack(template, username)
+        if story == None:
+            story = await asyncio.to_thread(self._load, user_id, username)
+            if story == None:
+                return None
+        self._put(user_id, story, now)
+        return story
+
+    def _load(self, user_id, username: str) -> Optional[Story]:
+        state = self.store.load(user_id)
+        if state == None:
+            return None
+        story = Story(self.get_template(state.get(STATE_STORY_ID)), username)
+        story.restore_state(state)
+        return story
+
+    def save(self, user_id, story: Story, now: float = None) -> None:
+        self._put(user_id, story, time.monotonic() if now == None else now)
+        self.store.save(user_id, story.get_state())
+
+    def close(self) -> None:
+        self.store.close()
+
+    def __len__(self) -> int:
+        return len(self._stories)
+
+    def get_packed_count(self) -> int:
+        return len(self._packed)
+
+    def get_hot_bytes(self) -> int:
+        """
+        Approximate bytes of stories kept unpacked, goes through all of them.
+        """
+        return sum(story.get_size() for story, _ in self._stories.values())
+
+    def _put(self, user_id, story: Story, now: float) -> None:
+        # Reader may have started again while the old story was packed
+        self._take_packed(user_id)
+        self._stories[user_id] = (story, now)
+        self._stories.move_to_end(user_id)
+        while len(self._stories) > self.capacity:
+            oldest_user_id, (oldest_story, _) = self._stories.popitem(last=False)
+            self._pack(oldest_user_id, oldest_story)
+        if self.idle_ttl != None:
+            # Oldest stories come first, the check stops at the first one that is still in use
+            while len(self._stories) > 0:
+                oldest_user_id, (oldest_story, last_used) = next(iter(self._stories.items()))
+                if now - last_used < self.idle_ttl:
+                    break
+                del self._stories[oldest_user_id]
+                self._pack(oldest_user_id, oldest_story)
+
+    def _pack(self, user_id, story: Story) -> None:
+        if self.packed_capacity == 0:
+            return
+        packed = story.pack()
+        self._packed[user_id] = packed
+        self.packed_bytes += packed.get_size()
+        self.packs += 1
+        while len(self._packed) > self.packed_capacity:
+            _, dropped = self._packed.popitem(last=False)
+            self.packed_bytes -= dropped.get_size()
+
+    def _take_packed(self, user_id) -> Optional[PackedStory]:
+        packed: PackedStory = self._packed.pop(user_id, None)
+        if packed != None:
+            self.packed_bytes -= packed.get_size()
+        return packed
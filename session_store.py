@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+class SessionStore:
+    """
+    Keeps reader states outside of the process. `save` only remembers the state,
+    states are written in batches by a background thread, so a click never waits for the disk.
+    When one reader changes state several times between flushes only the last state is written.
+    Backends implement `_read` and `_write_batch`.
+    """
+
+    def __init__(self, flush_interval: float = DEFAULT_FLUSH_INTERVAL) -> None:
+        self.flush_interval = flush_interval
+        self._pending: Dict[str, dict] = {}
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._writer = threading.Thread(target=self._write_behind, daemon=True)
+        self._writer.start()
+
+    def load(self, user_id) -> Optional[dict]:
+        user_id = str(user_id)
+        with self._pending_lock:
+            state = self._pending.get(user_id)
+        if state != None:
+            return state
+        with self._write_lock:
+            return self._read(user_id)
+
+    def save(self, user_id, state: dict) -> None:
+        with self._pending_lock:
+            self._pending[str(user_id)] = state
+
+    def flush(self) -> None:
+        # Batch leaves `_pending` only under the write lock, so `load` never misses it while it is written
+        with self._write_lock:
+            with self._pending_lock:
+                batch = self._pending
+                self._pending = {}
+            if len(batch) > 0:
+                self._write_batch(batch)
+
+    def close(self) -> None:
+        self._closed.set()
+        self._writer.join()
+        self.flush()
+
+    def _write_behind(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to write sessions')
+
+    def _read(self, user_id: str) -> Optional[dict]:
+        raise NotImplementedError()
+
+    def _write_batch(self, batch: Dict[str, dict]) -> None:
+        raise NotImplementedError()
+
+class SqliteSessionStore(SessionStore):
+    """
+    Stores reader states in a SQLite table, every batch is one transaction.
+    """
+
+    def __init__(self, file_path: str, flush_interval: float = DEFAULT_FLUSH_INTERVAL) -> None:
+        self._connection = sqlite3.connect(file_path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS sessions (user_id TEXT PRIMARY KEY, state TEXT NOT NULL)')
+        self._connection.commit()
+        super().__init__(flush_interval)
+
+    def close(self) -> None:
+        super().close()
+        self._connection.close()
+
+    def _read(self, user_id: str) -> Optional[dict]:
+        row = self._connection.execute('SELECT state FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+        if row == None:
+            return None
+        return json.loads(row[0])
+
+    def _write_batch(self, batch: Dict[str, dict]) -> None:
+        rows = [(user_id, json.dumps(state)) for user_id, state in batch.items()]
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO sessions (user_id, state) VALUES (?, ?)', rows)
+
+class FileSessionStore(SessionStore):
+    """
+    Appends reader states to a file as JSON lines, the last line of a reader wins.
+    Only offsets of the last lines are kept in memory, states are read from the file on demand.
+    """
+
+    def __init__(self, file_path: str, flush_interval: float = DEFAULT_FLUSH_INTERVAL) -> None:
+        self.file_path = file_path
+        self._offsets: Dict[str, int] = {}
+        self._file = open(file_path, 'a+b')
+        self._file.seek(0)
+        offset = 0
+        for line in self._file:
+            if not line.endswith(b'\n'):
+                # Last write was cut by a crash, the next one would be glued to it
+                logger.warning('Sessions file %s ends with a broken line, it is cut off', file_path)
+                self._file.truncate(offset)
+                break
+            self._offsets[json.loads(line)['user']] = offset
+            offset += len(line)
+        super().__init__(flush_interval)
+
+    def close(self) -> None:
+        super().close()
+        self._file.close()
+
+    def _read(self, user_id: str) -> Optional[dict]:
+        offset = self._offsets.get(user_id)
+        if offset == None:
+            return None
+        self._file.seek(offset)
+        return json.loads(self._file.readline())['state']
+
+    def _write_batch(self, batch: Dict[str, dict]) -> None:
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        for user_id, state in batch.items():
+            line = (json.dumps({'user': user_id, 'state': state}) + '\n').encode('utf-8')
+            self._file.write(line)
+            self._offsets[user_id] = offset
+            offset += len(line)
+        self._file.flush()
+        os.fsync(self._file.fileno())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import gc
+import logging
+import multiprocessing
+import signal
+from queue import Full
+from typing import Callable, List
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+MAX_QUEUED_UPDATES_PER_WORKER = 1024
+# Seconds to wait for room in the queue of a worker before checking that it is still alive
+WORKER_PUT_TIMEOUT = 1
+# Seconds a worker has to finish its updates on stop
+WORKER_STOP_TIMEOUT = 10
+
+class WorkerPool:
+    """
+    Spreads readers over worker processes by chat id, each worker owns sessions of its chats.
+    Workers are forked after the story is compiled, so they share it with the parent instead of parsing it again.
+    Updates of one chat always go to the same worker through one queue, so they keep their order.
+    """
+
+    def __init__(self, workers: int, create_worker_application: Callable[[int], Application]) -> None:
+        self.create_worker_application = create_worker_application
+        self._context = multiprocessing.get_context('fork')
+        self.queues = [self._context.Queue(MAX_QUEUED_UPDATES_PER_WORKER) for _ in range(workers)]
+        self._processes: List[multiprocessing.Process] = []
+
+    def start(self) -> None:
+        # Objects created so far are never freed, so the garbage collector doesn't touch and copy their pages in workers
+        gc.freeze()
+        for shard in range(len(self.queues)):
+            self._processes.append(self._start_worker(shard))
+
+    def stop(self) -> None:
+        for shard, queue in enumerate(self.queues):
+            try:
+                queue.put(None, timeout=WORKER_PUT_TIMEOUT)
+            except Full:
+                logger.error('Worker %d is stuck', shard)
+        for shard, process in enumerate(self._processes):
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.error('Worker %d did not stop, it is terminated', shard)
+                process.terminate()
+
+    def check_worker(self, shard: int) -> None:
+        """
+        Starts the worker again if it has died. Updates queued for it are dropped, the dead worker may have
+        left the queue locked.
+        """
+        if shard >= len(self._processes) or self._processes[shard].is_alive():
+            return
+        logger.error('Worker %d has died with exit code %s, it is started again', shard, self._processes[shard].exitcode)
+        self.queues[shard] = self._context.Queue(MAX_QUEUED_UPDATES_PER_WORKER)
+        self._processes[shard] = self._start_worker(shard)
+
+    def _start_worker(self, shard: int) -> multiprocessing.Process:
+        process = self._context.Process(target=run_worker, args=(shard, self.queues[shard], self.create_worker_application), daemon=True)
+        process.start()
+        return process
+
+    def get_shard(self, update: Update) -> int:
+        chat_id = 0
+        if update.effective_chat != None:
+            chat_id = update.effective_chat.id
+        elif update.effective_user != None:
+            chat_id = update.effective_user.id
+        return chat_id % len(self.queues)
+
+    async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        shard = self.get_shard(update)
+        update_data = update.to_dict()
+        self.check_worker(shard)
+        try:
+            self.queues[shard].put_nowait(update_data)
+            return
+        except Full:
+            pass
+        # Worker is behind, front process stops taking updates until it catches up, while its loop still runs
+        while True:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.queues[shard].put, update_data, True, WORKER_PUT_TIMEOUT)
+                return
+            except Full:
+                self.check_worker(shard)
+
+def create_front_application(token: str, pool: WorkerPool, base_url: str = None) -> Application:
+    """
+    Application receiving updates and passing them to the workers, one at a time to keep their order.
+    """
+    async def stop_pool(application: Application) -> None:
+        pool.stop()
+
+    # Bounded, so polling waits too when workers are behind
+    builder = Application.builder().token(token).update_queue(asyncio.Queue(MAX_QUEUED_UPDATES_PER_WORKER)).post_shutdown(stop_pool)
+    if base_url != None:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+    application.add_handler(TypeHandler(Update, pool.route))
+    return application
+
+def run_worker(shard: int, queue: multiprocessing.Queue, create_worker_application: Callable[[int], Application]) -> None:
+    # Front process decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve_shard(queue, create_worker_application(shard)))
+
+async def _serve_shard(queue: multiprocessing.Queue, application: Application) -> None:
+    await application.initialize()
+    if application.post_init != None:
+        await application.post_init(application)
+    await application.start()
+    loop = asyncio.get_running_loop()
+    while True:
+        update_data = await loop.run_in_executor(None, queue.get)
+        if update_data == None:
+            break
+        await application.update_queue.put(Update.de_json(update_data, application.bot))
+
+    await application.stop()
+    await application.shutdown()
+    if application.post_shutdown != None:
+        await application.post_shutdown(application)
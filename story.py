@@ -1,78 +1,221 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from typing import List
-import json, base64
-from passage import Passage
-from telegram.utils import helpers
+import sys
+from typing import List, Tuple, Union
+from passage import Passage, IMAGE_BASE_64, IMAGE_BLOB
+from passage_state import PassageState, NOTHING_REVEALED
+from story_template import *
+from story_file import ImageBlob
 
-STORY_NAME = 'name'
-STORY_PASSAGES = 'passages'
-STORY_FIRST_PASSAGE_ID = "startNode"
-
-IMAGE_BASE_64 = 'imageBase64'
-
-JSON_NAME = 'name'
-JSON_VALUE = 'value'
+STATE_STORY_ID = 'story'
+STATE_PASSAGE_ID = 'passage'
+# Name finds the passage in a reloaded story when its id has changed
+STATE_PASSAGE_NAME = 'passageName'
+STATE_VARIABLES = 'variables'
+STATE_REVEALED_MACROS = 'revealed'
 
 class Story:
+    """
+    Reading session of a single user, an overlay over the shared `StoryTemplate`. The overlay holds
+    variables and frozensets of revealed macros of the passages something was revealed in, nothing
+    is copied from the template, so a session costs a few small dicts however big the story is.
+    """
     
-    def __init__(self, story_dict: dict, username: str) -> None:        
-        self.passages_by_id = {}
-        self.passages_by_name = {}
-        self.story_dict = story_dict
-        for passage_dict in story_dict[STORY_PASSAGES]:
-            passage = Passage(passage_dict, self)
-            self.passages_by_id[passage.id] = passage
-            if passage.name != None:
-                self.passages_by_name[passage.name] = passage
-        
-        first_passage_id = self.story_dict[STORY_FIRST_PASSAGE_ID]
-        self.current_passage: Passage = self.passages_by_id[first_passage_id]
+    def __init__(self, story: StoryTemplate, username: str) -> None:
+        if not isinstance(story, StoryTemplate):
+            story = StoryTemplate(story)
+        self.template = story
         self.username = username
+        self.reveal_urls = story.links.get_reveal_urls(username)
+        self.revealed_macros = {}
         self.variables = {}
+        self.current_passage: PassageState = self._create_passage_state(story.first_passage_id)
 
     def get_name(self) -> str:
-        return self.story_dict[STORY_NAME]
+        return self.template.name
     
     def get_clean_text(self) -> str:
-        return self.current_passage.get_clean_text(self.passages_by_name)
+        return self.current_passage.get_clean_text(self.template.passages_by_name)
 
     def get_image_base64(self) -> str:
         if len(self.current_passage.images) > 0:
-            return self.current_passage.images[0][IMAGE_BASE_64]
+            return self.current_passage.images[0].get(IMAGE_BASE_64)
+
+    def get_image(self) -> Union[str, ImageBlob, None]:
+        """
+        Returns base64 of the image for JSON stories and `ImageBlob` for compiled ones.
+        """
+        if len(self.current_passage.images) > 0:
+            image = self.current_passage.images[0]
+            return image.get(IMAGE_BLOB) or image.get(IMAGE_BASE_64)
 
     def navigate(self, node_name: str) -> None:
-        self.current_passage = self.passages_by_name[node_name]
+        passage: Passage = self.template.passages_by_name[node_name]
+        self.current_passage = self._create_passage_state(passage.id)
     
-    def navigate_by_deeplink(self, data: str) -> None:
-        json_string = self._base64_urlsafe_decode(data)
-        json_data = json.loads(json_string)
-        name = json_data[JSON_NAME]
-        value = json_data[JSON_VALUE]
-        self.current_passage.navigate_by_macro(name, value)
+    def navigate_by_button(self, data: str) -> bool:
+        """
+        Returns False when the button is not of this story or of its current version.
+        """
+        node_name = self.template.links.get_passage_name(data)
+        if node_name == None:
+            return False
+        self.navigate(node_name)
+        return True
+
+    def navigate_by_deeplink(self, data: str) -> bool:
+        """
+        Reveals the macro of the link. Returns False when the link is unknown or not of the current passage.
+        """
+        reveal = self.template.links.get_reveal(data)
+        if reveal == None or reveal[0] != self.current_passage.id:
+            return False
+        self.revealed_macros[reveal[0]] = self.current_passage.reveal_macro(reveal[1])
+        return True
     
     def get_links(self) -> List:
         return self.current_passage.get_links()
     
-    def create_url(self, link_name: str, link_value: str) -> str:
-        data = self._create_url_data(link_name=link_name, link_value=link_value)
-        return helpers.create_deep_linked_url(self.username, data)
+    def get_render_key(self) -> tuple:
+        """
+        Two readers with equal keys get the same text, links and image for the current passage.
+        """
+        passage = self.current_passage.passage
+        variable_values = tuple(self.variables.get(name) for name in passage.render_variable_names)
+        return (self.username, self.template.id, self.template.version, passage.id, self.current_passage.revealed_macros, variable_values)
+
+    def get_assignments(self) -> dict:
+        """
+        Variables set by the last render of the current passage.
+        """
+        return self.current_passage.assignments
 
-    def _create_url_data(self, link_name: str, link_value: str) -> str:
-        json_data = json.dumps({JSON_NAME: link_name, JSON_VALUE: link_value})
-        return self._base64_urlsafe_encode(json_data)
+    def get_state(self) -> dict:
+        """
+        Returns everything reader has changed in the story as a JSON serializable dict.
+        """
+        revealed_macros = {passage_id: sorted(indices) for passage_id, indices in self.revealed_macros.items()}
+        return {STATE_STORY_ID: self.template.id, STATE_PASSAGE_ID: self.current_passage.id, STATE_PASSAGE_NAME: self.current_passage.name,
+                STATE_VARIABLES: dict(self.variables), STATE_REVEALED_MACROS: revealed_macros}
 
-    def _base64_urlsafe_encode(self, string):
+    def restore_state(self, state: dict) -> None:
         """
-        Removes any `=` used as padding from the encoded string.
+        State may be of another version of the story: the reader stays in the passage with the same id,
+        or else with the same name, or else starts again. Reveals of removed macros are dropped.
+        """
+        passages_by_id = self.template.passages_by_id
+        self.variables = dict(state[STATE_VARIABLES])
+        self.revealed_macros = {}
+        for passage_id, indices in state[STATE_REVEALED_MACROS].items():
+            passage = passages_by_id.get(passage_id)
+            if passage != None:
+                indices = frozenset(indices).intersection(macro.index for macro in passage.link_reveal_macros)
+                if len(indices) > 0:
+                    self.revealed_macros[passage_id] = indices
+        passage_id = state[STATE_PASSAGE_ID]
+        if passage_id not in passages_by_id:
+            passage = self.template.passages_by_name.get(state.get(STATE_PASSAGE_NAME))
+            passage_id = passage.id if passage != None else self.template.first_passage_id
+        self.current_passage = self._create_passage_state(passage_id)
+
+    def migrate(self) -> bool:
         """
-        encoded = base64.urlsafe_b64encode(string.encode('ascii'))
-        return encoded.rstrip(b"=").decode('ascii')
+        Moves the reader to the newest version of the story when it was reloaded, returns True if it did.
+        """
+        template = self.template
+        while template.replaced_by != None:
+            template = template.replaced_by
+        if template is self.template:
+            return False
+        state = self.get_state()
+        self.template = template
+        self.reveal_urls = template.links.get_reveal_urls(self.username)
+        self.restore_state(state)
+        return True
+
+    def snapshot(self) -> 'Story':
+        """
+        Returns a copy that can be read on without changing this story. Revealed macros are shared
+        until one of the copies reveals something, only the dicts of the overlay are copied.
+        """
+        story = Story.__new__(Story)
+        story.template = self.template
+        story.username = self.username
+        story.reveal_urls = self.reveal_urls
+        story.revealed_macros = dict(self.revealed_macros)
+        story.variables = dict(self.variables)
+        story.current_passage = story._create_passage_state(self.current_passage.id)
+        return story
+
+    def pack(self) -> 'PackedStory':
+        """
+        Returns compact copy of the story to keep while the reader is away.
+        """
+        reveal_bits = self.template.reveal_bits
+        reveals = 0
+        for passage_id, indices in self.revealed_macros.items():
+            for index in indices:
+                reveals |= 1 << reveal_bits[(passage_id, index)]
+        return PackedStory(self.template.id, self.template.version, self.current_passage.id, reveals, tuple(self.variables.items()))
+
+    def get_size(self) -> int:
+        """
+        Approximate bytes of the reader's own objects, the template is shared and is not counted.
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.__dict__) + sys.getsizeof(self.revealed_macros) + sys.getsizeof(self.variables)
+        size += sum(sys.getsizeof(indices) for indices in self.revealed_macros.values())
+        size += sum(sys.getsizeof(value) for value in self.variables.values())
+        return size + sys.getsizeof(self.current_passage) + sys.getsizeof(self.current_passage.assignments)
+
+    def _create_passage_state(self, passage_id) -> PassageState:
+        passage = self.template.passages_by_id[passage_id]
+        return PassageState(passage, self, self.revealed_macros.get(passage_id, NOTHING_REVEALED))
+
+    def create_reveal_url(self, passage_id, macro_index: int) -> str:
+        return self.reveal_urls[(passage_id, macro_index)]
+
+
+class PackedStory:
+    """
+    Story of a reader who is away: id and version of the story, id of the current passage, revealed macros
+    as bits of `StoryTemplate.reveal_bits` and variables. A hundred bytes or so instead of
+    the dicts and passage state of `Story`. The template itself is not kept, so a reloaded story
+    frees its old version while readers are away. Never changed, `unpack` makes a new `Story`.
+    """
+    __slots__ = ('story_id', 'version', 'passage_id', 'reveals', 'variables')
+
+    def __init__(self, story_id: str, version: int, passage_id: str, reveals: int, variables: Tuple[tuple, ...]) -> None:
+        self.story_id = story_id
+        self.version = version
+        self.passage_id = passage_id
+        self.reveals = reveals
+        self.variables = variables
+
+    def unpack(self, template: StoryTemplate, username: str) -> Story:
+        """
+        `template` is the version of the story the reader was packed with.
+        """
+        revealed_macros = {}
+        reveal_keys = template.reveal_keys
+        reveals = self.reveals
+        while reveals != 0:
+            lowest = reveals & -reveals
+            passage_id, index = reveal_keys[lowest.bit_length() - 1]
+            revealed_macros[passage_id] = revealed_macros.get(passage_id, NOTHING_REVEALED) | {index}
+            reveals ^= lowest
+
+        story = Story.__new__(Story)
+        story.template = template
+        story.username = username
+        story.reveal_urls = template.links.get_reveal_urls(username)
+        story.revealed_macros = revealed_macros
+        story.variables = dict(self.variables)
+        story.current_passage = story._create_passage_state(self.passage_id)
+        return story
 
-    def _base64_urlsafe_decode(self, string):
+    def get_size(self) -> int:
         """
-        Adds back in the required padding before decoding.
+        Approximate bytes of the packed story, names of variables come from the template and are not counted.
         """
-        padding = 4 - (len(string) % 4)
-        string = string + ("=" * padding)
-        return base64.urlsafe_b64decode(string.encode('ascii')).decode('ascii')
\ No newline at end of file
+        return (sys.getsizeof(self) + sys.getsizeof(self.reveals) + sys.getsizeof(self.variables)
+                + sum(sys.getsizeof(item) + sys.getsizeof(item[1]) for item in self.variables))
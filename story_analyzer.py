@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from collections import deque
+from typing import Dict, List, Tuple
+from passage import Passage
+
+class StoryError(Exception):
+    """
+    Story can't be read, e.g. it displays a passage that doesn't exist.
+    """
+
+class StoryAnalysis:
+    """
+    Graphs of a story built at load time: which passages link to and display which.
+    Problems that would break a reader mid-story are raised as `StoryError`,
+    links to missing passages are only collected, as Twine itself allows them.
+    """
+
+    def __init__(self, passages_by_id: Dict[str, Passage], passages_by_name: Dict[str, Passage], first_passage_id) -> None:
+        if first_passage_id not in passages_by_id:
+            raise StoryError(f'Start passage {first_passage_id} does not exist')
+
+        self.link_graph: Dict[str, Tuple] = {}
+        self.display_graph: Dict[str, Tuple] = {}
+        self.broken_links: List[Tuple] = []
+        for passage in passages_by_id.values():
+            destinations = []
+            for link in passage.get_links():
+                destination = passages_by_name.get(link.destination_name)
+                if destination == None:
+                    self.broken_links.append((passage.id, link.destination_name))
+                else:
+                    destinations.append(destination.id)
+            self.link_graph[passage.id] = tuple(destinations)
+
+            displayed = []
+            for display_name in passage.display_names:
+                displayed_passage = passages_by_name.get(display_name)
+                if displayed_passage == None:
+                    raise StoryError(f'Passage {passage.id} displays missing passage "{display_name}"')
+                displayed.append(displayed_passage.id)
+            self.display_graph[passage.id] = tuple(displayed)
+
+        self.display_order = self._sort_displays()
+        self.unreachable_passage_ids = frozenset(passages_by_id.keys()) - self._find_reachable(first_passage_id)
+
+    def _sort_displays(self) -> List:
+        """
+        Returns passage ids so that every passage comes after the passages it displays.
+        """
+        order = []
+        # 1 - passage is being visited, 2 - passage and everything it displays is visited
+        marks = {}
+        for passage_id in self.display_graph:
+            if passage_id in marks:
+                continue
+            marks[passage_id] = 1
+            stack = [(passage_id, iter(self.display_graph[passage_id]))]
+            while len(stack) > 0:
+                current_id, displayed = stack[-1]
+                displayed_id = next(displayed, None)
+                if displayed_id == None:
+                    marks[current_id] = 2
+                    order.append(current_id)
+                    stack.pop()
+                elif marks.get(displayed_id) == 1:
+                    cycle = [entry[0] for entry in stack] + [displayed_id]
+                    raise StoryError(f'Passages display each other in a cycle: {" -> ".join(map(str, cycle))}')
+                elif displayed_id not in marks:
+                    marks[displayed_id] = 1
+                    stack.append((displayed_id, iter(self.display_graph[displayed_id])))
+        return order
+
+    def _find_reachable(self, first_passage_id) -> set:
+        reachable = {first_passage_id}
+        queue = deque([first_passage_id])
+        while len(queue) > 0:
+            passage_id = queue.popleft()
+            for next_id in self.link_graph[passage_id] + self.display_graph[passage_id]:
+                if next_id not in reachable:
+                    reachable.add(next_id)
+                    queue.append(next_id)
+        return reachable
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Compiles stories ahead of time: checks them, renders passages that every reader sees the same
+# and writes compiled story files, so the bot starts without reading story JSON.
+# Usage:
+#   python story_compiler.py SPACE_FROG.json stories/ --output compiled/ --workers 4 --image-cache .image-cache/
+#   python bot.py <token> --stories compiled/
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+from image_pipeline import ImagePipeline, is_available
+from passage_state import PassageState
+from story import Story
+from story_file import STORY_FILE_EXTENSION, HEADER_IMAGES, convert_story
+from story_registry import STORY_EXTENSION
+from story_template import StoryTemplate, StoryError
+
+# Links made for this bot mean the passage depends on the bot it is read in
+SNAPSHOT_USERNAME = 'snapshot_bot'
+
+@dataclass(frozen=True)
+class CompileReport:
+    path: str
+    output: Optional[str] = None
+    passages: int = 0
+    images: int = 0
+    snapshots: int = 0
+    warnings: Tuple[str, ...] = ()
+    error: Optional[str] = None
+
+def find_stories(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(str(file) for file in Path(path).iterdir() if file.suffix == STORY_EXTENSION))
+        else:
+            files.append(path)
+    return files
+
+def render_snapshots(template: StoryTemplate) -> Dict[str, Tuple[str, Sequence[dict]]]:
+    """
+    Renders passages that don't read variables, don't set them and have no link-reveals,
+    as they look for a reader who has revealed nothing.
+    """
+    story = Story(template, SNAPSHOT_USERNAME)
+    snapshots = {}
+    for passage_id, passage in template.passages_by_id.items():
+        if len(passage.render_variable_names) > 0:
+            continue
+        state = PassageState(passage, story)
+        text = state.get_clean_text(template.passages_by_name)
+        if len(state.assignments) > 0 or SNAPSHOT_USERNAME in text:
+            continue
+        snapshots[passage_id] = (text, tuple(state.images))
+    return snapshots
+
+def compile_story(path: str, output_directory: str, image_pipeline: ImagePipeline = None) -> CompileReport:
+    """
+    Writes compiled story into `output_directory`, with images optimized by `image_pipeline` if given.
+    Problems that would break readers are returned as the error of the report, problems readers
+    can live with as warnings.
+    """
+    try:
+        with open(path) as f:
+            story_dict = json.load(f)
+        template = StoryTemplate(story_dict)
+    except (OSError, ValueError, KeyError, StoryError) as error:
+        return CompileReport(path, error=f'{type(error).__name__}: {error}')
+
+    warnings = []
+    for passage_id, passage in template.passages_by_id.items():
+        for error in passage.errors:
+            warnings.append(f'Passage {passage_id} has macro that is not supported: {error}')
+    for passage_id, destination_name in template.analysis.broken_links:
+        warnings.append(f'Passage {passage_id} links to missing passage "{destination_name}"')
+    if len(template.analysis.unreachable_passage_ids) > 0:
+        warnings.append(f'Passages {sorted(map(str, template.analysis.unreachable_passage_ids))} can not be reached')
+
+    snapshots = render_snapshots(template)
+    output = os.path.join(output_directory, Path(path).stem + STORY_FILE_EXTENSION)
+    header = convert_story(story_dict, output, snapshots, image_pipeline)
+    return CompileReport(path, output, len(template.passages_by_id), len(header[HEADER_IMAGES]), len(snapshots), tuple(warnings))
+
+def compile_stories(paths: List[str], output_directory: str, workers: int = None, optimize_images: bool = True,
+                    image_cache: str = None) -> List[CompileReport]:
+    """
+    Compiles every story in its own process, `workers` processes at a time, one per CPU by default.
+    A single story has its images optimized in `workers` processes instead.
+    Optimized images are kept in `image_cache` directory, so compiling again only optimizes new ones.
+    """
+    files = find_stories(paths)
+    os.makedirs(output_directory, exist_ok=True)
+    if workers == 1 or len(files) <= 1:
+        image_pipeline = ImagePipeline(image_cache, workers or os.cpu_count()) if optimize_images else None
+        return [compile_story(file, output_directory, image_pipeline) for file in files]
+    # Stories are already compiled in parallel, images of each are optimized in its process
+    image_pipeline = ImagePipeline(image_cache) if optimize_images else None
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(compile_story, files, [output_directory] * len(files), [image_pipeline] * len(files)))
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Checks "GTwine to JSON" stories and compiles them for the bot')
+    parser.add_argument('stories', nargs='+', help='story JSON files or directories with them')
+    parser.add_argument('--output', required=True, help='directory for compiled stories')
+    parser.add_argument('--workers', type=int, help='number of processes, one per CPU by default')
+    parser.add_argument('--image-cache', help='directory keeping optimized images between runs')
+    parser.add_argument('--keep-images', action='store_true', help='store images as they are, without resizing them for Telegram')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    # Warnings are reported below, once per story
+    logging.basicConfig(level=logging.ERROR)
+    arguments = parse_arguments()
+    if not arguments.keep_images and not is_available():
+        print('Pillow is not installed, images are stored as they are')
+    reports = compile_stories(arguments.stories, arguments.output, arguments.workers, not arguments.keep_images, arguments.image_cache)
+    for report in reports:
+        if report.error != None:
+            print(f'{report.path}: {report.error}')
+            continue
+        print(f'{report.path} -> {report.output}: {report.passages} passages, {report.images} images, {report.snapshots} snapshots')
+        for warning in report.warnings:
+            print(f'  {warning}')
+    failed = sum(1 for report in reports if report.error != None)
+    print(f'{len(reports) - failed} compiled, {failed} failed')
+    sys.exit(1 if failed > 0 else 0)
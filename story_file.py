@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Compiled story format: passages in an indexed table, images as raw bytes in a separate section.
+# Passages may carry render snapshots made by `story_compiler.py`, their images are blob indices too.
+# Usage:
+#   python story_file.py SPACE_FROG.json SPACE_FROG.twc
+import argparse
+import base64
+import hashlib
+import json
+import mmap
+import os
+import struct
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Sequence, Tuple
+from image_pipeline import ImagePipeline
+from passage import *
+from story_template import STORY_PASSAGES, StoryError
+
+STORY_FILE_EXTENSION = '.twc'
+STORY_FILE_MAGIC = b'TWCOIL'
+STORY_FILE_VERSION = 1
+# Magic, version, header length, passage table length
+PREAMBLE_FORMAT = '<6sHII'
+
+HEADER_PASSAGES = 'passageIndex'
+HEADER_IMAGES = 'imageIndex'
+IMAGE_BLOB_INDEX = 'blobIndex'
+
+@dataclass(frozen=True)
+class ImageBlob:
+    """
+    Image bytes of a compiled story, `data` points right into the mapped file.
+    `hash` is sha256 of the image base64, same as `ImageCache` uses for JSON stories.
+    """
+    hash: str
+    data: memoryview
+
+class StoryFile:
+    """
+    Compiled story mapped into memory. Passages are decoded one by one when asked for,
+    images are never copied: `ImageBlob.data` is a view of the mapped file.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        with open(file_path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        preamble_size = struct.calcsize(PREAMBLE_FORMAT)
+        if len(self._map) < preamble_size:
+            raise StoryError(f'{file_path} is not a compiled story')
+        magic, version, header_length, table_length = struct.unpack_from(PREAMBLE_FORMAT, self._map)
+        if magic != STORY_FILE_MAGIC:
+            raise StoryError(f'{file_path} is not a compiled story')
+        if version != STORY_FILE_VERSION:
+            raise StoryError(f'{file_path} has version {version}, only {STORY_FILE_VERSION} is supported')
+
+        self.header = json.loads(self._map[preamble_size:preamble_size + header_length])
+        self._table_offset = preamble_size + header_length
+        self._blobs_offset = self._table_offset + table_length
+        self._view = memoryview(self._map)
+
+    def get_passage_count(self) -> int:
+        return len(self.header[HEADER_PASSAGES])
+
+    def get_passage_dict(self, index: int) -> dict:
+        offset, length = self.header[HEADER_PASSAGES][index]
+        start = self._table_offset + offset
+        passage_dict = json.loads(self._map[start:start + length])
+        for image in passage_dict[PASSAGE_IMAGES]:
+            image[IMAGE_BLOB] = self.get_image(image.pop(IMAGE_BLOB_INDEX))
+        snapshot = passage_dict.get(PASSAGE_SNAPSHOT)
+        if snapshot != None:
+            snapshot[SNAPSHOT_IMAGES] = [{IMAGE_BLOB: self.get_image(index)} for index in snapshot[SNAPSHOT_IMAGES]]
+        return passage_dict
+
+    def get_image(self, index: int) -> ImageBlob:
+        offset, length, image_hash = self.header[HEADER_IMAGES][index]
+        start = self._blobs_offset + offset
+        return ImageBlob(image_hash, self._view[start:start + length])
+
+    def iterate_passage_dicts(self) -> Iterator[dict]:
+        for index in range(self.get_passage_count()):
+            yield self.get_passage_dict(index)
+
+    def get_story_dict(self) -> dict:
+        """
+        Story in "GTwine to JSON" form for `StoryTemplate`, passages are read while it iterates them.
+        """
+        story_dict = {key: value for key, value in self.header.items() if key not in (HEADER_PASSAGES, HEADER_IMAGES)}
+        story_dict[STORY_PASSAGES] = self.iterate_passage_dicts()
+        return story_dict
+
+def convert_story(story_dict: dict, file_path: str, snapshots: Dict[str, Tuple[str, Sequence[dict]]] = None,
+                  image_pipeline: ImagePipeline = None) -> dict:
+    """
+    Writes "GTwine to JSON" story as a compiled story. Equal images are stored once.
+    `snapshots` are texts and images of passages by passage id, see `Passage.snapshot`.
+    Images are optimized for Telegram by `image_pipeline` when it is given.
+    Returns header of the written file.
+    """
+    header = {key: value for key, value in story_dict.items() if key != STORY_PASSAGES}
+    header[HEADER_PASSAGES] = []
+    header[HEADER_IMAGES] = []
+    table = bytearray()
+    blobs: List[bytes] = []
+    image_indices = {}
+
+    def add_image(image_base64: str) -> int:
+        # Hash of the original, images are found by it before they are optimized
+        image_hash = hashlib.sha256(image_base64.encode('ascii')).hexdigest()
+        if image_hash not in image_indices:
+            image_indices[image_hash] = len(header[HEADER_IMAGES])
+            header[HEADER_IMAGES].append(image_hash)
+            blobs.append(base64.b64decode(image_base64.encode('ascii')))
+        return image_indices[image_hash]
+
+    for passage_dict in story_dict[STORY_PASSAGES]:
+        passage_dict = dict(passage_dict)
+        images = []
+        for image in passage_dict.get(PASSAGE_IMAGES, []):
+            image = dict(image)
+            image[IMAGE_BLOB_INDEX] = add_image(image.pop(IMAGE_BASE_64))
+            images.append(image)
+        passage_dict[PASSAGE_IMAGES] = images
+        if snapshots != None and passage_dict[PASSAGE_ID] in snapshots:
+            text, snapshot_images = snapshots[passage_dict[PASSAGE_ID]]
+            passage_dict[PASSAGE_SNAPSHOT] = {SNAPSHOT_TEXT: text, SNAPSHOT_IMAGES: [add_image(image[IMAGE_BASE_64]) for image in snapshot_images]}
+
+        record = json.dumps(passage_dict, separators=(',', ':')).encode('utf-8')
+        header[HEADER_PASSAGES].append([len(table), len(record)])
+        table += record
+
+    if image_pipeline != None:
+        blobs = image_pipeline.process(blobs)
+    blob_size = 0
+    for index, data in enumerate(blobs):
+        header[HEADER_IMAGES][index] = [blob_size, len(data), header[HEADER_IMAGES][index]]
+        blob_size += len(data)
+
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    # Written aside and renamed, so a running bot never maps a half written or truncated file
+    temporary_path = file_path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(struct.pack(PREAMBLE_FORMAT, STORY_FILE_MAGIC, STORY_FILE_VERSION, len(header_bytes), len(table)))
+        f.write(header_bytes)
+        f.write(table)
+        for data in blobs:
+            f.write(data)
+    os.replace(temporary_path, file_path)
+    return header
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Converts "GTwine to JSON" story to the compiled story format')
+    parser.add_argument('story', help='story JSON file')
+    parser.add_argument('output', help=f'compiled story file, usually with {STORY_FILE_EXTENSION} extension')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    with open(arguments.story) as f:
+        convert_story(json.load(f), arguments.output)
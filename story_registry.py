@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import logging
+import os
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+from story_template import *
+from story_file import StoryFile, STORY_FILE_EXTENSION
+from link_codec import DEFAULT_LINK_SECRET, sign_story
+
+STORY_EXTENSION = '.json'
+HEADER_CHUNK_SIZE = 4096
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class StoryHeader:
+    story_id: str
+    name: str
+    first_passage_id: str
+    path: str
+    # Modification time of the file in nanoseconds, version of the story
+    modified: int = field(default=0, compare=False)
+
+class StoryRegistry:
+    """
+    Catalogue of stories found in the given files and directories, JSON or compiled ones.
+    At start only headers of the stories are read, a story is compiled when its first reader comes. At most `capacity`
+    compiled stories are kept, the least recently used one is dropped first.
+    Links of the stories are signed with `link_secret`.
+    Changed and new files are found by `reload_changed`, stories of changed files are compiled again
+    and swapped in, readers move to the new version on their next click, see `Story.migrate`.
+    """
+
+    def __init__(self, paths: List[str], capacity: int, link_secret: bytes = DEFAULT_LINK_SECRET) -> None:
+        self.paths = paths
+        self.capacity = capacity
+        self.link_secret = link_secret
+        self.reloads = 0
+        self.headers: Dict[str, StoryHeader] = {}
+        self._templates = OrderedDict()
+        # Every version still read by someone, to mark it replaced on reload
+        self._live_templates: Dict[str, weakref.WeakSet] = {}
+        # Modification times of files that failed to reload, so they are reported once
+        self._failed_versions: Dict[str, Optional[int]] = {}
+        # Guards the dicts, stories are compiled outside of it
+        self._lock = Lock()
+        # Lock per story id, taken while the story is compiled
+        self._loading: Dict[str, Lock] = {}
+        # Story id -> (version, error) of stories that failed to compile, they are not compiled again until their file changes
+        self._failed_compiles: Dict[str, Tuple[int, StoryError]] = {}
+        # Catalogue button tokens by story id and story ids by token
+        self.story_data: Dict[str, str] = {}
+        self._stories_by_data: Dict[str, str] = {}
+        for file in self._find_files():
+            self._add_header(read_header(file))
+        if len(self.headers) == 0:
+            raise StoryError(f'No stories found in {paths}')
+        self.default_story_id = next(iter(self.headers))
+
+    def _find_files(self) -> List[str]:
+        files = []
+        for path in self.paths:
+            if os.path.isdir(path):
+                files.extend(sorted(str(file) for file in Path(path).iterdir() if file.suffix in (STORY_EXTENSION, STORY_FILE_EXTENSION)))
+            else:
+                files.append(path)
+        return files
+
+    def get_headers(self) -> List[StoryHeader]:
+        return list(self.headers.values())
+
+    def find_story(self, data: str) -> Optional[str]:
+        """
+        Returns id of the story chosen by a catalogue button, None for unknown and forged buttons.
+        """
+        return self._stories_by_data.get(data)
+
+    def _add_header(self, header: StoryHeader) -> None:
+        self.headers[header.story_id] = header
+        data = sign_story(header.story_id, len(self.story_data), self.link_secret)
+        self.story_data[header.story_id] = data
+        self._stories_by_data[data] = header.story_id
+
+    def get_loaded_count(self) -> int:
+        return len(self._templates)
+
+    def get_template(self, story_id: str = None) -> StoryTemplate:
+        """
+        Compiles the story when it is not loaded, so the event loop calls it in a thread. Callers asking
+        for the story being compiled wait for it, loaded stories are returned right away.
+        Raises `StoryError` when the story can't be compiled, the failure is remembered until its file changes.
+        """
+        if story_id == None:
+            story_id = self.default_story_id
+        with self._lock:
+            template = self._find_template(story_id)
+            if template != None:
+                return template
+            loading = self._loading.setdefault(story_id, Lock())
+        with loading:
+            with self._lock:
+                # Compiled by another thread while this one was waiting
+                template = self._find_template(story_id)
+                if template != None:
+                    return template
+                header = self.headers[story_id]
+                failed = self._failed_compiles.get(story_id)
+            if failed != None and failed[0] == header.modified:
+                raise failed[1]
+            try:
+                template = load_template(header.path, story_id, self.link_secret, header.modified)
+            except (OSError, ValueError, KeyError, StoryError) as error:
+                failure = error if isinstance(error, StoryError) else StoryError(f'Story {header.path} can\'t be read: {error}')
+                logger.error('Story "%s" is not loaded: %s', header.name, failure)
+                with self._lock:
+                    self._failed_compiles[story_id] = (header.modified, failure)
+                raise failure
+            with self._lock:
+                self._failed_compiles.pop(story_id, None)
+                self._add_template(story_id, template)
+            logger.info('Story "%s" is loaded', header.name)
+            return template
+
+    def find_template(self, story_id: str) -> Optional[StoryTemplate]:
+        """
+        Returns the current version of the story if it is compiled, never compiles it.
+        """
+        with self._lock:
+            if story_id not in self.headers:
+                return None
+            return self._find_template(story_id)
+
+    def _find_template(self, story_id: str) -> Optional[StoryTemplate]:
+        template = self._templates.get(story_id)
+        if template != None:
+            self._templates.move_to_end(story_id)
+            return template
+        # Readers keep dropped stories alive, the current version of one is used instead of compiling it again
+        version = self.headers[story_id].modified
+        for template in self._live_templates.get(story_id, ()):
+            if template.version == version and template.replaced_by == None:
+                self._add_template(story_id, template)
+                return template
+        return None
+
+    def _add_template(self, story_id: str, template: StoryTemplate) -> None:
+        self._templates[story_id] = template
+        self._templates.move_to_end(story_id)
+        self._live_templates.setdefault(story_id, weakref.WeakSet()).add(template)
+        if len(self._templates) > self.capacity:
+            self._templates.popitem(last=False)
+
+    def reload_changed(self) -> List[str]:
+        """
+        Reads headers of new story files and compiles again stories whose files have changed.
+        A story that fails to compile keeps its old version. Returns ids of reloaded stories.
+        """
+        paths = {header.path: header for header in self.headers.values()}
+        reloaded = []
+        for file in self._find_files():
+            old_header = paths.get(file)
+            modified = None
+            try:
+                modified = os.stat(file).st_mtime_ns
+                if self._failed_versions.get(file) == modified:
+                    continue
+                if old_header == None:
+                    header = read_header(file)
+                    with self._lock:
+                        self._add_header(header)
+                    logger.info('Story "%s" is added', header.name)
+                elif modified != old_header.modified:
+                    self._reload(old_header.story_id, read_header(file, old_header.story_id))
+                    reloaded.append(old_header.story_id)
+            except (OSError, ValueError, KeyError, StoryError) as error:
+                # Modification time is None for a file that can't be read at all, e.g. a removed one
+                if file not in self._failed_versions or self._failed_versions[file] != modified:
+                    logger.error('Story %s is not reloaded: %s', file, error)
+                self._failed_versions[file] = modified
+        return reloaded
+
+    def _reload(self, story_id: str, header: StoryHeader) -> None:
+        if len(self._live_templates.get(story_id, ())) == 0:
+            # Nobody reads it, the new version is compiled when it is asked for
+            with self._lock:
+                self.headers[story_id] = header
+            return
+        # Compiled outside of the lock, readers of other stories don't wait
+        template = load_template(header.path, story_id, self.link_secret, header.modified)
+        with self._lock:
+            self.headers[story_id] = header
+            for old_template in list(self._live_templates.get(story_id, ())):
+                old_template.replaced_by = template
+            self._add_template(story_id, template)
+            self.reloads += 1
+        logger.info('Story "%s" is reloaded', header.name)
+
+    async def watch(self, interval: float) -> None:
+        """
+        Looks for changed story files every `interval` seconds.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.reload_changed)
+            except Exception:
+                # Stories are still watched after an unexpected failure
+                logger.exception('Story files are not checked')
+
+def load_template(path: str, story_id: str = None, link_secret: bytes = DEFAULT_LINK_SECRET, version: int = 0) -> StoryTemplate:
+    if Path(path).suffix == STORY_FILE_EXTENSION:
+        return StoryTemplate(StoryFile(path).get_story_dict(), story_id, link_secret, version)
+    with open(path) as f:
+        return StoryTemplate(json.load(f), story_id, link_secret, version)
+
+def read_header(path: str, story_id: str = None) -> StoryHeader:
+    """
+    Reads name, uuid and start passage from the beginning of story JSON, without reading passages.
+    """
+    modified = os.stat(path).st_mtime_ns
+    if Path(path).suffix == STORY_FILE_EXTENSION:
+        header = StoryFile(path).header
+    else:
+        header = _read_header_fields(path)
+    if header == None or STORY_FIRST_PASSAGE_ID not in header:
+        # Passages come first in this file, nothing to do but to read all of it
+        with open(path) as f:
+            header = json.load(f)
+    if STORY_FIRST_PASSAGE_ID not in header:
+        raise StoryError(f'Story {path} has no start passage')
+
+    story_id = story_id or header.get(STORY_UUID) or Path(path).stem
+    return StoryHeader(story_id, header.get(STORY_NAME, story_id), header[STORY_FIRST_PASSAGE_ID], path, modified)
+
+def _read_header_fields(path: str) -> dict:
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        text = ''
+        while True:
+            chunk = f.read(HEADER_CHUNK_SIZE)
+            text += chunk
+            fields = _decode_fields(decoder, text)
+            if fields != None or not chunk:
+                return fields
+
+def _decode_fields(decoder: json.JSONDecoder, text: str) -> dict:
+    """
+    Decodes top level fields before "passages", returns None when the text ends too early.
+    """
+    fields = {}
+    position = _skip_spaces(text, 0)
+    if position >= len(text) or text[position] != '{':
+        return None
+    position += 1
+    try:
+        while True:
+            position = _skip_spaces(text, position)
+            if text[position] == '}':
+                return fields
+            key, position = decoder.raw_decode(text, position)
+            position = _skip_spaces(text, position)
+            position = _skip_spaces(text, position + 1)
+            if key == STORY_PASSAGES:
+                return fields
+            value, position = decoder.raw_decode(text, position)
+            # Values ending exactly at the end of the text may be cut, e.g. a number
+            if position >= len(text):
+                return None
+            fields[key] = value
+            position = _skip_spaces(text, position)
+            if text[position] == ',':
+                position += 1
+    except (IndexError, ValueError):
+        return None
+
+def _skip_spaces(text: str, position: int) -> int:
+    while position < len(text) and text[position] in ' \t\r\n':
+        position += 1
+    return position
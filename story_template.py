@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import dataclasses
+import logging
+from typing import Optional
+from macro import *
+from markup import *
+from passage import Passage
+from link_codec import LinkCodec, DEFAULT_LINK_SECRET
+from story_analyzer import StoryAnalysis, StoryError
+
+STORY_NAME = 'name'
+STORY_PASSAGES = 'passages'
+STORY_FIRST_PASSAGE_ID = "startNode"
+STORY_UUID = 'uuid'
+
+logger = logging.getLogger(__name__)
+
+class StoryTemplate:
+    """
+    Story compiled once from its JSON and shared between every reader.
+    Nothing here is changed after construction, per-reader progress lives in `Story`.
+    Buttons and deeplinks are signed with `link_secret`. `version` tells versions of one story apart,
+    e.g. modification time of its file. When the story is reloaded the old version gets `replaced_by`,
+    the only field set after construction.
+    Raises `StoryError` when the story can't be read.
+    """
+
+    def __init__(self, story_dict: dict, story_id: str = None, link_secret: bytes = DEFAULT_LINK_SECRET, version: int = 0) -> None:
+        self.version = version
+        self.replaced_by: Optional['StoryTemplate'] = None
+        self.passages_by_id = {}
+        self.passages_by_name = {}
+        for passage_dict in story_dict[STORY_PASSAGES]:
+            passage = Passage(passage_dict)
+            self.passages_by_id[passage.id] = passage
+            if passage.name != None:
+                self.passages_by_name[passage.name] = passage
+            for error in passage.errors:
+                logger.warning('Passage %s has macro that is not supported: %s', passage.id, error)
+
+        self.name = story_dict.get(STORY_NAME)
+        self.id = story_id or story_dict.get(STORY_UUID) or self.name
+        if STORY_FIRST_PASSAGE_ID not in story_dict:
+            raise StoryError('Story has no start passage')
+        self.first_passage_id = story_dict[STORY_FIRST_PASSAGE_ID]
+        self.links = LinkCodec(self.id, self.passages_by_id.values(), link_secret)
+        # Bit of every link-reveal macro in `PackedStory.reveals`, by passage id and macro number
+        self.reveal_bits = {key: bit for bit, key in enumerate(self.links.reveal_payloads)}
+        self.reveal_keys = tuple(self.reveal_bits)
+
+        self.analysis = StoryAnalysis(self.passages_by_id, self.passages_by_name, self.first_passage_id)
+        for passage_id, destination_name in self.analysis.broken_links:
+            logger.warning('Passage %s links to missing passage "%s"', passage_id, destination_name)
+        if len(self.analysis.unreachable_passage_ids) > 0:
+            logger.info('Passages %s can not be reached', sorted(map(str, self.analysis.unreachable_passage_ids)))
+
+        # Displayed passages come first, so what they display is already inlined
+        for passage_id in self.analysis.display_order:
+            passage = self.passages_by_id[passage_id]
+            passage.nodes = self._inline_static_displays(passage.nodes)
+            variable_names = set(passage.variable_names)
+            hook_names = set(passage.hooks_by_name)
+            for displayed_id in self.analysis.display_graph[passage_id]:
+                displayed_passage = self.passages_by_id[displayed_id]
+                variable_names.update(displayed_passage.render_variable_names)
+                hook_names.update(displayed_passage.render_hook_names)
+            passage.render_variable_names = tuple(sorted(variable_names))
+            passage.render_hook_names = frozenset(hook_names)
+            for macro in passage.show_macros:
+                if macro.value.strip()[1:] not in hook_names:
+                    logger.warning('Passage %s shows missing hook "%s"', passage_id, macro.value)
+
+    def _inline_static_displays(self, nodes: tuple) -> tuple:
+        """
+        Replaces (display:) of passages holding nothing but text with that text.
+        """
+        inlined = []
+        for node in nodes:
+            if type(node) is MacroNode and node.name == MACRO_DISPLAY:
+                displayed_passage = self.passages_by_name[node.value]
+                if displayed_passage.is_static():
+                    inlined.extend(displayed_passage.nodes)
+                    continue
+            elif type(node) is HookNode:
+                node = dataclasses.replace(node, nodes=self._inline_static_displays(node.nodes))
+            elif type(node) in (MacroNode, ConditionalNode) and node.hook != None:
+                hook = dataclasses.replace(node.hook, nodes=self._inline_static_displays(node.hook.nodes))
+                node = dataclasses.replace(node, hook=hook)
+            inlined.append(node)
+
+        merged = []
+        for node in inlined:
+            if type(node) is TextNode and len(merged) > 0 and type(merged[-1]) is TextNode:
+                merged[-1] = TextNode(merged[-1].text + node.text)
+            else:
+                merged.append(node)
+        return tuple(merged)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import heapq
+import json
+import logging
+import time
+from typing import IO, Iterator, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+class UpdateRecorder:
+    """
+    Appends every update the bot handles to a log, one JSON line per update: receive time and
+    the update as Telegram sent it. Lines are flushed as they are written, so the log survives a crash.
+    Logs hold messages of readers, keep them as private as the session store.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.recorded = 0
+        self._file: Optional[IO[str]] = open(path, 'a', buffering=1, encoding='utf-8')
+
+    async def record(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if self._file == None:
+            return
+        self._file.write(json.dumps([round(time.time(), 3), update.to_dict()], separators=(',', ':'), ensure_ascii=False) + '\n')
+        self.recorded += 1
+
+    def close(self) -> None:
+        if self._file != None:
+            self._file.close()
+            self._file = None
+
+def read_updates(paths: List[str]) -> Iterator[Tuple[float, dict]]:
+    """
+    Yields receive time and update of every recorded update, logs of several workers are merged by time.
+    """
+    return heapq.merge(*(_read_log(path) for path in paths), key=lambda record: record[0])
+
+def _read_log(path: str) -> Iterator[Tuple[float, dict]]:
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            try:
+                received, update_dict = json.loads(line)
+            except ValueError:
+                # Last line may be cut by a crash
+                logger.warning('Log %s is broken at line %d, the rest is skipped', path, number)
+                return
+            yield received, update_dict
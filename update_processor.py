@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+from typing import Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles updates of different chats concurrently, while updates of one chat are handled in order.
+    Reader may click faster than the bot answers and the story must see clicks in the order they were made.
+    """
+
+    def __init__(self, max_concurrent_updates: int) -> None:
+        super().__init__(max_concurrent_updates)
+        # Slots are taken after the chat lock, see `process_update`
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks = {}
+
+    async def process_update(self, update: object, coroutine: Awaitable) -> None:
+        # Base class takes a slot before `do_process_update`, so updates queued behind a busy chat would hold
+        # every slot while waiting for it and other chats would starve. Only the first update of a chat takes one here.
+        chat_id = None
+        if isinstance(update, Update) and update.effective_chat != None:
+            chat_id = update.effective_chat.id
+
+        lock, waiting = self._chat_locks.get(chat_id, (asyncio.Lock(), 0))
+        self._chat_locks[chat_id] = (lock, waiting + 1)
+        try:
+            async with lock:
+                async with self._slots:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            lock, waiting = self._chat_locks[chat_id]
+            if waiting == 1:
+                del self._chat_locks[chat_id]
+            else:
+                self._chat_locks[chat_id] = (lock, waiting - 1)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
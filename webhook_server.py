@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import logging
+import signal
+from typing import Optional
+
+from telegram import Bot, Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'x-telegram-bot-api-secret-token'
+RETRY_AFTER_SECONDS = 1
+MAX_BODY_SIZE = 1024 * 1024
+
+STATUS_TEXTS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+class WebhookServer:
+    """
+    Small HTTP server receiving updates from Telegram. Body may hold one update or a list of them.
+    Updates go to the bounded `update_queue` of the application, when there is no room for
+    the whole batch the server answers 503 and Telegram sends the batch again later.
+    """
+
+    def __init__(self, update_queue: asyncio.Queue, bot: Bot, path: str = '/', secret_token: str = None) -> None:
+        self.update_queue = update_queue
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self, host: str, port: int) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            keep_alive = True
+            while keep_alive:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split(' ', 2)
+                headers = await self._read_headers(reader)
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, 413, False)
+                    break
+                body = await reader.readexactly(length)
+                keep_alive = headers.get('connection', '').lower() != 'close' and version.strip() == 'HTTP/1.1'
+                status = self._handle_request(method, path, headers, body)
+                await self._respond(writer, status, keep_alive)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_headers(self, reader: asyncio.StreamReader) -> dict:
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                return headers
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+    def _handle_request(self, method: str, path: str, headers: dict, body: bytes) -> int:
+        if method != 'POST' or path != self.path:
+            return 404
+        if self.secret_token != None and headers.get(SECRET_TOKEN_HEADER) != self.secret_token:
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(data, list):
+            data = [data]
+
+        # Whole batch is parsed first, a broken update must not leave the ones before it queued
+        try:
+            updates = [Update.de_json(update_data, self.bot) for update_data in data if isinstance(update_data, dict)]
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return 400
+        if len(updates) != len(data):
+            return 400
+
+        if self.update_queue.maxsize > 0 and self.update_queue.maxsize - self.update_queue.qsize() < len(updates):
+            return 503
+        for update in updates:
+            self.update_queue.put_nowait(update)
+        return 200
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, keep_alive: bool) -> None:
+        headers = [f'HTTP/1.1 {status} {STATUS_TEXTS.get(status, "")}', 'Content-Length: 0']
+        if status == 503:
+            headers.append(f'Retry-After: {RETRY_AFTER_SECONDS}')
+        if not keep_alive:
+            headers.append('Connection: close')
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+async def serve_webhook(application: Application, url: str, host: str, port: int, path: str = '/', secret_token: str = None) -> None:
+    """
+    Runs the application with updates coming to the webhook until SIGINT or SIGTERM.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop.set)
+
+    await application.initialize()
+    if application.post_init != None:
+        await application.post_init(application)
+    server = WebhookServer(application.update_queue, application.bot, path, secret_token)
+    await server.start(host, port)
+    await application.bot.set_webhook(url, secret_token=secret_token)
+    await application.start()
+    logger.info('Webhook is listening on %s:%s', host, server.port)
+
+    await stop.wait()
+
+    await server.stop()
+    await application.stop()
+    await application.shutdown()
+    if application.post_shutdown != None:
+        await application.post_shutdown(application)